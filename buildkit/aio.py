@@ -0,0 +1,319 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for asyncio entry points to prepare buildspace trees.
+
+The coroutines run the blocking work of source_retrieval and domain_substitution in an
+executor, so that several buildspaces can be prepared concurrently from one event loop.
+They can be cancelled: the work stops before the next file (or download chunk), and
+asyncio.CancelledError is raised once it has stopped.
+
+Progress is reported as ProgressEvent tuples, to a callback passed as on_progress (which may
+be a coroutine function), or through the async iterator EventStream.
+"""
+
+import asyncio
+import collections
+import inspect
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from . import domain_substitution, metrics, source_retrieval, tracing
+from .common import STREAM_THRESHOLD, BuildkitAbort, get_logger
+
+# Constants
+
+# Minimum number of seconds between progress events of the same stage
+_EVENT_INTERVAL = 0.1
+
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+ProgressEvent = collections.namedtuple('ProgressEvent', ('stage', 'item', 'done', 'total'))
+ProgressEvent.__doc__ = """
+Progress of an operation.
+
+stage is 'download', 'extract', or 'substitute'
+item is the name of the file being downloaded, or the last file processed
+done is the number of bytes downloaded, or the number of files processed
+total is the size of the download or the number of files to process, or None if unknown
+"""
+
+# Custom Exceptions
+
+class OperationCancelled(BuildkitAbort):
+    """Exception raised in the worker thread to stop a cancelled operation"""
+    pass
+
+# Private definitions
+
+class _Operation:
+    """State shared by a coroutine and the worker thread doing its work"""
+
+    def __init__(self, on_progress):
+        self._loop = asyncio.get_event_loop()
+        self._on_progress = on_progress
+        self._queue = asyncio.Queue()
+        self._cancelled = threading.Event()
+        self._callback_error = None
+        # Dictionary of stage to the time of the last event
+        self._last_events = dict()
+
+    def check_cancelled(self):
+        """
+        Called by the worker thread.
+
+        Raises OperationCancelled if the operation was cancelled.
+        """
+        if self._cancelled.is_set():
+            raise OperationCancelled()
+
+    def emit(self, event, final=False):
+        """
+        Called by the worker thread to report a ProgressEvent. Events are dropped if they
+        come faster than _EVENT_INTERVAL for the same stage, unless final is True.
+        """
+        if self._on_progress is None:
+            return
+        now = time.monotonic()
+        if not final and now - self._last_events.get(event.stage, 0) < _EVENT_INTERVAL:
+            return
+        self._last_events[event.stage] = now
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+
+    async def _deliver_events(self):
+        """Passes events to the callback until the None sentinel is received"""
+        while True:
+            event = await self._queue.get()
+            if event is None:
+                return
+            if self._callback_error is not None:
+                continue
+            try:
+                result = self._on_progress(event)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as exc: #pylint: disable=broad-except
+                # Stop the work and raise the error from the coroutine instead
+                self._callback_error = exc
+                self._cancelled.set()
+
+    async def run(self, function, executor):
+        """Runs function in executor and returns its result"""
+        deliver_task = asyncio.ensure_future(self._deliver_events())
+        future = self._loop.run_in_executor(executor, function)
+        try:
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                self._cancelled.set()
+                try:
+                    await future
+                except Exception: #pylint: disable=broad-except
+                    pass # The work stopped; raise the cancellation
+                raise
+            except OperationCancelled:
+                if self._callback_error is None:
+                    raise
+                result = None
+        finally:
+            self._queue.put_nowait(None)
+            await deliver_task
+        if self._callback_error is not None:
+            raise self._callback_error
+        return result
+
+class _ProgressBridge:
+    """
+    Progress object for the progress argument of the blocking functions. It reports every
+    recorded item as a ProgressEvent, and stops the work if the operation is cancelled.
+    It can wrap a checkpoint.StageProgress to keep its behavior.
+    """
+
+    def __init__(self, operation, stage, total=None, progress=None):
+        self._operation = operation
+        self._stage = stage
+        self._total = total
+        self._progress = progress
+        self._done = 0
+        self._last_item = None
+
+    @property
+    def resumed(self):
+        """Indicates if the stage is resuming from previous progress"""
+        return self._progress is not None and self._progress.resumed
+
+    def __contains__(self, item):
+        return self._progress is not None and item in self._progress
+
+    def __len__(self):
+        return 0 if self._progress is None else len(self._progress)
+
+    def add(self, item):
+        """Records item as processed"""
+        self._operation.check_cancelled()
+        if self._progress is not None:
+            self._progress.add(item)
+        self._done += 1
+        self._last_item = item
+        self._operation.emit(ProgressEvent(self._stage, item, self._done, self._total))
+
+    def flush(self):
+        """Reports the final progress, and flushes the wrapped progress"""
+        if self._progress is not None:
+            self._progress.flush()
+        self._operation.emit(
+            ProgressEvent(self._stage, self._last_item, self._done, self._total), final=True)
+
+def _download(operation, file_path, url):
+    """
+    Downloads url to file_path in chunks if file_path does not exist, like
+    source_retrieval.retrieve_and_extract(). The file is written under a temporary name
+    until it is complete.
+
+    Raises source_retrieval.NotAFileError when the destination exists but is not a file.
+    Raises urllib.error.ContentTooShortError if the download ended early.
+    """
+    if file_path.exists():
+        if not file_path.is_file():
+            raise source_retrieval.NotAFileError(file_path)
+        return
+    get_logger().info('Downloading %s ...', file_path)
+    partial_path = file_path.with_name(file_path.name + '.partial')
+    downloaded = 0
+    try:
+        with tracing.span('download', 'io', file=file_path.name):
+            with urllib.request.urlopen(url) as response, partial_path.open('wb') as file_obj:
+                total = None
+                if 'Content-Length' in response.info():
+                    total = int(response.info()['Content-Length'])
+                while True:
+                    operation.check_cancelled()
+                    chunk = response.read(_DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    file_obj.write(chunk)
+                    downloaded += len(chunk)
+                    operation.emit(ProgressEvent('download', file_path.name, downloaded, total))
+        if total is not None and downloaded < total:
+            raise urllib.error.ContentTooShortError(
+                'Retrieval incomplete: got only {} out of {} bytes'.format(downloaded, total),
+                None)
+        partial_path.replace(file_path)
+    except BaseException:
+        if partial_path.exists():
+            partial_path.unlink()
+        raise
+    finally:
+        metrics.counter('buildkit_downloaded_bytes_total', 'Bytes downloaded').add(downloaded)
+    operation.emit(ProgressEvent('download', file_path.name, downloaded, total), final=True)
+
+# Public definitions
+
+async def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree, #pylint: disable=too-many-arguments
+                               prune_binaries=True, on_progress=None, executor=None,
+                               progress=None):
+    """
+    Coroutine version of source_retrieval.retrieve_and_extract(). Missing files are
+    downloaded in chunks, so that downloads can be cancelled and report their progress.
+
+    on_progress is a callable, or coroutine function, that takes a ProgressEvent, or None
+    executor is the concurrent.futures.Executor to run the work in, or None for the
+    default executor of the event loop
+    progress is the same as in source_retrieval.retrieve_and_extract()
+    Other arguments are the same as in source_retrieval.retrieve_and_extract().
+
+    Raises asyncio.CancelledError if the coroutine was cancelled.
+    Raises the exception raised by on_progress, after stopping the work.
+    Raises the same exceptions as source_retrieval.retrieve_and_extract() otherwise.
+    """
+    operation = _Operation(on_progress)
+
+    def _work():
+        if not buildspace_downloads.exists():
+            raise FileNotFoundError(buildspace_downloads)
+        if not buildspace_downloads.is_dir():
+            raise NotADirectoryError(buildspace_downloads)
+        for file_path, url in source_retrieval.get_downloads(config_bundle, buildspace_downloads):
+            _download(operation, file_path, url)
+        bridge = _ProgressBridge(operation, 'extract', progress=progress)
+        try:
+            source_retrieval.retrieve_and_extract(
+                config_bundle, buildspace_downloads, buildspace_tree,
+                prune_binaries=prune_binaries, show_progress=False, progress=bridge)
+        finally:
+            bridge.flush()
+
+    return await operation.run(_work, executor)
+
+async def process_tree_with_bundle(config_bundle, buildspace_tree, cache_dir=None, #pylint: disable=too-many-arguments
+                                   stream_threshold=STREAM_THRESHOLD, on_progress=None,
+                                   executor=None, progress=None):
+    """
+    Coroutine version of domain_substitution.process_tree_with_bundle().
+
+    on_progress, executor, and progress are the same as in retrieve_and_extract()
+    Other arguments are the same as in domain_substitution.process_tree_with_bundle().
+
+    Raises asyncio.CancelledError if the coroutine was cancelled.
+    Raises the exception raised by on_progress, after stopping the work.
+    Raises the same exceptions as domain_substitution.process_tree_with_bundle() otherwise.
+    """
+    operation = _Operation(on_progress)
+
+    def _work():
+        if not buildspace_tree.exists():
+            raise FileNotFoundError(buildspace_tree)
+        total = len(config_bundle.domain_substitution.expand(buildspace_tree.resolve()))
+        bridge = _ProgressBridge(operation, 'substitute', total=total, progress=progress)
+        try:
+            domain_substitution.process_tree_with_bundle(
+                config_bundle, buildspace_tree, cache_dir=cache_dir,
+                stream_threshold=stream_threshold, progress=bridge)
+        finally:
+            bridge.flush()
+
+    return await operation.run(_work, executor)
+
+class EventStream:
+    """
+    Async iterator of the ProgressEvents of a coroutine function of this module.
+
+    The coroutine starts running when the stream is created. Iteration ends when it finishes,
+    and raises its exception if it failed. Cancelling the stream cancels the coroutine.
+
+    For example:
+
+        stream = EventStream(aio.retrieve_and_extract, bundle, downloads, tree)
+        async for event in stream:
+            print(event)
+    """
+
+    def __init__(self, coroutine_function, *args, **kwargs):
+        """
+        coroutine_function is retrieve_and_extract or process_tree_with_bundle
+        args and kwargs are its arguments, except on_progress
+        """
+        self._queue = asyncio.Queue()
+        kwargs['on_progress'] = self._queue.put_nowait
+        self.task = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+        self.task.add_done_callback(lambda _: self._queue.put_nowait(None))
+
+    def cancel(self):
+        """Cancels the coroutine"""
+        self.task.cancel()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._queue.get()
+        if event is None:
+            self.task.result() # Raises the exception of the coroutine, if any
+            raise StopAsyncIteration
+        return event
@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for a persistent record of the stages completed on a buildspace.
+
+Every stage is recorded with a fingerprint of its inputs when it starts, and a fingerprint
+of its outputs when it completes. A stage can be skipped if its inputs are unchanged and
+its outputs are still as it left them. A stage that was interrupted keeps a record of the
+items (e.g. files) it finished, so that it can resume where it stopped.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+from .common import ENCODING
+
+# Constants
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS stages ('
+    'name TEXT PRIMARY KEY, inputs TEXT NOT NULL, outputs TEXT, token TEXT)',
+    'CREATE TABLE IF NOT EXISTS progress ('
+    'stage TEXT NOT NULL, item TEXT NOT NULL, PRIMARY KEY (stage, item)) WITHOUT ROWID',
+)
+
+# Name of the marker file written by mark_directory(). It is not hidden, so that it is
+# deleted along with the other files of the directory (e.g. by "rm -rf tree/*").
+_MARKER_FILE = 'buildkit_checkpoint.token'
+
+# Completed items are written to the database after this many items or seconds
+_FLUSH_ITEMS = 1000
+_FLUSH_SECONDS = 2.0
+
+# Public definitions
+
+def get_fingerprint(*parts):
+    """
+    Returns a hex digest of parts, which must be composed of strings, numbers, None, lists,
+    tuples and dictionaries with string keys
+    """
+    return hashlib.sha256(json.dumps(
+        parts, ensure_ascii=False, sort_keys=True,
+        separators=(',', ':')).encode(ENCODING)).hexdigest()
+
+def get_tree_manifest(resolved_tree, relative_paths):
+    """
+    Returns a hex digest of the size and modification time of the files at relative_paths.
+    Missing files are included as missing.
+
+    resolved_tree is the resolved pathlib.Path to the buildspace tree
+    relative_paths is an iterable of POSIX path strings relative to resolved_tree
+    """
+    hasher = hashlib.sha256()
+    for relative_path in relative_paths:
+        try:
+            stat_result = os.stat(str(resolved_tree / relative_path))
+            entry = '{}\0{}\0{}\n'.format(
+                relative_path, stat_result.st_size, stat_result.st_mtime_ns)
+        except FileNotFoundError:
+            entry = '{}\0\n'.format(relative_path)
+        hasher.update(entry.encode(ENCODING, errors='surrogateescape'))
+    return hasher.hexdigest()
+
+def mark_directory(path):
+    """
+    Writes a new random token to a marker file in the directory at path, and returns it.
+    Stages can record the token as the fingerprint of outputs that are too large to hash.
+
+    Raises FileNotFoundError if the directory does not exist.
+    """
+    token = uuid.uuid4().hex
+    marker_path = path / _MARKER_FILE
+    temp_path = marker_path.with_name(marker_path.name + '.tmp')
+    temp_path.write_text(token, encoding=ENCODING)
+    os.replace(str(temp_path), str(marker_path))
+    return token
+
+def get_directory_mark(path):
+    """
+    Returns the token written by mark_directory() to the directory at path, or None if
+    there is none. The token is gone once the directory is deleted or emptied, unlike its
+    inode number, which the filesystem may reuse for a new directory.
+    """
+    try:
+        return (path / _MARKER_FILE).read_text(encoding=ENCODING).strip() or None
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+class StageProgress:
+    """
+    Record of the items completed by a stage in progress. Completed items are written to the
+    checkpoint store periodically and by flush().
+    """
+
+    def __init__(self, connection, stage, resumed):
+        """
+        connection is the sqlite3.Connection of the CheckpointStore
+        stage is the name of the stage
+        resumed indicates if the stage is resuming from previous progress
+        """
+        self.stage = stage
+        self.resumed = resumed
+        self._connection = connection
+        if resumed:
+            self._completed = {
+                row[0] for row in
+                connection.execute('SELECT item FROM progress WHERE stage = ?', (stage,))
+            }
+        else:
+            self._completed = set()
+        self._pending = list()
+        self._last_flush = time.monotonic()
+
+    def __contains__(self, item):
+        """Returns True if item was completed; False otherwise"""
+        return item in self._completed
+
+    def __len__(self):
+        """Returns the number of completed items"""
+        return len(self._completed)
+
+    def add(self, item):
+        """Records item as completed"""
+        self._completed.add(item)
+        self._pending.append((self.stage, item))
+        if (len(self._pending) >= _FLUSH_ITEMS
+                or time.monotonic() - self._last_flush >= _FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """Writes the completed items to the checkpoint store"""
+        if self._pending:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO progress (stage, item) VALUES (?, ?)', self._pending)
+            self._pending = list()
+        self._last_flush = time.monotonic()
+
+class CheckpointStore:
+    """
+    Persistent record of the stages completed on a buildspace, stored in sqlite.
+    """
+
+    def __init__(self, store_path):
+        """
+        store_path is a pathlib.Path to the database. It is created if it does not exist.
+
+        The store and its StageProgress objects may be used from another thread than the one
+        that created them (e.g. by the coroutines of aio), but not from several at once.
+
+        Raises sqlite3.OperationalError if the database cannot be opened.
+        """
+        self.store_path = store_path
+        self._connection = sqlite3.connect(str(store_path), check_same_thread=False)
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+
+    def close(self):
+        """Closes the database"""
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_record(self, stage):
+        """Returns a tuple of the inputs, outputs and token of the stage, or None"""
+        return self._connection.execute(
+            'SELECT inputs, outputs, token FROM stages WHERE name = ?', (stage,)).fetchone()
+
+    def is_complete(self, stage, inputs, outputs=''):
+        """
+        Returns True if the stage completed with the same inputs and outputs; False otherwise
+
+        stage is the name of the stage
+        inputs is the fingerprint of the inputs of the stage
+        outputs is the fingerprint of the current state of the outputs of the stage
+        """
+        record = self._get_record(stage)
+        return record is not None and record[1] is not None and record[:2] == (inputs, outputs)
+
+    def get_token(self, stage):
+        """
+        Returns a string that is unique to the last completion of the stage, or None if the
+        stage is not complete. Stages that depend on another stage can include this in
+        their inputs.
+        """
+        record = self._get_record(stage)
+        if record is None or record[1] is None:
+            return None
+        return record[2]
+
+    def start(self, stage, inputs, resume=True):
+        """
+        Records the start of a stage and returns its StageProgress.
+
+        The progress of the last run of the stage is kept if resume is True, the stage did
+        not complete, and its inputs are the same. Otherwise, the stage starts over.
+        """
+        record = self._get_record(stage)
+        resumed = bool(resume and record and record[1] is None and record[0] == inputs)
+        if not resumed:
+            with self._connection:
+                self._connection.execute('DELETE FROM progress WHERE stage = ?', (stage,))
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO stages (name, inputs, outputs, token) '
+                    'VALUES (?, ?, NULL, NULL)', (stage, inputs))
+        return StageProgress(self._connection, stage, resumed)
+
+    def complete(self, stage, outputs=''):
+        """
+        Records the completion of a stage that was started with start()
+
+        outputs is the fingerprint of the outputs of the stage
+        """
+        with self._connection:
+            self._connection.execute(
+                'UPDATE stages SET outputs = ?, token = ? WHERE name = ?',
+                (outputs, uuid.uuid4().hex, stage))
+            self._connection.execute('DELETE FROM progress WHERE stage = ?', (stage,))
+
+    def clear(self, stage):
+        """Removes the record of a stage, so that it runs again"""
+        with self._connection:
+            self._connection.execute('DELETE FROM progress WHERE stage = ?', (stage,))
+            self._connection.execute('DELETE FROM stages WHERE name = ?', (stage,))
@@ -15,19 +15,33 @@ buildkit has optional environment variables. They are as follows:
 
 * BUILDKIT_RESOURCES - Path to the resources/ directory. Defaults to
 the one in buildkit's parent directory.
+* BUILDKIT_NO_BUNDLE_CACHE - If set to a non-empty value, config bundles are always
+resolved and parsed from their files instead of loaded from buildspace/bundle_cache.
+The cache is a pickle without integrity check; set this if the buildspace is writable by
+untrusted users.
+* BUILDKIT_JOBS - The default number of parallel jobs, like the --jobs option. Defaults to
+the number of CPUs available, including limits of the cgroup (e.g. of a container).
 """
 
+# To keep startup fast, modules that are only needed by some commands are imported
+# in the commands' callbacks. developer_utilities/benchmark_startup.py checks this.
+
 import argparse
+import sys
 from pathlib import Path
 
-from . import config
-from . import source_retrieval
-from . import domain_substitution
 from .common import (
-    CONFIG_BUNDLES_DIR, BUILDSPACE_DOWNLOADS, BUILDSPACE_TREE,
-    BUILDSPACE_TREE_PACKAGING, BUILDSPACE_USER_BUNDLE,
-    BuildkitAbort, get_resources_dir, get_logger)
-from .config import ConfigBundle
+    BUILDSPACE_BUNDLE_CACHE, BUILDSPACE_CHECKPOINTS, BUILDSPACE_DOWNLOADS,
+    BUILDSPACE_DOMSUB_CACHE, BUILDSPACE_DOMAIN_INDEX, BUILDSPACE_TREE,
+    BUILDSPACE_TREE_PACKAGING, BUILDSPACE_USER_BUNDLE, ENCODING, STREAM_THRESHOLD,
+    BuildkitAbort, Executor, get_executor, get_logger, set_default_jobs, start_details_log,
+    stop_details_log)
+
+# Constants
+
+# Dictionary of ('base', name) or ('user', resolved path) to loaded ConfigBundles.
+# This lets the stages of the run command share the same config bundle.
+_LOADED_BUNDLES = dict()
 
 # Classes
 
@@ -46,8 +60,16 @@ class NewBaseBundleAction(argparse.Action): #pylint: disable=too-few-public-meth
             raise ValueError('nargs cannot be greater than 1')
 
     def __call__(self, parser, namespace, values, option_string=None):
+        from .config import ConfigBundle
         try:
-            base_bundle = ConfigBundle.from_base_name(values)
+            base_bundle = _LOADED_BUNDLES.get(('base', values))
+            if base_bundle is None:
+                base_bundle = ConfigBundle.from_base_name(
+                    values, cache_dir=Path(BUILDSPACE_BUNDLE_CACHE))
+                _LOADED_BUNDLES[('base', values)] = base_bundle
+            else:
+                # An earlier command may have modified its files
+                base_bundle.refresh()
         except NotADirectoryError as exc:
             get_logger().error('resources/ or resources/patches directories could not be found.')
             parser.exit(status=1)
@@ -64,6 +86,60 @@ class NewBaseBundleAction(argparse.Action): #pylint: disable=too-few-public-meth
 
 # Methods
 
+def _get_jobs_arg(value):
+    """Returns the number of jobs from a command-line argument, for argparse types"""
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer: {}'.format(value))
+    return jobs
+
+def _get_workers_arg(value):
+    """Returns a number of worker processes that may be zero, for argparse types"""
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = -1
+    if workers < 0:
+        raise argparse.ArgumentTypeError('must be a non-negative integer: {}'.format(value))
+    return workers
+
+def _load_user_bundle(path):
+    """Returns the ConfigBundle of the user bundle at path, for argparse types"""
+    from .config import ConfigBundle
+    bundle_key = ('user', Path(path).resolve())
+    user_bundle = _LOADED_BUNDLES.get(bundle_key)
+    if user_bundle is None:
+        user_bundle = ConfigBundle.from_user_path(
+            Path(path), cache_dir=Path(BUILDSPACE_BUNDLE_CACHE))
+        _LOADED_BUNDLES[bundle_key] = user_bundle
+    else:
+        # An earlier command may have modified its files (e.g. genbun --incremental)
+        user_bundle.refresh()
+    return user_bundle
+
+def _open_checkpoints(args):
+    """
+    Returns the checkpoint.CheckpointStore of the buildspace, or None if checkpoints are
+    disabled or the buildspace directory does not exist.
+    """
+    if not args.checkpoints:
+        return None
+    from .checkpoint import CheckpointStore
+    import sqlite3
+    try:
+        return CheckpointStore(Path(BUILDSPACE_CHECKPOINTS))
+    except sqlite3.OperationalError as exc:
+        get_logger().debug('Not using checkpoints: %s', exc)
+        return None
+
+def _get_stage_name(command, path):
+    """Returns the name of the checkpoint stage of command on path"""
+    import os.path
+    return '{} {}'.format(command, os.path.abspath(str(path)))
+
 def setup_bundle_group(parser):
     """Helper to add arguments for loading a config bundle to argparse.ArgumentParser"""
     config_group = parser.add_mutually_exclusive_group()
@@ -75,7 +151,7 @@ def setup_bundle_group(parser):
               'Default value is nothing; a default is specified by --user-bundle-path.'))
     config_group.add_argument(
         '-u', '--user-bundle', metavar='PATH', dest='bundle', default=BUILDSPACE_USER_BUNDLE,
-        type=lambda x: ConfigBundle(Path(x)),
+        type=_load_user_bundle,
         help=('The path to a user bundle to use. '
               'Mutually exclusive with --base-bundle-name. Default: %(default)s'))
 
@@ -83,11 +159,17 @@ def _add_bunnfo(subparsers):
     """Gets info about base bundles."""
     def _callback(args):
         if vars(args).get('list'):
-            for bundle_dir in sorted(
-                    (get_resources_dir() / CONFIG_BUNDLES_DIR).iterdir()):
-                bundle_meta = config.BaseBundleMetaIni(
-                    bundle_dir / config.BASEBUNDLEMETA_INI)
-                print(bundle_dir.name, '-', bundle_meta.display_name)
+            from .config import BundleCatalog
+            try:
+                catalog = BundleCatalog()
+            except NotADirectoryError as exc:
+                get_logger().error('resources/ directory could not be found: %s', exc)
+                raise _CLIError()
+            except ValueError as exc:
+                get_logger().error('Base bundle metadata has an issue: %s', exc)
+                raise _CLIError()
+            for name in catalog:
+                print(name, '-', catalog.metadata[name].display_name)
         elif vars(args).get('bundle'):
             for dependency in args.bundle.get_dependencies():
                 print(dependency)
@@ -112,7 +194,7 @@ def _add_genbun(subparsers):
     """Generates a user config bundle from a base config bundle."""
     def _callback(args):
         try:
-            args.base_bundle.write(args.user_bundle_path)
+            args.base_bundle.write(args.user_bundle_path, incremental=args.incremental)
         except FileExistsError:
             get_logger().error('User bundle dir is not empty: %s', args.user_bundle_path)
             raise _CLIError()
@@ -126,7 +208,11 @@ def _add_genbun(subparsers):
         '-u', '--user-bundle', metavar='PATH', dest='user_bundle_path',
         type=Path, default=BUILDSPACE_USER_BUNDLE,
         help=('The output path for the user config bundle. '
-              'The path must not already exist. '))
+              'The path must not already exist, unless --incremental is specified. '))
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help=('Update an existing user config bundle instead. Up-to-date patches are not '
+              'copied again, and files that are not part of the base bundle are removed.'))
     parser.add_argument(
         'base_bundle', action=NewBaseBundleAction,
         help='The base config bundle name to use.')
@@ -135,10 +221,31 @@ def _add_genbun(subparsers):
 def _add_getsrc(subparsers):
     """Downloads, checks, and unpacks the necessary files into the buildspace tree"""
     def _callback(args):
+        from . import checkpoint, source_retrieval
+        from .config import EXTRA_DEPS_INI, PRUNING_LIST, VERSION_INI
+        store = _open_checkpoints(args)
         try:
-            source_retrieval.retrieve_and_extract(
-                args.bundle, args.downloads, args.tree, prune_binaries=args.prune_binaries,
-                show_progress=args.show_progress)
+            if store is None:
+                source_retrieval.retrieve_and_extract(
+                    args.bundle, args.downloads, args.tree, prune_binaries=args.prune_binaries,
+                    show_progress=args.show_progress)
+                return
+            stage = _get_stage_name('getsrc', args.tree)
+            inputs = checkpoint.get_fingerprint(
+                args.bundle.fingerprint((VERSION_INI, EXTRA_DEPS_INI, PRUNING_LIST)),
+                args.prune_binaries)
+            if store.is_complete(stage, inputs, checkpoint.get_directory_mark(args.tree)):
+                get_logger().info('Skipping getsrc; the buildspace tree is up to date: %s',
+                                  args.tree)
+                return
+            progress = store.start(stage, inputs, resume=args.tree.exists())
+            try:
+                source_retrieval.retrieve_and_extract(
+                    args.bundle, args.downloads, args.tree, prune_binaries=args.prune_binaries,
+                    show_progress=args.show_progress, progress=progress)
+            finally:
+                progress.flush()
+            store.complete(stage, checkpoint.mark_directory(args.tree))
         except FileExistsError as exc:
             get_logger().error('Directory is not empty: %s', exc)
             raise _CLIError()
@@ -154,6 +261,9 @@ def _add_getsrc(subparsers):
         except source_retrieval.HashMismatchError as exc:
             get_logger().error('Archive checksum is invalid: %s', exc)
             raise _CLIError()
+        finally:
+            if store is not None:
+                store.close()
     parser = subparsers.add_parser(
         'getsrc', help=_add_getsrc.__doc__ + '.',
         description=_add_getsrc.__doc__ + '; ' + (
@@ -161,7 +271,9 @@ def _add_getsrc(subparsers):
             'By default, binary pruning is performed during extraction. '
             'The %s directory must already exist for storing downloads. '
             'If the buildspace tree already exists or there is a checksum mismatch, '
-            'this command will abort. '
+            'this command will abort, unless an earlier run of this command was interrupted; '
+            'then, unpacking resumes where it stopped. If this command already completed '
+            'with the same config bundle, it does nothing. '
             'Only files that are missing will be downloaded. '
             'If the files are already downloaded, their checksums are '
             'confirmed and then they are unpacked.') % BUILDSPACE_DOWNLOADS)
@@ -190,15 +302,37 @@ def _add_prubin(subparsers):
         except FileNotFoundError as exc:
             logger.error('File or directory does not exist: %s', exc)
             raise _CLIError()
-        missing_file = False
-        for tree_node in args.bundle.pruning:
-            try:
-                (resolved_tree / tree_node).unlink()
-            except FileNotFoundError:
-                missing_file = True
-                logger.warning('No such file: %s', resolved_tree / tree_node)
-        if missing_file:
-            raise _CLIError()
+        store = _open_checkpoints(args)
+        try:
+            if store is not None:
+                from . import checkpoint
+                from .config import PRUNING_LIST
+                stage = _get_stage_name('prubin', args.tree)
+                inputs = checkpoint.get_fingerprint(
+                    args.bundle.fingerprint((PRUNING_LIST,)),
+                    store.get_token(_get_stage_name('getsrc', args.tree)),
+                    checkpoint.get_directory_mark(args.tree))
+                if store.is_complete(stage, inputs):
+                    logger.info('Skipping prubin; binaries are already pruned: %s', args.tree)
+                    return
+                store.start(stage, inputs, resume=False)
+            from . import file_removal, metrics
+            result = file_removal.prune_files(
+                resolved_tree, args.bundle.pruning.expand(resolved_tree),
+                remove_empty_dirs=args.remove_empty_dirs)
+            metrics.counter(
+                'buildkit_pruned_files_total', 'Files pruned', stage='prubin').add(result.deleted)
+            if args.remove_empty_dirs:
+                logger.info('Pruned %s files and %s empty directories', result.deleted,
+                            result.removed_dirs)
+            if result.missing:
+                logger.error('%s files to prune were not found', len(result.missing))
+                raise _CLIError()
+            if store is not None:
+                store.complete(stage)
+        finally:
+            if store is not None:
+                store.close()
     parser = subparsers.add_parser(
         'prubin', help=_add_prubin.__doc__, description=_add_prubin.__doc__ + (
             ' This is NOT necessary if the source code was already pruned '
@@ -207,22 +341,168 @@ def _add_prubin(subparsers):
     parser.add_argument(
         '-t', '--tree', type=Path, default=BUILDSPACE_TREE,
         help='The buildspace tree path to apply binary pruning. Default: %(default)s')
+    parser.add_argument(
+        '--remove-empty-dirs', action='store_true',
+        help='Also removes the directories that are empty after pruning.')
     parser.set_defaults(callback=_callback)
 
+def _add_clean(subparsers):
+    """Deletes the buildspace tree quickly."""
+    def _callback(args):
+        from . import file_removal
+        logger = get_logger()
+        trash_paths = file_removal.get_moved_aside(args.tree)
+        if trash_paths:
+            logger.info('Also deleting %s trees left by earlier clean commands',
+                        len(trash_paths))
+        if not args.trash_only:
+            try:
+                trash_path = file_removal.move_aside(args.tree)
+            except FileNotFoundError:
+                logger.info('Buildspace tree does not exist: %s', args.tree)
+            except NotADirectoryError as exc:
+                logger.error('Path is not a directory: %s', exc)
+                raise _CLIError()
+            else:
+                logger.info('Moved the buildspace tree aside to %s', trash_path)
+                trash_paths.append(trash_path)
+            store = _open_checkpoints(args)
+            if store is not None:
+                for command in ('getsrc', 'prubin', 'subdom'):
+                    store.clear(_get_stage_name(command, args.tree))
+                store.close()
+        if not trash_paths:
+            return
+        if args.detach:
+            import os
+            import subprocess
+            import sys
+            environment = dict(os.environ)
+            environment['PYTHONPATH'] = os.pathsep.join(filter(None, (
+                str(Path(__file__).resolve().parent.parent), environment.get('PYTHONPATH'))))
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'buildkit', 'clean', '--trash-only', '-t', str(args.tree)],
+                env=environment, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, start_new_session=True)
+            logger.info('Deleting in the background with process %s', process.pid)
+            return
+        for trash_path in trash_paths:
+            file_removal.delete_tree_in_background(trash_path, get_executor().jobs)
+    parser = subparsers.add_parser(
+        'clean', help=_add_clean.__doc__, description=_add_clean.__doc__ + (
+            ' The tree is renamed aside atomically, so that getsrc can create a new tree '
+            'right away, e.g. in "run clean getsrc". The old tree is deleted in parallel in '
+            'the background, and the command exits once it is deleted. Trees left by '
+            'interrupted clean commands are deleted as well.'))
+    parser.add_argument(
+        '-t', '--tree', type=Path, default=BUILDSPACE_TREE,
+        help='The buildspace tree path to delete. Default: %(default)s')
+    parser.add_argument(
+        '--detach', action='store_true',
+        help=('Deletes the old tree in a detached process and exits right away. '
+              'Progress is not reported.'))
+    parser.add_argument(
+        '--trash-only', action='store_true',
+        help='Only deletes the trees left by earlier clean commands.')
+    parser.set_defaults(callback=_callback)
+
+def _substitute_tree(args, profile, progress=None):
+    """Substitutes domains in the buildspace tree, sharded if requested, for the subdom command"""
+    from . import domain_substitution
+    if args.shard_dir is None and args.shard_workers is None:
+        domain_substitution.process_tree_with_bundle(
+            args.bundle, args.tree, cache_dir=args.cache,
+            stream_threshold=args.stream_threshold, profile=profile, progress=progress)
+    else:
+        domain_substitution.process_tree_sharded(
+            args.bundle, args.tree, job_dir=args.shard_dir, local_workers=args.shard_workers,
+            stream_threshold=args.stream_threshold, progress=progress)
+
+def _subdom_tree(args, store, profile):
+    """Substitutes domains in the buildspace tree for the subdom command"""
+    if store is None:
+        _substitute_tree(args, profile)
+        return
+    from . import checkpoint
+    from .config import DOMAIN_REGEX_LIST, DOMAIN_SUBSTITUTION_LIST
+    if not args.tree.exists():
+        raise FileNotFoundError(args.tree)
+    resolved_tree = args.tree.resolve()
+    stage = _get_stage_name('subdom', args.tree)
+    inputs = checkpoint.get_fingerprint(
+        args.bundle.fingerprint((DOMAIN_REGEX_LIST, DOMAIN_SUBSTITUTION_LIST)),
+        store.get_token(_get_stage_name('getsrc', args.tree)),
+        args.cache and str(args.cache.resolve()))
+    file_list = args.bundle.domain_substitution.expand(resolved_tree)
+    if store.is_complete(stage, inputs, checkpoint.get_tree_manifest(resolved_tree, file_list)):
+        get_logger().info('Skipping domain substitution of the unchanged buildspace tree: %s',
+                          args.tree)
+        return
+    progress = store.start(stage, inputs)
+    if progress.resumed and args.cache is None:
+        get_logger().info('Resuming domain substitution after %s files', len(progress))
+    try:
+        _substitute_tree(args, profile, progress)
+    finally:
+        progress.flush()
+    store.complete(stage, checkpoint.get_tree_manifest(resolved_tree, file_list))
+
+def _subdom_patches(args, store, profile):
+    """Substitutes domains in the config bundle's patches for the subdom command"""
+    from . import domain_substitution
+    if store is None or args.bundle.patches.path is None:
+        domain_substitution.process_bundle_patches(args.bundle, profile=profile)
+        return
+    from .config import DOMAIN_REGEX_LIST, DOMAIN_SUBSTITUTION_LIST, PATCH_ORDER_LIST
+    stage = _get_stage_name('subdom', args.bundle.patches.path)
+    inputs = args.bundle.fingerprint((DOMAIN_REGEX_LIST, DOMAIN_SUBSTITUTION_LIST))
+    if store.is_complete(stage, inputs, args.bundle.fingerprint((PATCH_ORDER_LIST,))):
+        get_logger().info('Skipping domain substitution of the unchanged patches')
+        return
+    store.start(stage, inputs, resume=False)
+    domain_substitution.process_bundle_patches(args.bundle, profile=profile)
+    store.complete(stage, args.bundle.fingerprint((PATCH_ORDER_LIST,)))
+
 def _add_subdom(subparsers):
     """Substitutes domain names in buildspace tree or patches with blockable strings."""
     def _callback(args):
+        from . import domain_substitution
+        profile = None
+        if args.profile:
+            profile = domain_substitution.SubstitutionProfile()
+        if ((args.shard_dir is not None or args.shard_workers is not None)
+                and (args.cache is not None or args.profile)):
+            get_logger().error('Sharded substitution requires --no-cache and cannot be profiled')
+            raise _CLIError()
+        if args.revert and args.cache is None:
+            get_logger().error('--revert requires the domain substitution cache')
+            raise _CLIError()
+        store = _open_checkpoints(args)
         try:
+            if args.revert:
+                domain_substitution.revert_substitution(args.tree.resolve(), args.cache)
+                if store is not None:
+                    store.clear(_get_stage_name('subdom', args.tree))
+                return
             if not args.only or args.only == 'tree':
-                domain_substitution.process_tree_with_bundle(args.bundle, args.tree)
+                _subdom_tree(args, store, profile)
             if not args.only or args.only == 'patches':
-                domain_substitution.process_bundle_patches(args.bundle)
+                _subdom_patches(args, store, profile)
+            if profile:
+                get_logger().info('Domain substitution profile:\n%s', profile.report())
+                profile.write_json(args.profile)
         except FileNotFoundError as exc:
             get_logger().error('File or directory does not exist: %s', exc)
             raise _CLIError()
         except NotADirectoryError as exc:
             get_logger().error('Patches directory does not exist: %s', exc)
             raise _CLIError()
+        except FileExistsError as exc:
+            get_logger().error('Shard directory is not empty: %s', exc)
+            raise _CLIError()
+        finally:
+            if store is not None:
+                store.close()
     parser = subparsers.add_parser(
         'subdom', help=_add_subdom.__doc__, description=_add_subdom.__doc__ + (
             ' By default, it will substitute the domains on both the buildspace tree and '
@@ -236,8 +516,141 @@ def _add_subdom(subparsers):
         '-t', '--tree', type=Path, default=BUILDSPACE_TREE,
         help=('The buildspace tree path to apply domain substitution. '
               'Not applicable when --only is "patches". Default: %(default)s'))
+    parser.add_argument(
+        '-c', '--cache', type=Path, default=BUILDSPACE_DOMSUB_CACHE,
+        help=('The directory to store the original contents of substituted files. '
+              'When domain substitution is applied again, only files whose contents, '
+              'list membership, or domain regexes changed are processed. '
+              'Default: %(default)s'))
+    parser.add_argument(
+        '--no-cache', action='store_const', const=None, dest='cache',
+        help='Substitute the buildspace tree without using or updating the cache.')
+    parser.add_argument(
+        '--stream-threshold', metavar='BYTES', type=int,
+        default=STREAM_THRESHOLD,
+        help=('Files larger than this size are substituted in chunks to limit memory usage. '
+              'The result is identical to substituting the whole file. Default: %(default)s'))
+    parser.add_argument(
+        '--profile', metavar='PATH', type=Path,
+        help=('Records the time, bytes scanned and matches of every domain regex, '
+              'and the time of every file. A report is logged and the full data is written '
+              'to PATH as JSON.'))
+    parser.add_argument(
+        '--revert', action='store_true',
+        help=('Restores the original contents of the buildspace tree from the cache, '
+              'then deletes the cache. Patches are not reverted.'))
+    parser.add_argument(
+        '--shard-dir', metavar='PATH', type=Path,
+        help=('Substitutes the buildspace tree as a sharded job published in PATH, which '
+              'must be empty. Workers on other hosts can join with the shard-worker command '
+              'if PATH and the buildspace tree are shared at the same paths. '
+              'Requires --no-cache.'))
+    parser.add_argument(
+        '--shard-workers', metavar='COUNT', type=_get_workers_arg,
+        help=('Substitutes the buildspace tree as a sharded job with COUNT worker processes '
+              'on this host. With 0, only workers started by shard-worker process the job. '
+              'Without --shard-dir, the job is published in a temporary directory. '
+              'Default: the number of jobs. Requires --no-cache.'))
+    parser.set_defaults(callback=_callback)
+
+def _add_shard_worker(subparsers):
+    """Processes shards of a sharded job, e.g. of subdom --shard-dir."""
+    def _callback(args):
+        from . import domain_substitution, sharding
+        try:
+            processed = sharding.run_worker(args.job_dir, domain_substitution.SHARD_TASKS)
+        except KeyError as exc:
+            get_logger().error('Unknown task of the job: %s', exc)
+            raise _CLIError()
+        get_logger().info('Processed %s shards', processed)
+    parser = subparsers.add_parser(
+        'shard-worker', help=_add_shard_worker.__doc__, description=_add_shard_worker.__doc__ + (
+            ' It waits for the job to be published, and exits when the job is finished.'))
+    parser.add_argument('job_dir', metavar='PATH', type=Path,
+                        help='The directory of the job, as given to --shard-dir.')
     parser.set_defaults(callback=_callback)
 
+def _add_index(subparsers):
+    """Builds and queries an index of domain names in the buildspace tree."""
+    def _update_callback(args):
+        from .domain_index import DomainIndex
+        try:
+            with DomainIndex(args.index) as domain_index:
+                if args.index_jobs:
+                    with Executor(args.index_jobs) as executor:
+                        scanned, removed = domain_index.update(args.tree, executor=executor)
+                else:
+                    scanned, removed = domain_index.update(args.tree)
+        except FileNotFoundError as exc:
+            get_logger().error('File or directory does not exist: %s', exc)
+            raise _CLIError()
+        get_logger().info('Index updated: %s files scanned, %s removed', scanned, removed)
+    def _query_callback(args):
+        import re
+        from .domain_index import DomainIndex
+        try:
+            regex = re.compile(args.regex)
+        except re.error as exc:
+            get_logger().error('Invalid regex: %s', exc)
+            raise _CLIError()
+        with DomainIndex(args.index) as domain_index:
+            if args.offsets:
+                for path, token, count, offsets in domain_index.query(regex):
+                    print(path, token, count, ','.join(map(str, offsets)))
+            else:
+                for path, count in sorted(domain_index.files_matching(regex).items()):
+                    print(path, count)
+    def _unlisted_callback(args):
+        from .domain_index import DomainIndex, unlisted_files
+        with DomainIndex(args.index) as domain_index:
+            for path, count in sorted(unlisted_files(domain_index, args.bundle).items()):
+                print(path, count)
+    def _summary_callback(args):
+        from .domain_index import DomainIndex, pattern_summary
+        with DomainIndex(args.index) as domain_index:
+            for pattern, file_count, occurrences in pattern_summary(domain_index, args.bundle):
+                print(pattern, file_count, occurrences)
+    parser = subparsers.add_parser(
+        'index', help=_add_index.__doc__, description=_add_index.__doc__ + (
+            ' The index maps domain-like tokens to the files and byte offsets they occur at, '
+            'so that the effect of domain regexes can be checked without reading the tree.'))
+    parser.add_argument(
+        '-i', '--index', type=Path, default=BUILDSPACE_DOMAIN_INDEX,
+        help='The path to the index database. Default: %(default)s')
+    subsubparsers = parser.add_subparsers(title='Index commands', dest='index_command')
+    subsubparsers.required = True # Workaround for http://bugs.python.org/issue9253#msg186387
+
+    update_parser = subsubparsers.add_parser(
+        'update', help='Scans new and modified files of the buildspace tree into the index.')
+    update_parser.add_argument(
+        '-t', '--tree', type=Path, default=BUILDSPACE_TREE,
+        help='The buildspace tree path to index. Default: %(default)s')
+    update_parser.add_argument(
+        '-j', '--jobs', dest='index_jobs', type=_get_jobs_arg,
+        help='Number of worker processes. Overrides the global --jobs option.')
+    update_parser.set_defaults(callback=_update_callback)
+
+    query_parser = subsubparsers.add_parser(
+        'query', help=('Prints the files and occurrence counts of indexed domains matching '
+                       'a regex, such as a prospective domain_regex.list pattern.'))
+    query_parser.add_argument('regex', help='The Python regex to match domains with.')
+    query_parser.add_argument(
+        '--offsets', action='store_true',
+        help='Print every matching domain with its byte offsets in each file.')
+    query_parser.set_defaults(callback=_query_callback)
+
+    unlisted_parser = subsubparsers.add_parser(
+        'unlisted', help=('Prints files containing domains matched by the bundle\'s domain '
+                          'regexes that are not in its domain substitution list.'))
+    setup_bundle_group(unlisted_parser)
+    unlisted_parser.set_defaults(callback=_unlisted_callback)
+
+    summary_parser = subsubparsers.add_parser(
+        'summary', help=('Prints the number of files and occurrences matched by each of '
+                         'the bundle\'s domain regexes.'))
+    setup_bundle_group(summary_parser)
+    summary_parser.set_defaults(callback=_summary_callback)
+
 def _add_genpkg_archlinux(subparsers):
     """Generate Arch Linux packaging files"""
     def _callback(args):
@@ -385,10 +798,162 @@ def _add_genpkg(subparsers):
     _add_genpkg_windows(subsubparsers)
     _add_genpkg_macos(subsubparsers)
 
-def main(arg_list=None):
-    """CLI entry point"""
+def _read_pipeline(pipeline_path):
+    """
+    Returns a list of the commands in the pipeline file at pipeline_path, as lists of arguments
+
+    Raises ValueError if a command cannot be split into arguments.
+    """
+    import shlex
+    commands = list()
+    with pipeline_path.open(encoding=ENCODING) as pipeline_file:
+        for line in pipeline_file:
+            command = shlex.split(line, comments=True)
+            if command:
+                commands.append(command)
+    return commands
+
+def _add_run(subparsers):
+    """Runs a sequence of commands in a single process."""
+    def _callback(args):
+        import shlex
+        import time
+        try:
+            if args.pipeline:
+                commands = _read_pipeline(args.pipeline)
+            else:
+                commands = [shlex.split(x) for x in args.commands]
+        except FileNotFoundError as exc:
+            get_logger().error('Pipeline file does not exist: %s', exc)
+            raise _CLIError()
+        except ValueError as exc:
+            get_logger().error('Unable to parse command: %s', exc)
+            raise _CLIError()
+        if not commands:
+            get_logger().error('No commands to run')
+            raise _CLIError()
+        if any(x[0] == 'run' for x in commands):
+            get_logger().error('The run command cannot be nested')
+            raise _CLIError()
+        stage_parser = _get_parser()
+        stage_times = list()
+        try:
+            for command in commands:
+                get_logger().info('Running: %s', ' '.join(command))
+                start_time = time.perf_counter()
+                # Commands are parsed right before they run, since they may use
+                # files created by earlier commands (e.g. a user bundle from genbun)
+                try:
+                    stage_args = stage_parser.parse_args(args=command)
+                except SystemExit as exc:
+                    if exc.code:
+                        raise _CLIError()
+                    continue # Help was printed
+                if (stage_args.trace or stage_args.metrics or stage_args.log_details
+                        or stage_args.memprofile):
+                    get_logger().error('--trace, --metrics, --memprofile, and --log-details '
+                                       'must be passed to the run command instead')
+                    raise _CLIError()
+                if not args.checkpoints:
+                    stage_args.checkpoints = False
+                if stage_args.jobs:
+                    # The jobs of a command only apply to it; later commands use the
+                    # jobs of the run command again
+                    previous_jobs = get_executor().jobs
+                    set_default_jobs(stage_args.jobs)
+                    try:
+                        _run_callback(stage_args, ' '.join(command))
+                    finally:
+                        set_default_jobs(previous_jobs)
+                else:
+                    _run_callback(stage_args, ' '.join(command))
+                stage_times.append((' '.join(command), time.perf_counter() - start_time))
+        finally:
+            if stage_times:
+                get_logger().info('Command times:\n%s', '\n'.join(
+                    '{:>9.2f}s  {}'.format(seconds, command)
+                    for command, seconds in stage_times))
+    parser = subparsers.add_parser(
+        'run', help=_add_run.__doc__, description=_add_run.__doc__ + (
+            ' Config bundles are resolved once and shared by every command that uses them, '
+            'along with their compiled domain regexes and the pools of parallel jobs. '
+            'The time of each command is reported at the end. '
+            'Running stops at the first command that fails.'))
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        'commands', metavar='COMMAND', nargs='*', default=list(),
+        help=('A buildkit command with its arguments as one quoted string, '
+              'e.g. "getsrc -b linux_portable"'))
+    group.add_argument(
+        '-p', '--pipeline', metavar='PATH', type=Path,
+        help=('A file of commands to run instead, one per line. '
+              'Empty lines and comments starting with # are ignored.'))
+    parser.set_defaults(callback=_callback)
+
+def _run_callback(args, name):
+    """
+    Runs the callback of the command in args, and records its duration in a trace span named
+    name and in the metrics, if they are enabled
+    """
+    import contextlib
+    import time
+    # main() imports these modules when they are enabled; they are not imported otherwise
+    # to keep the startup fast
+    tracing = sys.modules.get(__package__ + '.tracing')
+    memory_profile = sys.modules.get(__package__ + '.memory_profile')
+    metrics = sys.modules.get(__package__ + '.metrics')
+    start_time = time.perf_counter()
+    try:
+        with contextlib.ExitStack() as stack:
+            if tracing is not None:
+                stack.enter_context(tracing.span(name, 'command'))
+            if memory_profile is not None:
+                stack.enter_context(memory_profile.stage(name))
+            args.callback(args=args)
+    finally:
+        if metrics is not None:
+            metrics.histogram(
+                'buildkit_stage_duration_seconds', 'Duration of commands in seconds',
+                stage=args.command).observe(time.perf_counter() - start_time)
+
+def _get_parser():
+    """Returns the argparse.ArgumentParser for all commands"""
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        '--no-checkpoints', action='store_false', dest='checkpoints',
+        help=('Do not use or update the record of completed stages in\n%s.\n'
+              'Otherwise, getsrc, prubin, and subdom are skipped if they already completed\n'
+              'with the same inputs, and resume where they stopped if interrupted.')
+        % BUILDSPACE_CHECKPOINTS)
+    parser.add_argument(
+        '--log-details', metavar='FILE', type=Path,
+        help=('Writes every warning about individual files to FILE. Otherwise, only the\n'
+              'first few warnings of each kind are logged, followed by a count of the rest.'))
+    parser.add_argument(
+        '--trace', metavar='FILE', type=Path,
+        help=('Writes a trace of the time spent in every stage to FILE, in the\n'
+              'Chrome trace event format (for chrome://tracing or ui.perfetto.dev).'))
+    parser.add_argument(
+        '--trace-files', metavar='BYTES', type=int,
+        help='With --trace, also records every file processed of at least BYTES.')
+    parser.add_argument(
+        '--metrics', metavar='FILE', type=Path,
+        help=('Writes counters of the work done (e.g. bytes and files processed) and\n'
+              'the durations of commands to FILE at exit, as JSON if FILE ends with\n'
+              '.json, or in the Prometheus text format otherwise.'))
+    parser.add_argument(
+        '--metrics-interval', metavar='SECONDS', type=float,
+        help='With --metrics, also writes FILE every SECONDS while running.')
+    parser.add_argument(
+        '--memprofile', metavar='FILE', type=Path,
+        help=('Profiles the memory usage of every stage with tracemalloc and getrusage.\n'
+              'A report with the peak memory and the top allocation sites of every\n'
+              'stage is logged, and written to FILE as JSON. This is much slower.'))
+    parser.add_argument(
+        '-j', '--jobs', type=_get_jobs_arg,
+        help=('The maximum number of parallel jobs of every command.\n'
+              'Default: BUILDKIT_JOBS or the number of CPUs available'))
 
     subparsers = parser.add_subparsers(title='Available commands', dest='command')
     subparsers.required = True # Workaround for http://bugs.python.org/issue9253#msg186387
@@ -396,14 +961,53 @@ def main(arg_list=None):
     _add_genbun(subparsers)
     _add_getsrc(subparsers)
     _add_prubin(subparsers)
+    _add_clean(subparsers)
     _add_subdom(subparsers)
+    _add_shard_worker(subparsers)
+    _add_index(subparsers)
     _add_genpkg(subparsers)
+    _add_run(subparsers)
+    return parser
 
+def main(arg_list=None):
+    """CLI entry point"""
+    parser = _get_parser()
     args = parser.parse_args(args=arg_list)
+    if args.jobs:
+        set_default_jobs(args.jobs)
+    if args.log_details:
+        start_details_log(args.log_details)
+    if args.trace:
+        from . import tracing
+        tracing.enable(file_threshold=args.trace_files)
+    if args.memprofile:
+        from . import memory_profile
+        memory_profile.enable()
+    metrics_writer = None
+    if args.metrics:
+        from .metrics import PeriodicWriter
+        metrics_writer = PeriodicWriter(args.metrics, args.metrics_interval)
+        metrics_writer.start()
     try:
-        args.callback(args=args)
+        _run_callback(args, args.command)
+        # Only commands that delete trees in the background import file_removal
+        if 'buildkit.file_removal' in sys.modules:
+            from .file_removal import wait_for_deletions
+            if not wait_for_deletions():
+                raise _CLIError()
     except (_CLIError, BuildkitAbort):
         parser.exit(status=1)
     except BaseException:
         get_logger().exception('Unexpected exception caught.')
         parser.exit(status=1)
+    finally:
+        if args.trace:
+            tracing.write(args.trace)
+            get_logger().info('Trace written to %s', args.trace)
+        if metrics_writer is not None:
+            metrics_writer.stop()
+        if args.memprofile:
+            get_logger().info('Memory profile:\n%s', memory_profile.report())
+            memory_profile.write_json(args.memprofile)
+            memory_profile.disable()
+        stop_details_log()
@@ -8,6 +8,7 @@
 
 import os
 import logging
+import math
 from pathlib import Path
 
 # Constants
@@ -18,13 +19,30 @@ CONFIG_BUNDLES_DIR = "config_bundles"
 PACKAGING_DIR = "packaging"
 PATCHES_DIR = "patches"
 
+BUILDSPACE_BUNDLE_CACHE = 'buildspace/bundle_cache'
+BUILDSPACE_CHECKPOINTS = 'buildspace/checkpoints.sqlite'
 BUILDSPACE_DOWNLOADS = 'buildspace/downloads'
+BUILDSPACE_DOMSUB_CACHE = 'buildspace/domain_substitution_cache'
+BUILDSPACE_DOMAIN_INDEX = 'buildspace/domain_index.sqlite'
 BUILDSPACE_TREE = 'buildspace/tree'
 BUILDSPACE_TREE_PACKAGING = 'buildspace/tree/ungoogled_packaging'
 BUILDSPACE_USER_BUNDLE = 'buildspace/user_bundle'
 
+# Files larger than this many bytes are substituted in chunks instead of all at once
+STREAM_THRESHOLD = 8 * 1024 * 1024
+
 _ENV_FORMAT = "BUILDKIT_{}"
 
+# Number of warnings of each kind from FileWarnings that are logged to the console
+_WARNING_SAMPLES = 5
+
+# Name of the logger for the full details of FileWarnings
+_DETAILS_LOGGER = __package__ + '.details'
+
+# Files with the CPU quota and period of the cgroup, for cgroup v2 and v1
+_CGROUP_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+_CGROUP_V1_CPU_DIRS = ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct')
+
 # Public classes
 
 class BuildkitError(Exception):
@@ -37,6 +55,145 @@ class BuildkitAbort(BuildkitError):
     It should only be caught by the user of buildkit's library interface.
     """
 
+class Executor:
+    """
+    Runs tasks in parallel, with a limit on the number of jobs shared by every stage.
+
+    CPU-bound tasks run in a pool of processes, and I/O-bound tasks run in a pool of threads.
+    Each pool is created on first use and has as many workers as the number of jobs.
+    With one job, tasks run serially in the calling thread instead.
+    """
+
+    def __init__(self, jobs=None):
+        """
+        jobs is the same as in get_jobs()
+
+        Raises ValueError if jobs is not a positive integer.
+        Raises BuildkitAbort if BUILDKIT_JOBS is invalid.
+        """
+        self.jobs = get_jobs(jobs)
+        self._process_pool = None
+        self._thread_pool = None
+
+    def _get_pool(self, cpu_bound):
+        """Returns the pool for CPU-bound or I/O-bound tasks, creating it if necessary"""
+        import concurrent.futures
+        if cpu_bound:
+            if self._process_pool is None:
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.jobs)
+            return self._process_pool
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        return self._thread_pool
+
+    def map(self, function, *iterables, cpu_bound=True, chunksize=1):
+        """
+        Returns an iterator of the results of function applied to every item of iterables,
+        like the builtin map(). Results are in the same order as the items.
+
+        function and its arguments must be picklable if cpu_bound is True.
+        cpu_bound indicates if tasks run in processes instead of threads.
+        chunksize is the number of tasks sent to a worker process at once.
+
+        If a task raises an exception, it is logged and BuildkitAbort is raised when its
+        result is reached.
+        """
+        if self.jobs == 1:
+            results = map(function, *iterables)
+        elif cpu_bound:
+            from . import metrics, tracing
+            traced_task = tracing.wrap_task(function)
+            task = metrics.wrap_task(traced_task)
+            results = tracing.unwrap_results(traced_task, metrics.unwrap_results(
+                self._get_pool(cpu_bound).map(task, *iterables, chunksize=chunksize)))
+        else:
+            results = self._get_pool(cpu_bound).map(function, *iterables)
+        return self._check_results(results)
+
+    @staticmethod
+    def _check_results(results):
+        """Yields results, and converts exceptions raised by tasks into BuildkitAbort"""
+        try:
+            yield from results
+        except BuildkitAbort:
+            raise
+        except Exception: #pylint: disable=broad-except
+            get_logger().exception('A parallel task failed')
+            raise BuildkitAbort()
+
+    def shutdown(self):
+        """Waits for running tasks and shuts down the pools. The pools are created again if used."""
+        for pool in (self._process_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown()
+        self._process_pool = None
+        self._thread_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+class FileWarnings:
+    """
+    Aggregates repetitive warnings about individual files, e.g. missing files.
+
+    Only the first few warnings with the same message are logged to the console; the rest
+    are counted and summarized by flush(). Every warning is written to the details log if
+    it was started with start_details_log().
+
+    It can be used as a context manager that calls flush() when it exits.
+    """
+
+    def __init__(self, samples=_WARNING_SAMPLES):
+        """samples is the number of warnings with the same message to log to the console"""
+        self.samples = samples
+        # Dictionary of messages to the number of warnings
+        self.counts = dict()
+
+    def warn(self, message, path):
+        """
+        Records a warning about path. message is a logging format string that takes path
+        as its only argument, e.g. 'No such file: %s'
+        """
+        count = self.counts.get(message, 0) + 1
+        self.counts[message] = count
+        if count <= self.samples:
+            get_logger().warning(message, path)
+        if _details_listener is not None:
+            logging.getLogger(_DETAILS_LOGGER).warning(message, path)
+
+    @property
+    def total(self):
+        """The number of warnings recorded since the last flush()"""
+        return sum(self.counts.values())
+
+    def flush(self):
+        """Logs a summary of the warnings that were not logged, and resets the counts"""
+        for message, count in self.counts.items():
+            if count > self.samples:
+                if _details_listener is None:
+                    summary = '{:,d} more'.format(count - self.samples)
+                else:
+                    summary = '{:,d} more (all are in {})'.format(
+                        count - self.samples, _details_listener.handlers[0].baseFilename)
+                get_logger().warning(message, summary)
+        self.counts.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+# The executor returned by get_executor()
+_default_executor = None
+
+# The logging.handlers.QueueListener of the details log, or None
+_details_listener = None
+
 # Public methods
 
 def get_logger(name=__package__, initial_level=logging.DEBUG):
@@ -61,6 +218,38 @@ def get_logger(name=__package__, initial_level=logging.DEBUG):
                 logger.debug("Initialized logger '%s'", name)
     return logger
 
+def start_details_log(path):
+    """
+    Starts writing the full details of FileWarnings to the file at path. Records are written
+    by a background thread, so they do not slow down the callers.
+    """
+    import logging.handlers
+    import queue
+    global _details_listener #pylint: disable=global-statement
+    stop_details_log()
+    log_queue = queue.Queue()
+    file_handler = logging.FileHandler(str(path), mode='w', encoding=ENCODING)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s: %(message)s"))
+    details_logger = logging.getLogger(_DETAILS_LOGGER)
+    details_logger.setLevel(logging.DEBUG)
+    details_logger.propagate = False # Keep the details out of the console
+    details_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _details_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _details_listener.start()
+
+def stop_details_log():
+    """Writes the remaining records of the details log and closes it, if it was started"""
+    global _details_listener #pylint: disable=global-statement
+    if _details_listener is None:
+        return
+    _details_listener.stop()
+    for handler in _details_listener.handlers:
+        handler.close()
+    details_logger = logging.getLogger(_DETAILS_LOGGER)
+    for handler in list(details_logger.handlers):
+        details_logger.removeHandler(handler)
+    _details_listener = None
+
 def get_resources_dir():
     """
     Returns the path to the root of the resources directory
@@ -79,6 +268,103 @@ def get_resources_dir():
         raise NotADirectoryError(str(path))
     return path
 
+def bundle_cache_enabled():
+    """
+    Returns True if the resolved config bundle cache may be used; False if it is disabled
+    by the BUILDKIT_NO_BUNDLE_CACHE environment variable.
+    """
+    return not os.environ.get(_ENV_FORMAT.format('NO_BUNDLE_CACHE'))
+
+def _get_cgroup_cpu_limit():
+    """
+    Returns the number of CPUs the cgroup of this process is limited to as a float,
+    or None if there is no limit.
+    """
+    try:
+        with open(_CGROUP_CPU_MAX) as cpu_max_file:
+            quota, period = cpu_max_file.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    for cpu_dir in _CGROUP_V1_CPU_DIRS:
+        try:
+            with open(os.path.join(cpu_dir, 'cpu.cfs_quota_us')) as quota_file:
+                quota = int(quota_file.read())
+            with open(os.path.join(cpu_dir, 'cpu.cfs_period_us')) as period_file:
+                period = int(period_file.read())
+        except (OSError, ValueError):
+            continue
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+    return None
+
+def get_cpu_count():
+    """
+    Returns the number of CPUs available to this process. The CPU affinity and the CPU quota
+    of the cgroup (e.g. of a container) are taken into account.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+    cgroup_limit = _get_cgroup_cpu_limit()
+    if cgroup_limit:
+        cpu_count = min(cpu_count, max(1, math.ceil(cgroup_limit)))
+    return cpu_count
+
+def get_jobs(jobs=None):
+    """
+    Returns the number of parallel jobs to run.
+
+    jobs is the number of jobs requested, or None to use the value of the BUILDKIT_JOBS
+    environment variable. If it is not set, the number of CPUs from get_cpu_count() is used.
+
+    Raises ValueError if jobs is not a positive integer.
+    Raises BuildkitAbort if BUILDKIT_JOBS is not a positive integer.
+    """
+    if jobs is not None:
+        if jobs < 1:
+            raise ValueError('Number of jobs must be positive: {}'.format(jobs))
+        return jobs
+    env_value = os.environ.get(_ENV_FORMAT.format('JOBS'))
+    if env_value:
+        try:
+            jobs = int(env_value)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            get_logger().error(
+                '%s must be a positive integer: %s', _ENV_FORMAT.format('JOBS'), env_value)
+            raise BuildkitAbort()
+        return jobs
+    return get_cpu_count()
+
+def get_executor():
+    """
+    Returns the Executor shared by all stages of buildkit in this process.
+    It uses the number of jobs set by set_default_jobs(), or get_jobs() otherwise.
+    """
+    global _default_executor #pylint: disable=global-statement
+    if _default_executor is None:
+        _default_executor = Executor()
+    return _default_executor
+
+def set_default_jobs(jobs):
+    """
+    Sets the number of jobs of the Executor returned by get_executor().
+    If the shared Executor already exists, it is shut down and replaced.
+
+    Raises ValueError if jobs is not a positive integer.
+    """
+    global _default_executor #pylint: disable=global-statement
+    new_executor = Executor(jobs)
+    if _default_executor is not None:
+        _default_executor.shutdown()
+    _default_executor = new_executor
+
 def dir_empty(path):
     """
     Returns True if the directory is empty; False otherwise
@@ -11,15 +11,19 @@ Build configuration generation implementation
 import abc
 import configparser
 import collections
+import hashlib
 import itertools
+import json
+import os
+import pickle
 import re
-import shutil
 
 from pathlib import Path
 
 from .common import (
     ENCODING, CONFIG_BUNDLES_DIR, BuildkitAbort,
-    get_logger, get_resources_dir, ensure_empty_dir)
+    bundle_cache_enabled, get_logger, get_resources_dir)
+from .file_materialization import DirectoryExport, materialize_file
 from .third_party import schema
 
 # Constants
@@ -34,6 +38,8 @@ PATCH_ORDER_LIST = "patch_order.list"
 PATCHES_DIR = "patches"
 VERSION_INI = "version.ini"
 
+_BUNDLE_CACHE_VERSION = 3
+
 # Helpers for third_party.schema
 
 def schema_dictcast(data):
@@ -44,11 +50,199 @@ def schema_inisections(data):
     """Cast configparser data structure to dict and remove DEFAULT section"""
     return schema_dictcast({configparser.DEFAULTSECT: object, **data})
 
+# Returned by compiled validators for invalid data
+_INVALID = object()
+
+def _compile_interpreted(schema_obj, ignore_extra_keys):
+    """Returns a validator that runs the interpreted schema, for unsupported schema types"""
+    wrapped_schema = schema.Schema(schema_obj, ignore_extra_keys=ignore_extra_keys)
+
+    def _validate(data):
+        try:
+            return wrapped_schema.validate(data)
+        except schema.SchemaError:
+            return _INVALID
+    return _validate
+
+def _compile_dict(schema_dict, ignore_extra_keys):
+    """Returns a validator for a dictionary schema"""
+    sorted_keys = sorted(schema_dict, key=schema.Schema._dict_key_priority) #pylint: disable=protected-access
+    if any(isinstance(x, schema.Forbidden) or hasattr(x, 'default') for x in sorted_keys):
+        return _compile_interpreted(schema_dict, ignore_extra_keys)
+    key_validators = tuple(
+        (x, _compile_schema(x), _compile_schema(schema_dict[x], ignore_extra_keys))
+        for x in sorted_keys)
+    required_keys = set(
+        x for x in schema_dict
+        if type(x) not in (schema.Optional, schema.Forbidden)) #pylint: disable=unidiomatic-typecheck
+
+    def _validate(data):
+        if not isinstance(data, dict):
+            return _INVALID
+        new_data = type(data)()
+        coverage = set()
+        for key, value in data.items():
+            for schema_key, validate_key, validate_value in key_validators:
+                new_key = validate_key(key)
+                if new_key is _INVALID:
+                    continue
+                new_value = validate_value(value)
+                if new_value is _INVALID:
+                    return _INVALID
+                new_data[new_key] = new_value
+                coverage.add(schema_key)
+                break
+        if not required_keys.issubset(coverage):
+            return _INVALID
+        if not ignore_extra_keys and len(new_data) != len(data):
+            return _INVALID
+        return new_data
+    return _validate
+
+def _compile_schema(schema_obj, ignore_extra_keys=False): #pylint: disable=too-many-return-statements
+    """
+    Returns a function that returns the validated data, or _INVALID if the data does not
+    validate. It accepts the same data as the interpreted schema_obj.
+    """
+    schema_type = type(schema_obj)
+    if schema_type in (schema.Schema, schema.Optional):
+        return _compile_schema(
+            schema_obj._schema, schema_obj._ignore_extra_keys) #pylint: disable=protected-access
+    if schema_type in (schema.And, schema.Or):
+        validators = tuple(
+            _compile_schema(x, schema_obj._ignore_extra_keys) #pylint: disable=protected-access
+            for x in schema_obj._args) #pylint: disable=protected-access
+        if schema_type is schema.And:
+            def _validate_and(data):
+                for validator in validators:
+                    data = validator(data)
+                    if data is _INVALID:
+                        break
+                return data
+            return _validate_and
+
+        def _validate_or(data):
+            for validator in validators:
+                result = validator(data)
+                if result is not _INVALID:
+                    return result
+            return _INVALID
+        return _validate_or
+    if schema_type is schema.Use:
+        use_callable = schema_obj._callable #pylint: disable=protected-access
+
+        def _validate_use(data):
+            try:
+                return use_callable(data)
+            except Exception: #pylint: disable=broad-except
+                return _INVALID
+        return _validate_use
+    flavor = schema._priority(schema_obj) #pylint: disable=protected-access
+    if flavor == schema.DICT:
+        return _compile_dict(schema_obj, ignore_extra_keys)
+    if flavor == schema.TYPE:
+        if schema_obj is object:
+            return lambda data: data
+        return lambda data: data if isinstance(data, schema_obj) else _INVALID
+    if flavor == schema.CALLABLE:
+        def _validate_callable(data):
+            try:
+                if schema_obj(data):
+                    return data
+            except Exception: #pylint: disable=broad-except
+                pass
+            return _INVALID
+        return _validate_callable
+    if flavor == schema.COMPARABLE:
+        return lambda data: data if schema_obj == data else _INVALID
+    return _compile_interpreted(schema_obj, ignore_extra_keys)
+
+class CompiledSchema: #pylint: disable=too-few-public-methods
+    """
+    A third_party.schema.Schema compiled into flat validator functions.
+
+    Data that does not validate is validated again with the interpreted schema, so the
+    same SchemaError is raised with the same message.
+    """
+
+    def __init__(self, schema_obj):
+        """schema_obj is the third_party.schema.Schema to compile"""
+        self.schema = schema_obj
+        self._validate = _compile_schema(schema_obj)
+
+    def validate(self, data):
+        """
+        Returns the validated data, like schema.Schema.validate()
+
+        Raises schema.SchemaError if the data does not validate.
+        """
+        result = self._validate(data)
+        if result is _INVALID:
+            return self.schema.validate(data)
+        return result
+
+# Parsers of single config files for _ConfigABC._read_layer
+
+def _read_text_layer(path):
+    """Returns the contents of the config file at path"""
+    with path.open(encoding=ENCODING) as config_file:
+        return config_file.read()
+
+def _parse_list_layer(path):
+    """Returns a tuple of the non-empty lines of the list file at path"""
+    return tuple(filter(len, _read_text_layer(path).splitlines()))
+
+def _parse_mapping_layer(path):
+    """Returns a tuple of the key-value pairs of the mapping file at path"""
+    return tuple(
+        tuple(line.split('=')) for line in filter(len, _read_text_layer(path).splitlines()))
+
+def _hash_canonical(data):
+    """
+    Returns the hex SHA-256 digest of data, which must be composed of strings, lists,
+    tuples and dictionaries with string keys
+    """
+    return hashlib.sha256(json.dumps(
+        data, ensure_ascii=False, sort_keys=True,
+        separators=(',', ':')).encode(ENCODING)).hexdigest()
+
+def _hash_file(path):
+    """Returns the hex SHA-256 digest of the contents of the file at path"""
+    hasher = hashlib.sha256()
+    with path.open('rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(1 << 16), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
 # Classes
 
+class _ParsedLayerCache: #pylint: disable=too-few-public-methods
+    """
+    Cache of parsed config files, shared by the config bundles of a BundleCatalog.
+    Parsed config files are reused until their modification time or size changes.
+    """
+
+    def __init__(self):
+        # Dictionary of (parser, path) to a tuple of mtime, size, and parsed data
+        self._layers = dict()
+
+    def get(self, path, parse_layer):
+        """Returns the output of parse_layer for the config file at path"""
+        stat_result = path.stat()
+        cached = self._layers.get((parse_layer, path))
+        if cached and cached[:2] == (stat_result.st_mtime_ns, stat_result.st_size):
+            return cached[2]
+        parsed = parse_layer(path)
+        self._layers[(parse_layer, path)] = (
+            stat_result.st_mtime_ns, stat_result.st_size, parsed)
+        return parsed
+
 class _ConfigABC(abc.ABC):
     """Abstract base class for configuration files or directories"""
 
+    # The _ParsedLayerCache to share parsed config files with, or None
+    _layer_cache = None
+
     def __init__(self, path, name=None):
         """
         Initializes the config class.
@@ -136,6 +330,15 @@ class _ConfigABC(abc.ABC):
             return True
         return False
 
+    def _read_layer(self, path, parse_layer):
+        """
+        Returns the output of the function parse_layer for the single config file at path.
+        The output is shared with other config bundles of the same BundleCatalog.
+        """
+        if self._layer_cache is None:
+            return parse_layer(path)
+        return self._layer_cache.get(path, parse_layer)
+
     @abc.abstractmethod
     def _parse_data(self):
         """
@@ -161,29 +364,79 @@ class _ConfigABC(abc.ABC):
         If this config file is a placeholder, nothing is written.
         """
 
+    @abc.abstractmethod
+    def _get_canonical_data(self):
+        """
+        Returns the merged config data as strings, lists and dictionaries for fingerprint().
+        Placeholders have the same canonical data as empty config files.
+        """
+
 class _CacheConfigMixin: #pylint: disable=too-few-public-methods
     """
     Mixin for _ConfigABC to cache parse output
 
-    NOTE: This does not work with ListConfigFile
+    The cache is invalidated when the set of paths, or the modification time or size of any
+    of the paths changes. The paths are only checked on the first access, and again after
+    refresh(), so that lookups in the cached data do not access the filesystem.
+    Parsers must return data that is not modified afterwards.
     """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._read_cache = None
+        self._read_cache_key = None
+        # Tuple of the cache key and digest of the last fingerprint()
+        self._fingerprint_cache = (None, None)
+        # The cache key of the paths when they were last checked, or None to check them again
+        self._checked_cache_key = None
+
+    def _get_cache_key(self):
+        """
+        Returns a value that changes when the config data on disk may have changed.
+        The paths are checked again only after refresh() or when paths were added.
+        """
+        if (self._checked_cache_key is None
+                or len(self._checked_cache_key) != len(self._path_order)):
+            key = list()
+            for path in self._path_order:
+                stat_result = path.stat()
+                key.append((path, stat_result.st_mtime_ns, stat_result.st_size))
+            self._checked_cache_key = tuple(key)
+        return self._checked_cache_key
+
+    def refresh(self):
+        """
+        Checks the paths of the config file again on the next access, and parses them again
+        if they changed. This must be called before reusing the config file after its files
+        may have been modified (e.g. by another command of the run command).
+        """
+        self._checked_cache_key = None
 
     @property
     def _config_data(self):
         """
         Returns the cached parsed config data.
-        It parses and caches if the cash is not present.
+        It parses and caches if the cache is not present or is outdated.
         """
-        if self._read_cache:
-            return self._read_cache
-        self._read_cache = super()._config_data
+        cache_key = self._get_cache_key()
+        if self._read_cache is None or cache_key != self._read_cache_key:
+            self._read_cache = super()._config_data
+            self._read_cache_key = cache_key
         return self._read_cache
 
+    def fingerprint(self):
+        """
+        Returns a hex digest of the canonical merged config data. Config files with the same
+        fingerprint are equivalent, regardless of how the data is split among dependencies.
+        The digest is reused until the paths, or the modification time or size of any of the
+        paths changes.
+        """
+        cache_key = self._get_cache_key()
+        if self._fingerprint_cache[0] != cache_key:
+            self._fingerprint_cache = (cache_key, _hash_canonical(self._get_canonical_data()))
+        return self._fingerprint_cache[1]
+
 class RequiredConfigMixin: #pylint: disable=too-few-public-methods
     """Mixin to require a config file, i.e. disallow placeholders"""
 
@@ -200,6 +453,18 @@ class IniConfigFile(_CacheConfigMixin, _ConfigABC):
 
     _schema = schema.Schema(object) # Allow any INI by default
 
+    # Dictionary of schemas to their CompiledSchema
+    _compiled_schemas = dict()
+
+    @classmethod
+    def _get_compiled_schema(cls):
+        """Returns the CompiledSchema of the class schema"""
+        compiled_schema = cls._compiled_schemas.get(cls._schema)
+        if compiled_schema is None:
+            compiled_schema = CompiledSchema(cls._schema)
+            cls._compiled_schemas[cls._schema] = compiled_schema
+        return compiled_schema
+
     def __getitem__(self, key):
         """
         Returns a section from the INI
@@ -229,16 +494,24 @@ class IniConfigFile(_CacheConfigMixin, _ConfigABC):
             # on their own, or inherit RequiredConfigMixin.
             return parsed_ini
         for ini_path in self._path_order:
-            with ini_path.open(encoding=ENCODING) as ini_file:
-                parsed_ini.read_file(ini_file, source=str(ini_path))
+            parsed_ini.read_string(
+                self._read_layer(ini_path, _read_text_layer), source=str(ini_path))
         try:
-            self._schema.validate(parsed_ini)
+            self._get_compiled_schema().validate(parsed_ini)
         except schema.SchemaError:
             get_logger().exception(
                 'Merged INI files failed schema validation: %s', tuple(self._path_order))
             raise BuildkitAbort()
         return parsed_ini
 
+    def _get_canonical_data(self):
+        """Returns a dictionary of section names to dictionaries of the section's items"""
+        parsed_ini = self._config_data
+        return {
+            section: dict(parsed_ini.items(section, raw=True))
+            for section in parsed_ini.sections()
+        }
+
     def write(self, path):
         if not self._placeholder:
             ini_parser = configparser.ConfigParser()
@@ -246,35 +519,296 @@ class IniConfigFile(_CacheConfigMixin, _ConfigABC):
             with path.open("w", encoding=ENCODING) as output_file:
                 ini_parser.write(output_file)
 
-class ListConfigFile(_ConfigABC):
+class ListConfigFile(_CacheConfigMixin, _ConfigABC):
     """
     Represents a simple newline-delimited list
 
-    NOTE: This will not work properly if combined with _CacheConfigMixin
+    The list is cached as a tuple, with a frozenset for membership tests.
     """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Tuple of the list data the set was built from, and the set
+        self._set_cache = (None, None)
+
     def __contains__(self, item):
         """Returns True if item is in the list; False otherwise"""
-        return item in self._config_data
+        return item in self._config_set
 
     def _line_generator(self):
         for list_path in self._path_order:
-            with list_path.open(encoding=ENCODING) as list_file:
-                line_iter = list_file.read().splitlines()
-                yield from filter(len, line_iter)
+            yield from self._read_layer(list_path, _parse_list_layer)
 
     def __iter__(self):
         """Returns an iterator over the list items"""
         return iter(self._config_data)
 
+    def __len__(self):
+        """Returns the number of list items"""
+        return len(self._config_data)
+
+    @property
+    def _config_set(self):
+        """Returns a frozenset of the list items"""
+        config_data = self._config_data
+        if self._set_cache[0] is not config_data:
+            self._set_cache = (config_data, frozenset(config_data))
+        return self._set_cache[1]
+
     def _parse_data(self):
-        """Returns an iterator over the list items"""
-        return self._line_generator()
+        """Returns a tuple of the list items"""
+        return tuple(self._line_generator())
+
+    def _get_canonical_data(self):
+        """Returns the list items in order"""
+        return self._config_data
 
     def write(self, path):
         if not self._placeholder:
             with path.open('w', encoding=ENCODING) as output_file:
                 output_file.writelines(map(lambda x: '%s\n' % x, self._config_data))
 
+def _is_glob_rule(line):
+    """Returns True if the list line is a glob rule; False otherwise"""
+    return any(char in line for char in '*?[')
+
+def _is_path_rule(line):
+    """Returns True if the list line is a rule of PathListConfigFile; False otherwise"""
+    return line.startswith('!') or line.endswith('/') or _is_glob_rule(line)
+
+def _has_path_rules(lines):
+    """Returns True if any of the list lines is a rule of PathListConfigFile; False otherwise"""
+    joined = '\n{}\n'.format('\n'.join(lines))
+    return '\n!' in joined or '/\n' in joined or _is_glob_rule(joined)
+
+def _translate_glob(glob):
+    """Returns a regex string matching the same paths as the glob rule"""
+    regex = list()
+    index = 0
+    while index < len(glob):
+        char = glob[index]
+        if glob.startswith('**/', index):
+            regex.append('(?:.*/)?')
+            index += 3
+            continue
+        elif glob.startswith('**', index):
+            regex.append('.*')
+            index += 2
+            continue
+        elif char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '[' and ']' in glob[index + 2:]:
+            end = glob.index(']', index + 2)
+            char_class = glob[index + 1:end].replace('\\', '\\\\')
+            if char_class.startswith('!'):
+                char_class = '^' + char_class[1:]
+            regex.append('[{}]'.format(char_class))
+            index = end
+        else:
+            regex.append(re.escape(char))
+        index += 1
+    return ''.join(regex)
+
+def _get_glob_base(glob):
+    """Returns the directory of the glob rule before the first component with a wildcard"""
+    base_parts = list()
+    for part in glob.split('/')[:-1]:
+        if _is_glob_rule(part):
+            break
+        base_parts.append(part)
+    return '/'.join(base_parts)
+
+def _compile_globs(regex_strings):
+    """Returns a compiled regex matching any of the translated globs, or None if empty"""
+    if not regex_strings:
+        return None
+    return re.compile('(?:{})\\Z'.format('|'.join(regex_strings)))
+
+def walk_tree_files(resolved_tree, directory=''):
+    """
+    Yields the POSIX relative path of every non-directory (including symlinks) at or below
+    the POSIX relative directory of the tree. Symlinks are not followed.
+    """
+    pending_dirs = [directory]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            entries = list(os.scandir(str(resolved_tree / current_dir)))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            if current_dir:
+                relative_path = current_dir + '/' + entry.name
+            else:
+                relative_path = entry.name
+            if entry.is_dir(follow_symlinks=False):
+                pending_dirs.append(relative_path)
+            else:
+                yield relative_path
+
+class PathRules:
+    """
+    Matcher for the rules of a PathListConfigFile.
+
+    Rules are one of the following:
+
+    * Directory rules end with "/" and match every file below the directory
+    * Glob rules contain "*", "?" or "[...]". "*" and "?" do not match "/", and a "**"
+      path component matches zero or more directories.
+    * Exceptions are directory rules, glob rules or paths prefixed with "!". A path matching
+      an exception is not matched by the other rules.
+    """
+
+    def __init__(self, rules):
+        """rules is an iterable of rule strings"""
+        self._include_dirs = set()
+        self._exclude_dirs = set()
+        self._exclude_paths = set()
+        include_globs = list()
+        exclude_globs = list()
+        # Directories under which matching files may be found
+        self.base_dirs = set()
+        for rule in rules:
+            is_exception = rule.startswith('!')
+            if is_exception:
+                rule = rule[1:]
+            if rule.endswith('/'):
+                if is_exception:
+                    self._exclude_dirs.add(rule.rstrip('/'))
+                else:
+                    self._include_dirs.add(rule.rstrip('/'))
+                    self.base_dirs.add(rule.rstrip('/'))
+            elif _is_glob_rule(rule):
+                if is_exception:
+                    exclude_globs.append(_translate_glob(rule))
+                else:
+                    include_globs.append(_translate_glob(rule))
+                    self.base_dirs.add(_get_glob_base(rule))
+            elif is_exception:
+                self._exclude_paths.add(rule)
+            else:
+                raise ValueError('Rule is not a directory or glob rule: {}'.format(rule))
+        self._include_regex = _compile_globs(include_globs)
+        self._exclude_regex = _compile_globs(exclude_globs)
+
+    def __bool__(self):
+        return bool(self.base_dirs)
+
+    @staticmethod
+    def _in_dirs(path, dirs):
+        if not dirs:
+            return False
+        index = path.find('/')
+        while index != -1:
+            if path[:index] in dirs:
+                return True
+            index = path.find('/', index + 1)
+        return False
+
+    def matches(self, path):
+        """Returns True if the POSIX relative path is matched by the rules; False otherwise"""
+        if not (self._in_dirs(path, self._include_dirs)
+                or (self._include_regex and self._include_regex.match(path))):
+            return False
+        if path in self._exclude_paths or self._in_dirs(path, self._exclude_dirs):
+            return False
+        return not (self._exclude_regex and self._exclude_regex.match(path))
+
+class PathListConfigFile(ListConfigFile):
+    """
+    Represents a list of POSIX paths relative to the buildspace tree, such as the binary pruning
+    and domain substitution lists.
+
+    In addition to plain paths, the list can contain directory and glob rules with exceptions
+    (see PathRules). Since rules can only be expanded with a buildspace tree, a list with
+    rules cannot be iterated over; expand() returns all of its paths instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Tuple of the list data the rules were parsed from, the plain paths, and the rules
+        self._rules_cache = (None, None, None)
+
+    def _get_parsed(self):
+        config_data = self._config_data
+        if self._rules_cache[0] is not config_data:
+            if not _has_path_rules(config_data):
+                paths = config_data
+                rules = PathRules(tuple())
+            else:
+                paths = tuple(x for x in config_data if not _is_path_rule(x))
+                rules = PathRules(x for x in config_data if _is_path_rule(x))
+            self._rules_cache = (config_data, paths, rules)
+        return self._rules_cache[1:]
+
+    @property
+    def rules(self):
+        """Returns the PathRules of the list. It is False if there are no rules."""
+        return self._get_parsed()[1]
+
+    def __contains__(self, item):
+        """Returns True if the path is a plain path or matched by the rules; False otherwise"""
+        if item in self._config_set:
+            return True
+        rules = self.rules
+        return bool(rules) and rules.matches(item)
+
+    def _get_paths_without_rules(self):
+        """
+        Returns the paths of the list
+
+        Raises TypeError if the list has rules, since they cannot be expanded without a tree.
+        """
+        paths, rules = self._get_parsed()
+        if rules:
+            raise TypeError('Path list "{}" has rules; use expand() instead'.format(self.name))
+        return paths
+
+    @property
+    def plain_paths(self):
+        """Returns a tuple of the plain paths of the list, without the files of the rules"""
+        return self._get_parsed()[0]
+
+    def __iter__(self):
+        """
+        Returns an iterator over the paths of the list
+
+        Raises TypeError if the list has rules.
+        """
+        return iter(self._get_paths_without_rules())
+
+    def __len__(self):
+        """
+        Returns the number of paths of the list
+
+        Raises TypeError if the list has rules.
+        """
+        return len(self._get_paths_without_rules())
+
+    def expand(self, resolved_tree):
+        """
+        Returns a sorted tuple of the plain paths and the paths of the tree matched by the rules.
+        Only the directories that can contain matching files are read.
+
+        resolved_tree is an absolute pathlib.Path to the buildspace tree.
+        """
+        paths, rules = self._get_parsed()
+        if not rules:
+            return tuple(sorted(set(paths)))
+        result = set(paths)
+        # Skip base directories that are below other base directories
+        base_dirs = sorted(rules.base_dirs)
+        for index, base_dir in enumerate(base_dirs):
+            if any(base_dir == x or base_dir.startswith(x + '/') or not x
+                   for x in base_dirs[:index]):
+                continue
+            result.update(filter(rules.matches, walk_tree_files(resolved_tree, base_dir)))
+        return tuple(sorted(result))
+
 class MappingConfigFile(_CacheConfigMixin, _ConfigABC):
     """Represents a simple string-keyed and string-valued dictionary"""
     def __contains__(self, item):
@@ -303,26 +837,252 @@ class MappingConfigFile(_CacheConfigMixin, _ConfigABC):
         """Return a dictionary of the mapping of keys and values"""
         new_dict = dict()
         for mapping_path in self._path_order:
-            with mapping_path.open(encoding=ENCODING) as mapping_file:
-                for line in filter(len, mapping_file.read().splitlines()):
-                    key, value = line.split('=')
-                    new_dict[key] = value
+            for key, value in self._read_layer(mapping_path, _parse_mapping_layer):
+                new_dict[key] = value
         return new_dict
 
+    def _get_canonical_data(self):
+        """Returns the dictionary of the mapping"""
+        return self._config_data
+
     def write(self, path):
         if not self._placeholder:
             with path.open('w', encoding=ENCODING) as output_file:
                 for item in self._config_data.items():
                     output_file.write('%s=%s\n' % item)
 
+class _PathTrieNode: #pylint: disable=too-few-public-methods
+    """A node of PathTrie"""
+
+    __slots__ = ('children', 'terminal', 'count')
+
+    def __init__(self):
+        self.children = dict()
+        self.terminal = False
+        # Number of paths at and below this node
+        self.count = 0
+
+class PathTrie:
+    """
+    A set of POSIX relative paths stored as a tree of path components.
+
+    In addition to the set operations, it can answer queries about whole directories in
+    time proportional to the depth of the directory. Paths can be given as strings
+    (e.g. "third_party/foo/bar.c") or as sequences of path components
+    (e.g. PurePosixPath.parts).
+    """
+
+    def __init__(self, paths=tuple()):
+        """paths is an iterable of paths to add"""
+        self._root = _PathTrieNode()
+        for path in paths:
+            self.add(path)
+
+    @staticmethod
+    def _get_parts(path):
+        if isinstance(path, str):
+            return tuple(filter(len, path.split('/')))
+        return tuple(path)
+
+    def _find_node(self, parts):
+        """Returns the node for parts, or None if it does not exist"""
+        node = self._root
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def add(self, path):
+        """Adds a path. Returns True if it was not already present; False otherwise"""
+        parts = self._get_parts(path)
+        node = self._find_node(parts)
+        if node is not None and node.terminal:
+            return False
+        node = self._root
+        node.count += 1
+        for part in parts:
+            node = node.children.setdefault(part, _PathTrieNode())
+            node.count += 1
+        node.terminal = True
+        return True
+
+    def remove(self, path):
+        """
+        Removes a path.
+
+        Raises KeyError if the path is not present.
+        """
+        parts = self._get_parts(path)
+        node = self._find_node(parts)
+        if node is None or not node.terminal:
+            raise KeyError(path)
+        node.terminal = False
+        node = self._root
+        node.count -= 1
+        for part in parts:
+            child = node.children[part]
+            child.count -= 1
+            if not child.count:
+                del node.children[part]
+                break
+            node = child
+
+    def discard(self, path):
+        """Removes a path if it is present"""
+        try:
+            self.remove(path)
+        except KeyError:
+            pass
+
+    def __contains__(self, path):
+        """Returns True if the path is present; False otherwise"""
+        node = self._find_node(self._get_parts(path))
+        return node is not None and node.terminal
+
+    def __len__(self):
+        """Returns the number of paths"""
+        return self._root.count
+
+    def __bool__(self):
+        return bool(self._root.count)
+
+    def count(self, directory=''):
+        """
+        Returns the number of paths at or below directory.
+        An empty directory (the default) refers to the root.
+        """
+        node = self._find_node(self._get_parts(directory))
+        if node is None:
+            return 0
+        return node.count
+
+    def has_subtree(self, directory):
+        """Returns True if any path is at or below directory; False otherwise"""
+        return self._find_node(self._get_parts(directory)) is not None
+
+    def children(self, directory=''):
+        """
+        Returns a sorted list of tuples of the name and path count of every component
+        directly below directory.
+        """
+        node = self._find_node(self._get_parts(directory))
+        if node is None:
+            return list()
+        return sorted((name, child.count) for name, child in node.children.items())
+
+    def iter_subtree(self, directory=''):
+        """
+        Returns an iterator of paths as strings at or below directory, in sorted order of
+        their components.
+        """
+        parts = self._get_parts(directory)
+        node = self._find_node(parts)
+        if node is None:
+            return
+        # Stack of tuples of node and its path components, in reverse order
+        pending = [(node, parts)]
+        while pending:
+            node, parts = pending.pop()
+            if node.terminal:
+                yield '/'.join(parts)
+            for name in sorted(node.children, reverse=True):
+                pending.append((node.children[name], parts + (name,)))
+
+    def __iter__(self):
+        """Returns an iterator of all paths in sorted order of their components"""
+        return self.iter_subtree()
+
+def _get_bundle_cache_key(bundle_dirs):
+    """
+    Returns a tuple of the path, mtime and size of the config bundle directories and
+    every file in them.
+
+    Raises FileNotFoundError if a path does not exist.
+    """
+    key = list()
+    for bundle_dir in bundle_dirs:
+        stat_result = os.stat(str(bundle_dir))
+        key.append((str(bundle_dir), stat_result.st_mtime_ns, stat_result.st_size))
+        for entry in sorted(os.scandir(str(bundle_dir)), key=lambda x: x.name):
+            stat_result = entry.stat()
+            key.append((entry.path, stat_result.st_mtime_ns, stat_result.st_size))
+    return tuple(key)
+
+def _get_bundle_cache_path(cache_dir, bundle_kind, bundle_path):
+    """Returns the pathlib.Path to the cache file of a config bundle"""
+    identifier = '{}:{}'.format(bundle_kind, bundle_path.resolve())
+    return cache_dir / '{}.pickle'.format(
+        hashlib.sha256(identifier.encode(ENCODING)).hexdigest()[:32])
+
+def _read_bundle_cache(cache_path):
+    """
+    Returns the cached ConfigBundle at cache_path, or None if it does not exist or is outdated.
+
+    The cache is unpickled without any integrity check, so it can run arbitrary code. It must
+    only be read from a buildspace that is not writable by untrusted users.
+    """
+    try:
+        with cache_path.open('rb') as cache_file:
+            version, bundle_dirs, key = pickle.load(cache_file)
+            if version != _BUNDLE_CACHE_VERSION:
+                return None
+            if _get_bundle_cache_key(bundle_dirs) != key:
+                return None
+            return pickle.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError, TypeError):
+        get_logger().debug('Ignoring unreadable config bundle cache: %s', cache_path)
+        return None
+
+def _write_bundle_cache(config_bundle, cache_path):
+    """
+    Parses, validates and fingerprints every config file of the config bundle, and then
+    writes it to the cache at cache_path. Nothing is written if the cache directory cannot
+    be created (e.g. the buildspace does not exist), or if a config file cannot be parsed;
+    in the latter case, the error is raised again when the config file is used.
+    """
+    try:
+        for config_file in config_bundle._config_data.values(): #pylint: disable=protected-access
+            config_file._config_data #pylint: disable=pointless-statement,protected-access
+            if isinstance(config_file, ListConfigFile):
+                config_file._config_set #pylint: disable=pointless-statement,protected-access
+            if isinstance(config_file, PathListConfigFile):
+                config_file.rules #pylint: disable=pointless-statement
+        config_bundle.fingerprint()
+    except (BuildkitAbort, ValueError, TypeError, NotADirectoryError):
+        get_logger().debug('Not caching config bundle with invalid files: %s', config_bundle.path)
+        return
+    bundle_dirs = tuple(map(str, config_bundle._path_order)) #pylint: disable=protected-access
+    key = _get_bundle_cache_key(bundle_dirs)
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+    except FileNotFoundError:
+        return # The buildspace does not exist
+    try:
+        temp_path = cache_path.with_name(cache_path.name + '.tmp')
+        with temp_path.open('wb') as cache_file:
+            pickle.dump((_BUNDLE_CACHE_VERSION, bundle_dirs, key), cache_file, protocol=4)
+            pickle.dump(config_bundle, cache_file, protocol=4)
+        os.replace(str(temp_path), str(cache_path))
+    except OSError as exc:
+        get_logger().debug('Unable to write config bundle cache: %s', exc)
+
 class ConfigBundle(_CacheConfigMixin, RequiredConfigMixin, _ConfigABC):
     """Represents a user or base config bundle"""
 
     @classmethod
-    def from_base_name(cls, name):
+    def from_base_name(cls, name, cache_dir=None):
         """
         Return a new ConfigBundle from a base config bundle name.
 
+        cache_dir is a pathlib.Path to the directory of the resolved config bundle cache, or None
+        to not use the cache. With the cache, a config bundle whose directories and files are
+        unchanged is loaded without resolving, parsing, or validating any of its files.
+        The cache can also be disabled with the BUILDKIT_NO_BUNDLE_CACHE environment variable.
+        The cache is a pickle without integrity check, so the buildspace must be trusted.
+
         Raises NotADirectoryError if the resources/ or resources/patches directories
         could not be found.
         Raises FileNotFoundError if the base config bundle name does not exist.
@@ -330,7 +1090,30 @@ class ConfigBundle(_CacheConfigMixin, RequiredConfigMixin, _ConfigABC):
         dependencies' metadata
         """
         config_bundles_dir = get_resources_dir() / CONFIG_BUNDLES_DIR
+        cache_path = None
+        if cache_dir is not None and bundle_cache_enabled():
+            cache_path = _get_bundle_cache_path(cache_dir, 'base', config_bundles_dir / name)
+            cached_bundle = _read_bundle_cache(cache_path)
+            if cached_bundle is not None:
+                return cached_bundle
+        new_bundle = cls._resolve_base_bundle(
+            name, config_bundles_dir, get_resources_dir() / PATCHES_DIR,
+            lambda x: BaseBundleMetaIni(config_bundles_dir / x / BASEBUNDLEMETA_INI))
+        if cache_path is not None:
+            _write_bundle_cache(new_bundle, cache_path)
+        return new_bundle
+
+    @classmethod
+    def _resolve_base_bundle(cls, name, config_bundles_dir, patches_dir, get_metadata,
+                             layer_cache=None):
+        """
+        Returns a new ConfigBundle of the base config bundle name and its dependencies.
+
+        get_metadata is a function that returns the BaseBundleMetaIni of a base bundle name.
+        layer_cache is the _ParsedLayerCache for the config files, or None.
+        """
         new_bundle = cls(config_bundles_dir / name)
+        new_bundle._layer_cache = layer_cache #pylint: disable=protected-access
         pending_explore = collections.deque()
         pending_explore.appendleft(name)
         known_names = set()
@@ -340,17 +1123,35 @@ class ConfigBundle(_CacheConfigMixin, RequiredConfigMixin, _ConfigABC):
                 raise ValueError('Duplicate base config bundle dependency "{}"'.format(
                     base_bundle_name))
             known_names.add(base_bundle_name)
-            basebundlemeta = BaseBundleMetaIni(
-                config_bundles_dir / base_bundle_name / BASEBUNDLEMETA_INI)
-            for dependency_name in basebundlemeta.depends:
+            for dependency_name in get_metadata(base_bundle_name).depends:
                 if new_bundle.update_first_path(config_bundles_dir / dependency_name):
                     pending_explore.appendleft(dependency_name)
         try:
-            new_bundle.patches.set_patches_dir(get_resources_dir() / PATCHES_DIR)
+            new_bundle.patches.set_patches_dir(patches_dir)
         except KeyError:
             pass # Don't do anything if patch_order does not exist
         return new_bundle
 
+    @classmethod
+    def from_user_path(cls, path, cache_dir=None):
+        """
+        Return a new ConfigBundle from a user config bundle directory.
+
+        cache_dir is the same as in from_base_name()
+
+        Raises FileNotFoundError if path does not exist.
+        """
+        cache_path = None
+        if cache_dir is not None and bundle_cache_enabled() and path.is_dir():
+            cache_path = _get_bundle_cache_path(cache_dir, 'user', path)
+            cached_bundle = _read_bundle_cache(cache_path)
+            if cached_bundle is not None:
+                return cached_bundle
+        new_bundle = cls(path)
+        if cache_path is not None:
+            _write_bundle_cache(new_bundle, cache_path)
+        return new_bundle
+
     def get_dependencies(self):
         """
         Returns a tuple of dependencies for the config bundle, in descending order of inheritance.
@@ -426,23 +1227,69 @@ class ConfigBundle(_CacheConfigMixin, RequiredConfigMixin, _ConfigABC):
                             'Unknown files in config bundle: {}'.format(directory))
                     unused_names.discard(config_path.name)
                     if config_class:
-                        file_dict[config_path.name] = config_class(config_path)
+                        config_file = config_class(config_path)
+                        config_file._layer_cache = self._layer_cache #pylint: disable=protected-access
+                        file_dict[config_path.name] = config_file
         # Add placeholder config files
         for name in unused_names:
             file_dict[name] = _FILE_DEF[name](None, name=name)
         return file_dict
 
-    def write(self, path):
+    def fingerprint(self, names=None): #pylint: disable=arguments-differ
+        """
+        Returns a hex digest of the canonical merged data of the config bundle's files.
+        Config bundles with the same fingerprint are equivalent.
+
+        names is an iterable of config file names (e.g. DOMAIN_REGEX_LIST) to limit the
+        fingerprint to, or None for all config files. This allows caches to be invalidated
+        only by the config files they depend on.
+
+        Raises KeyError if a config file name is not known.
+        Raises ValueError if the config bundle is malformed.
+        """
+        if names is None:
+            return _hash_canonical(self._get_canonical_data())
+        return _hash_canonical({name: self[name].fingerprint() for name in names})
+
+    def _get_canonical_data(self):
+        """Returns a dictionary of config file names to their fingerprints"""
+        return {name: config_file.fingerprint() for name, config_file in self._config_data.items()}
+
+    def refresh(self):
+        """
+        Checks the directories and the config files of the config bundle again on the next
+        access. See _CacheConfigMixin.refresh()
+        """
+        super().refresh()
+        if self._read_cache is not None:
+            for config_file in self._read_cache.values():
+                if isinstance(config_file, _CacheConfigMixin):
+                    config_file.refresh()
+
+    def write(self, path, incremental=False):
         """
         Writes a copy of this config bundle to a new directory specified by path.
 
-        Raises FileExistsError if the directory already exists and is not empty.
+        incremental indicates if an existing config bundle at path is updated instead.
+        Patches that are already up-to-date are not copied again, and files that are no
+        longer part of the config bundle are removed.
+
+        Raises FileExistsError if incremental is False and the directory already exists and
+        is not empty.
         Raises FileNotFoundError if the parent directories for path do not exist.
         Raises ValueError if the config bundle is malformed.
         """
-        ensure_empty_dir(path)
+        bundle_export = DirectoryExport(path, incremental=incremental)
         for config_file in self._config_data.values():
-            config_file.write(path / config_file.name)
+            if config_file._placeholder: #pylint: disable=protected-access
+                # Nothing is written, so a file of a previous config bundle must be removed
+                continue
+            if isinstance(config_file, PatchesConfig):
+                config_file.write(path / config_file.name, bundle_export=bundle_export)
+            else:
+                config_file.write(path / config_file.name)
+            bundle_export.add_written(config_file.name)
+        bundle_export.finish()
 
 class BaseBundleMetaIni(RequiredConfigMixin, IniConfigFile):
     """Represents basebundlemeta.ini files"""
@@ -472,6 +1319,90 @@ class BaseBundleMetaIni(RequiredConfigMixin, IniConfigFile):
         else:
             return tuple()
 
+class BundleCatalog:
+    """
+    Represents all base config bundles in the resources directory.
+
+    The metadata of every base bundle is parsed once, and the dependency graph is validated to
+    be a polytree (see DESIGN.md). Base bundles from the catalog share the parsed config files
+    of their common dependencies.
+    """
+
+    def __init__(self, resources_dir=None):
+        """
+        resources_dir is a pathlib.Path to the resources directory.
+        Defaults to the one from get_resources_dir()
+
+        Raises NotADirectoryError if the resources directory could not be found.
+        Raises ValueError if a base bundle depends on an unknown base bundle, or if the
+        base bundle dependencies do not form a polytree.
+        Raises BuildkitAbort if a basebundlemeta.ini fails validation.
+        """
+        if resources_dir is None:
+            resources_dir = get_resources_dir()
+        self._config_bundles_dir = resources_dir / CONFIG_BUNDLES_DIR
+        self._patches_dir = resources_dir / PATCHES_DIR
+        self._layer_cache = _ParsedLayerCache()
+        self._bundles = dict()
+        self.metadata = collections.OrderedDict()
+        for bundle_dir in sorted(self._config_bundles_dir.iterdir()):
+            if bundle_dir.is_dir():
+                self.metadata[bundle_dir.name] = BaseBundleMetaIni(
+                    bundle_dir / BASEBUNDLEMETA_INI)
+        self._validate_polytree()
+
+    def _validate_polytree(self):
+        """
+        Raises ValueError if there are unknown dependencies, or if the dependency graph
+        contains a cycle when ignoring the direction of dependencies.
+        """
+        # Union-find of base bundle names; a dependency connecting two names that are
+        # already connected creates an undirected cycle
+        parents = {name: name for name in self.metadata}
+
+        def _find_root(name):
+            while parents[name] != name:
+                parents[name] = parents[parents[name]]
+                name = parents[name]
+            return name
+
+        for name, metadata in self.metadata.items():
+            for dependency_name in metadata.depends:
+                if dependency_name not in self.metadata:
+                    raise ValueError('Base bundle "{}" has unknown dependency "{}"'.format(
+                        name, dependency_name))
+                name_root = _find_root(name)
+                dependency_root = _find_root(dependency_name)
+                if name_root == dependency_root:
+                    raise ValueError(
+                        'Base bundle dependencies are not a polytree: '
+                        'dependency "{}" of "{}" forms a cycle'.format(dependency_name, name))
+                parents[name_root] = dependency_root
+
+    def __iter__(self):
+        """Returns an iterator over the sorted base bundle names"""
+        return iter(self.metadata)
+
+    def __contains__(self, name):
+        """Returns True if name is a base bundle name; False otherwise"""
+        return name in self.metadata
+
+    def get_bundle(self, name):
+        """
+        Returns the ConfigBundle of the base bundle name. The same ConfigBundle is returned for
+        the same name, so it must not be modified.
+
+        Raises KeyError if the base bundle name does not exist.
+        """
+        if name not in self.metadata:
+            raise KeyError(name)
+        if name not in self._bundles:
+            resolve_base_bundle = ConfigBundle._resolve_base_bundle #pylint: disable=protected-access
+            self._bundles[name] = resolve_base_bundle(
+                name, self._config_bundles_dir, self._patches_dir, self.metadata.__getitem__,
+                layer_cache=self._layer_cache)
+        return self._bundles[name]
+
 class DomainRegexList(ListConfigFile):
     """Representation of a domain_regex_list file"""
     _regex_pair_tuple = collections.namedtuple('DomainRegexPair', ('pattern', 'replacement'))
@@ -491,9 +1422,21 @@ class DomainRegexList(ListConfigFile):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # Cache of compiled regex pairs
+        # Cache of compiled regex pairs, and the list data they were compiled from
         self._compiled_regex = None
         self._compiled_inverted_regex = None
+        self._compiled_source = None
+
+    def __getstate__(self):
+        """
+        Drops the compiled regex pairs. Their namedtuple type is not a module attribute, so
+        pickle cannot find it, and compiled patterns are compiled again when unpickled anyway.
+        """
+        state = self.__dict__.copy()
+        state['_compiled_regex'] = None
+        state['_compiled_inverted_regex'] = None
+        state['_compiled_source'] = None
+        return state
 
     def _compile_regex(self, line):
         """Generates a regex pair tuple for the given line"""
@@ -595,6 +1538,10 @@ class DomainRegexList(ListConfigFile):
         If invert=True, raises ValueError if a pair isn't invertible.
         If invert=True, may raise undetermined exceptions during pair inversion
         """
+        if self._compiled_source is not self._config_data:
+            self._compiled_source = self._config_data
+            self._compiled_regex = None
+            self._compiled_inverted_regex = None
         if invert:
             if not self._compiled_inverted_regex:
                 if not self._check_invertible():
@@ -666,6 +1613,8 @@ class PatchesConfig(ListConfigFile):
         super().__init__(*args, **kwargs)
 
         self._patches_dir = None
+        # Dictionary of patch paths to a tuple of mtime, size, and digest
+        self._patch_digests = dict()
 
     def set_patches_dir(self, path):
         """
@@ -702,36 +1651,73 @@ class PatchesConfig(ListConfigFile):
         for relative_path in self:
             yield self._get_patches_dir() / relative_path
 
-    def export_patches(self, path, series=Path('series')):
+    def _get_patch_digest(self, patch_path):
+        """
+        Returns the hex SHA-256 digest of the patch at patch_path.
+        The digest is reused until the modification time or size of the patch changes.
+        """
+        stat_result = patch_path.stat()
+        cached = self._patch_digests.get(patch_path)
+        if cached and cached[:2] == (stat_result.st_mtime_ns, stat_result.st_size):
+            return cached[2]
+        digest = _hash_file(patch_path)
+        self._patch_digests[patch_path] = (stat_result.st_mtime_ns, stat_result.st_size, digest)
+        return digest
+
+    def fingerprint(self):
+        """
+        Returns a hex digest of patch_order and the contents of the patches in order.
+
+        Raises NotADirectoryError if the patches directory is not a directory or does not exist
+        """
+        if self._placeholder:
+            return super().fingerprint()
+        return _hash_canonical((
+            super().fingerprint(), [self._get_patch_digest(x) for x in self.patch_iter()]))
+
+    def export_patches(self, path, series=Path('series'), incremental=False):
         """
         Writes patches and a series file to the directory specified by path.
         This is useful for writing a quilt-compatible patches directory and series file.
         This does nothing if it is a placeholder.
 
-        path is a pathlib.Path to the patches directory to create. It must not already exist.
+        path is a pathlib.Path to the patches directory to create. It must not already exist,
+        unless incremental is True.
         series is a pathlib.Path to the series file, relative to path.
+        incremental indicates if an existing patches directory is updated. Patches that are
+        already up-to-date are not copied again, and other files are removed.
 
-        Raises FileExistsError if path already exists and is not empty.
+        Raises FileExistsError if incremental is False and path already exists and is not empty.
         Raises FileNotFoundError if the parent directories for path do not exist.
         """
         if self._placeholder:
             return
-        ensure_empty_dir(path) # Raises FileExistsError, FileNotFoundError
+        # Raises FileExistsError, FileNotFoundError
+        patches_export = DirectoryExport(path, incremental=incremental)
         for relative_path in self:
-            destination = path / relative_path
-            destination.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copyfile(str(self._get_patches_dir() / relative_path), str(destination))
+            patches_export.add_file(self._get_patches_dir() / relative_path, Path(relative_path))
         super().write(path / series)
+        patches_export.add_written(series)
+        patches_export.finish()
 
-    def write(self, path):
-        """Writes patch_order and patches/ directory to the same directory"""
+    def write(self, path, bundle_export=None):
+        """
+        Writes patch_order and patches/ directory to the same directory
+
+        bundle_export is the file_materialization.DirectoryExport of the config bundle
+        directory to add the patches to, or None to copy them directly.
+        """
         if self._placeholder:
             return
         super().write(path)
         for relative_path in self:
-            destination = path.parent / PATCHES_DIR / relative_path
-            destination.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copyfile(str(self._get_patches_dir() / relative_path), str(destination))
+            source = self._get_patches_dir() / relative_path
+            if bundle_export is None:
+                destination = path.parent / PATCHES_DIR / relative_path
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                materialize_file(source, destination)
+            else:
+                bundle_export.add_file(source, Path(PATCHES_DIR, relative_path))
 
 class VersionIni(RequiredConfigMixin, IniConfigFile):
     """Representation of a version.ini file"""
@@ -773,9 +1759,9 @@ class VersionIni(RequiredConfigMixin, IniConfigFile):
 
 _FILE_DEF = {
     BASEBUNDLEMETA_INI: None, # This file has special handling, so ignore it
-    PRUNING_LIST: ListConfigFile,
+    PRUNING_LIST: PathListConfigFile,
     DOMAIN_REGEX_LIST: DomainRegexList,
-    DOMAIN_SUBSTITUTION_LIST: ListConfigFile,
+    DOMAIN_SUBSTITUTION_LIST: PathListConfigFile,
     EXTRA_DEPS_INI: ExtraDepsIni,
     GN_FLAGS_MAP: MappingConfigFile,
     PATCH_ORDER_LIST: PatchesConfig,
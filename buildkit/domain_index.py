@@ -0,0 +1,244 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for a persistent inverted index of domain names in the buildspace tree.
+
+The index maps every dotted token of domain name characters found in the buildspace tree
+to the files it occurs in, with the byte offsets of every occurrence. Tokens are not
+filtered by their top-level domain, so file names like "foo.cc" are indexed as well as
+"www.google.com" or "goo.gl", and regexes also match within tokens like "google.comfoo".
+Questions about domain substitution coverage can then be answered by matching regexes
+against the set of distinct tokens, instead of re-reading the whole tree.
+"""
+
+import os
+import re
+import sqlite3
+
+from .common import get_executor, get_logger
+
+# Constants
+
+# Version of the tokens stored in the index. An index of another version is rebuilt.
+_INDEX_VERSION = 2
+
+# Dotted tokens of domain name characters. Backslashes are included for escaped periods.
+_TOKEN_REGEX = re.compile(rb'[A-Za-z0-9\-\\]+(?:\.[A-Za-z0-9\-\\]+)+')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS files ('
+    'id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, '
+    'mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS tokens (id INTEGER PRIMARY KEY, token TEXT UNIQUE NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS postings ('
+    'token_id INTEGER NOT NULL, file_id INTEGER NOT NULL, '
+    'count INTEGER NOT NULL, offsets TEXT NOT NULL, '
+    'PRIMARY KEY (token_id, file_id)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS postings_file ON postings (file_id)',
+)
+
+# Private definitions
+
+def _scan_file(path):
+    """
+    Returns a dictionary of domain tokens in the file at path to a list of their byte offsets
+
+    This is run in worker processes.
+    """
+    occurrences = dict()
+    with open(path, 'rb') as file_obj:
+        file_bytes = file_obj.read()
+    for match in _TOKEN_REGEX.finditer(file_bytes):
+        occurrences.setdefault(match.group().decode('ascii'), list()).append(match.start())
+    return occurrences
+
+def _walk_tree(resolved_tree):
+    """
+    Yields tuples of the POSIX relative path, mtime in nanoseconds, and size of every
+    regular file in the buildspace tree. Symlinks are not followed.
+    """
+    pending_dirs = [resolved_tree]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        files = list()
+        with os.scandir(str(current_dir)) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat_result = entry.stat(follow_symlinks=False)
+                    relative_path = os.path.relpath(entry.path, str(resolved_tree))
+                    files.append((relative_path.replace(os.sep, '/'), stat_result.st_mtime_ns,
+                                  stat_result.st_size))
+        # The directory is closed before yielding, so that it is not kept open by the caller
+        yield from files
+
+# Public definitions
+
+class DomainIndex:
+    """
+    Persistent inverted index of domain tokens in a buildspace tree, stored in sqlite.
+    """
+
+    def __init__(self, index_path):
+        """
+        index_path is a pathlib.Path to the index database. It is created if it does not exist,
+        and emptied if it was created by another version of buildkit.
+        """
+        self.index_path = index_path
+        self._connection = sqlite3.connect(str(index_path))
+        version, = self._connection.execute('PRAGMA user_version').fetchone()
+        if version != _INDEX_VERSION:
+            with self._connection:
+                for table in ('postings', 'tokens', 'files'):
+                    self._connection.execute('DROP TABLE IF EXISTS {}'.format(table))
+                self._connection.execute('PRAGMA user_version = {}'.format(_INDEX_VERSION))
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+
+    def close(self):
+        """Closes the index database"""
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _remove_file(self, file_id):
+        self._connection.execute('DELETE FROM postings WHERE file_id = ?', (file_id,))
+        self._connection.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def _get_token_id(self, token, token_ids):
+        token_id = token_ids.get(token)
+        if token_id is None:
+            token_id = self._connection.execute(
+                'INSERT INTO tokens (token) VALUES (?)', (token,)).lastrowid
+            token_ids[token] = token_id
+        return token_id
+
+    def update(self, buildspace_tree, executor=None):
+        """
+        Scans new and modified files in the buildspace tree and updates the index.
+        Files are considered modified if their mtime or size changed.
+
+        buildspace_tree is a pathlib.Path to the buildspace tree.
+        executor is the common.Executor to scan files with. Defaults to the shared executor
+        from common.get_executor().
+
+        Returns a tuple of the number of files scanned and removed from the index.
+        Raises FileNotFoundError if the buildspace tree does not exist.
+        """
+        if not buildspace_tree.exists():
+            raise FileNotFoundError(buildspace_tree)
+        resolved_tree = buildspace_tree.resolve()
+        known_files = {
+            path: (file_id, mtime_ns, size) for file_id, path, mtime_ns, size in
+            self._connection.execute('SELECT id, path, mtime_ns, size FROM files')
+        }
+        pending_files = list()
+        for relative_path, mtime_ns, size in _walk_tree(resolved_tree):
+            known = known_files.pop(relative_path, None)
+            if known and known[1:] == (mtime_ns, size):
+                continue
+            pending_files.append((relative_path, mtime_ns, size, known and known[0]))
+        get_logger().info(
+            'Indexing %s files (%s removed)...', len(pending_files), len(known_files))
+        token_ids = dict(self._connection.execute('SELECT token, id FROM tokens'))
+        if executor is None:
+            executor = get_executor()
+        with self._connection:
+            for file_id, _, _ in known_files.values():
+                self._remove_file(file_id)
+            results = executor.map(
+                _scan_file, (str(resolved_tree / x[0]) for x in pending_files),
+                chunksize=64)
+            for (relative_path, mtime_ns, size, file_id), occurrences in zip(
+                    pending_files, results):
+                if file_id is not None:
+                    self._remove_file(file_id)
+                file_id = self._connection.execute(
+                    'INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)',
+                    (relative_path, mtime_ns, size)).lastrowid
+                postings = [
+                    (self._get_token_id(token, token_ids), file_id, len(offsets),
+                     ','.join(map(str, offsets)))
+                    for token, offsets in occurrences.items()
+                ]
+                self._connection.executemany(
+                    'INSERT INTO postings (token_id, file_id, count, offsets) '
+                    'VALUES (?, ?, ?, ?)', postings)
+            self._connection.execute(
+                'DELETE FROM tokens WHERE id NOT IN (SELECT token_id FROM postings)')
+        return len(pending_files), len(known_files)
+
+    def tokens(self):
+        """Returns an iterator of all distinct domain tokens in the index"""
+        return (row[0] for row in self._connection.execute('SELECT token FROM tokens'))
+
+    def query(self, regex):
+        """
+        Returns a sorted list of tuples (path, token, count, offsets) for every occurrence of
+        an indexed token matching the compiled regex. offsets is a tuple of byte offsets of
+        the token in the file.
+
+        Only indexed tokens are matched, so regexes matching characters outside of domain
+        names or across several tokens are not fully answered.
+        """
+        matching_ids = [
+            token_id for token_id, token in
+            self._connection.execute('SELECT id, token FROM tokens') if regex.search(token)
+        ]
+        results = list()
+        for token_id in matching_ids:
+            results.extend(self._connection.execute(
+                'SELECT files.path, tokens.token, postings.count, postings.offsets '
+                'FROM postings JOIN files ON files.id = postings.file_id '
+                'JOIN tokens ON tokens.id = postings.token_id WHERE postings.token_id = ?',
+                (token_id,)))
+        return sorted(
+            (path, token, count, tuple(map(int, offsets.split(','))))
+            for path, token, count, offsets in results)
+
+    def files_matching(self, regex):
+        """
+        Returns a dictionary of paths to the number of occurrences of tokens matching the
+        compiled regex. See query() for the limitations.
+        """
+        file_counts = dict()
+        for path, _, count, _ in self.query(regex):
+            file_counts[path] = file_counts.get(path, 0) + count
+        return file_counts
+
+def unlisted_files(domain_index, config_bundle):
+    """
+    Returns a dictionary of paths to occurrence counts for files that contain domains matched
+    by the config bundle's domain regexes but are not in its domain substitution list.
+
+    domain_index is a DomainIndex
+    config_bundle is a config.ConfigBundle
+    """
+    return {
+        path: count for path, count in
+        domain_index.files_matching(config_bundle.domain_regex.search_regex).items()
+        if path not in config_bundle.domain_substitution
+    }
+
+def pattern_summary(domain_index, config_bundle):
+    """
+    Returns a list of tuples (pattern, file count, occurrence count) for every domain regex
+    of the config bundle.
+
+    domain_index is a DomainIndex
+    config_bundle is a config.ConfigBundle
+    """
+    summary = list()
+    for regex_pair in config_bundle.domain_regex.get_pairs():
+        file_counts = domain_index.files_matching(regex_pair.pattern)
+        summary.append((regex_pair.pattern.pattern, len(file_counts), sum(file_counts.values())))
+    return summary
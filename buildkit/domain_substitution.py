@@ -8,106 +8,982 @@
 Module for substituting domain names in buildspace tree with blockable strings.
 """
 
-from .common import ENCODING, BuildkitAbort, get_logger
-from .third_party import unidiff
+import codecs
+import collections
+import hashlib
+import itertools
+import json
+import re
+import shutil
+import time
+import zlib
+from pathlib import Path
+
+try:
+    from re import _parser as sre_parse # pylint: disable=no-name-in-module
+except ImportError:
+    import sre_parse # Python 3.10 and older
+
+from . import memory_profile, metrics, sharding, tracing
+from .common import (
+    ENCODING, STREAM_THRESHOLD, BuildkitAbort, FileWarnings, get_executor, get_logger)
+from .third_party.unidiff.constants import (
+    RE_HUNK_BODY_LINE, RE_HUNK_EMPTY_BODY_LINE, RE_HUNK_HEADER, RE_NO_NEWLINE_MARKER,
+    RE_SOURCE_FILENAME, RE_TARGET_FILENAME)
+from .third_party.unidiff.errors import UnidiffParseError
 
 # Encodings to try on buildspace tree files
 TREE_ENCODINGS = (ENCODING, 'ISO-8859-1')
 
-def substitute_domains_for_files(regex_iter, file_iter, log_warnings=True):
+# Constants for the domain substitution cache
+_CACHE_INDEX = 'index.json'
+_CACHE_ORIGINALS = 'originals'
+_CACHE_FORMAT_VERSION = 1
+
+# Constants for chunked file processing
+_CHUNK_SIZE = 1024 * 1024
+_MAX_ALPHABET_RANGE = 0x1000 # Larger character ranges are treated as matching anything
+
+# Regex pair that can be sent to worker processes
+_PlainRegexPair = collections.namedtuple('_PlainRegexPair', ('pattern', 'replacement'))
+
+# Metrics
+_TREE_FILES = metrics.counter(
+    'buildkit_substituted_files_total', 'Files with domains substituted', target='tree')
+_TREE_MATCHES = metrics.counter(
+    'buildkit_regex_matches_total', 'Domain regex matches substituted', target='tree')
+_PATCH_FILES = metrics.counter(
+    'buildkit_substituted_files_total', 'Files with domains substituted', target='patches')
+_PATCH_MATCHES = metrics.counter(
+    'buildkit_regex_matches_total', 'Domain regex matches substituted', target='patches')
+_PATCH_HUNKS = metrics.counter('buildkit_patch_hunks_total', 'Patch hunks processed')
+_SKIPPED_FILES = metrics.counter(
+    'buildkit_skipped_files_total', 'Files skipped because they were already processed',
+    stage='substitute')
+
+# Private definitions
+
+def _decode_file_bytes(file_bytes, path):
+    """
+    Returns a tuple of the decoded content of file_bytes and the encoding used
+
+    path is the pathlib.Path of the file, used for logging.
+
+    Raises BuildkitAbort if the bytes could not be decoded with any of TREE_ENCODINGS
+    """
+    for encoding in TREE_ENCODINGS:
+        try:
+            return file_bytes.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    get_logger().error('Unable to decode with any encoding: %s', path)
+    raise BuildkitAbort()
+
+def _substitute_content(regex_iter, content):
+    """Returns a tuple of the substituted content and the number of substitutions made"""
+    file_subs = 0
+    for regex_pair in regex_iter:
+        content, sub_count = regex_pair.pattern.subn(
+            regex_pair.replacement, content)
+        file_subs += sub_count
+    return content, file_subs
+
+def _get_digest(data):
+    """Returns the hex digest of the bytes-like object data used by the cache"""
+    return hashlib.sha256(data).hexdigest()
+
+def _read_chunks(file_obj):
+    """Yields chunks of _CHUNK_SIZE bytes from the binary file object file_obj"""
+    return iter(lambda: file_obj.read(_CHUNK_SIZE), b'')
+
+def _get_file_digest(path):
+    """Returns the hex digest of the file at path without reading it all into memory"""
+    hasher = hashlib.sha256()
+    with path.open('rb') as file_obj:
+        for chunk in _read_chunks(file_obj):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _get_regex_digest(regex_iter):
+    """Returns a digest identifying the set of regex pairs in regex_iter"""
+    return _get_digest('\n'.join(
+        '{}#{}'.format(x.pattern.pattern, x.replacement) for x in regex_iter).encode(ENCODING))
+
+def _get_pattern_alphabet(parsed_pattern, alphabet):
+    """
+    Adds the code points that parsed_pattern can match to the set alphabet.
+
+    parsed_pattern is the output of sre_parse.parse(), or a subpattern of it.
+
+    Returns False if the pattern can match an unbounded set of characters, or uses
+    constructs (anchors, lookarounds, backreferences) that depend on text outside of
+    the match; True otherwise.
+    """
+    for opcode, argument in parsed_pattern:
+        if opcode is sre_parse.LITERAL:
+            alphabet.add(argument)
+        elif opcode is sre_parse.IN:
+            for item_opcode, item_argument in argument:
+                if item_opcode is sre_parse.LITERAL:
+                    alphabet.add(item_argument)
+                elif item_opcode is sre_parse.RANGE:
+                    if item_argument[1] - item_argument[0] > _MAX_ALPHABET_RANGE:
+                        return False
+                    alphabet.update(range(item_argument[0], item_argument[1] + 1))
+                else:
+                    # NEGATE, CATEGORY, etc.
+                    return False
+        elif opcode in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            if not _get_pattern_alphabet(argument[2], alphabet):
+                return False
+        elif opcode is sre_parse.SUBPATTERN:
+            # The subpattern is always the last item of the argument
+            if not _get_pattern_alphabet(argument[-1], alphabet):
+                return False
+        elif opcode is sre_parse.BRANCH:
+            for branch in argument[1]:
+                if not _get_pattern_alphabet(branch, alphabet):
+                    return False
+        else:
+            # ANY, NOT_LITERAL, AT, ASSERT, ASSERT_NOT, GROUPREF, etc.
+            return False
+    return True
+
+def _get_split_regex(regex_iter):
+    """
+    Returns a compiled regex matching the characters at which file contents can be
+    split into chunks without changing the result of substitution, or None if there are
+    no such characters.
+
+    A character that none of the patterns can match can never be part of a match, nor
+    be removed by a replacement. Therefore, substituting the chunks that end right after
+    such a character yields the same output as substituting the whole file. This holds
+    regardless of how long a match can be, which matters since most domain regexes have
+    unbounded lazy groups.
+    """
+    alphabet = set()
+    for regex_pair in regex_iter:
+        if regex_pair.pattern.flags & re.IGNORECASE:
+            return None
+        if not _get_pattern_alphabet(sre_parse.parse(regex_pair.pattern.pattern), alphabet):
+            return None
+    if not alphabet:
+        return None
+    return re.compile('[^{}]'.format(''.join(re.escape(chr(x)) for x in sorted(alphabet))))
+
+def _find_split_point(split_regex, content):
+    """
+    Returns the index right after the last split character in content,
+    or 0 if there is none.
+    """
+    search_start = len(content)
+    window = 4096
+    while search_start > 0:
+        search_start = max(0, search_start - window)
+        last_match = None
+        for last_match in split_regex.finditer(content, search_start):
+            pass
+        if last_match:
+            return last_match.end()
+        window *= 2
+    return 0
+
+def _detect_file_encoding(path):
+    """
+    Returns a tuple of the first encoding in TREE_ENCODINGS that can decode the file at path,
+    and the hex digest of the file. The file is read in chunks.
+
+    Raises BuildkitAbort if the file could not be decoded with any of TREE_ENCODINGS
+    """
+    for encoding in TREE_ENCODINGS:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        hasher = hashlib.sha256()
+        try:
+            with path.open('rb') as file_obj:
+                for chunk in _read_chunks(file_obj):
+                    decoder.decode(chunk)
+                    hasher.update(chunk)
+                decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            continue
+        return encoding, hasher.hexdigest()
+    get_logger().error('Unable to decode with any encoding: %s', path)
+    raise BuildkitAbort()
+
+def _get_temp_path(path):
+    """Returns a path next to path for writing a replacement file"""
+    return path.with_name(path.name + '.buildkit-tmp')
+
+def _replace_file(temp_path, path):
+    """Replaces path with temp_path, keeping the permissions of path"""
+    shutil.copymode(str(path), str(temp_path))
+    temp_path.replace(path)
+
+def _substitute_file_streaming(regex_iter, path, split_regex, store_original):
+    """
+    Substitutes a file in chunks that end at a split character from split_regex.
+    Memory usage is bounded by _CHUNK_SIZE and the longest run of characters without
+    a split character.
+
+    Returns the same as _substitute_file().
+    """
+    encoding, orig_digest = _detect_file_encoding(path)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    encoder = codecs.getincrementalencoder(encoding)()
+    hasher = hashlib.sha256()
+    file_subs = 0
+    temp_path = _get_temp_path(path)
+
+    def _write_content(output_file, content, final=False):
+        nonlocal file_subs
+        content, sub_count = _substitute_content(regex_iter, content)
+        file_subs += sub_count
+        output_bytes = encoder.encode(content, final)
+        hasher.update(output_bytes)
+        output_file.write(output_bytes)
+
+    try:
+        with path.open('rb') as input_file, temp_path.open('wb') as output_file:
+            pending = ''
+            for chunk in _read_chunks(input_file):
+                pending += decoder.decode(chunk)
+                split_point = _find_split_point(split_regex, pending)
+                if split_point:
+                    _write_content(output_file, pending[:split_point])
+                    pending = pending[split_point:]
+            pending += decoder.decode(b'', final=True)
+            _write_content(output_file, pending, final=True)
+        if file_subs > 0:
+            if store_original:
+                store_original(orig_digest, path)
+            _replace_file(temp_path, path)
+            return file_subs, orig_digest, hasher.hexdigest()
+        return file_subs, orig_digest, orig_digest
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+def _substitute_file(regex_iter, path, split_regex, stream_threshold, store_original=None):
+    """
+    Runs domain substitution with regex_iter over the file at path
+
+    split_regex is the output of _get_split_regex() for regex_iter
+    stream_threshold is the file size in bytes above which the file is substituted in chunks.
+    If it is None, or split_regex is None, the whole file is always substituted at once.
+    store_original is a callable taking the digest of the original content and either the
+    original bytes or the pathlib.Path to the unmodified file. It is called before the file
+    is modified, and only if there were substitutions.
+
+    Returns a tuple of the number of substitutions, and the hex digests of the original
+    and resulting content.
+    Raises BuildkitAbort if the file could not be decoded.
+    """
+    if (split_regex is not None and stream_threshold is not None
+            and path.stat().st_size > stream_threshold):
+        return _substitute_file_streaming(regex_iter, path, split_regex, store_original)
+    with path.open(mode="r+b") as file_obj:
+        orig_bytes = file_obj.read()
+        orig_digest = _get_digest(orig_bytes)
+        content, encoding = _decode_file_bytes(orig_bytes, path)
+        content, file_subs = _substitute_content(regex_iter, content)
+        if file_subs > 0:
+            new_bytes = content.encode(encoding)
+            if store_original:
+                store_original(orig_digest, orig_bytes)
+            file_obj.seek(0)
+            file_obj.write(new_bytes)
+            file_obj.truncate()
+            return file_subs, orig_digest, _get_digest(new_bytes)
+        return file_subs, orig_digest, orig_digest
+
+class _SubstitutionCache:
+    """
+    Persistent record of the domain substitution applied to a buildspace tree.
+
+    For every file in the domain substitution list, it stores the digest of the original
+    content and the digest of the substituted content. The original content of each
+    substituted file is stored zlib-compressed and keyed by its digest, so substitution
+    can be reverted or redone without the source archives.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        cache_dir is a pathlib.Path to the cache directory. It does not need to exist.
+
+        Raises BuildkitAbort if the cache index exists but cannot be read.
+        """
+        self.cache_dir = cache_dir
+        self.regex_digest = None
+        # POSIX relative path -> [original digest, substituted digest]
+        self.files = dict()
+        index_path = cache_dir / _CACHE_INDEX
+        if index_path.exists():
+            try:
+                with index_path.open(encoding=ENCODING) as index_file:
+                    index = json.load(index_file)
+                if index['version'] != _CACHE_FORMAT_VERSION:
+                    raise ValueError('Unsupported cache version: {}'.format(index['version']))
+                self.regex_digest = index['regex_digest']
+                self.files = index['files']
+            except (ValueError, KeyError, TypeError):
+                get_logger().exception('Unable to read domain substitution cache: %s', index_path)
+                raise BuildkitAbort()
+
+    @property
+    def exists(self):
+        """Returns True if the cache index exists on disk; False otherwise"""
+        return (self.cache_dir / _CACHE_INDEX).exists()
+
+    def _original_path(self, digest):
+        return self.cache_dir / _CACHE_ORIGINALS / digest
+
+    def store_original(self, digest, source):
+        """
+        Stores the original content with the given digest if it is not already stored
+
+        source is either the bytes of the original content, or a pathlib.Path to a file
+        containing it.
+        """
+        original_path = self._original_path(digest)
+        if original_path.exists():
+            return
+        original_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = _get_temp_path(original_path)
+        compressor = zlib.compressobj()
+        with temp_path.open('wb') as original_file:
+            if isinstance(source, bytes):
+                original_file.write(compressor.compress(source))
+            else:
+                with source.open('rb') as source_file:
+                    for chunk in _read_chunks(source_file):
+                        original_file.write(compressor.compress(chunk))
+            original_file.write(compressor.flush())
+        temp_path.replace(original_path)
+
+    def restore_original(self, digest, path):
+        """
+        Replaces the file at path with the original content of the given digest.
+
+        Raises BuildkitAbort if the original is missing or corrupt.
+        """
+        temp_path = _get_temp_path(path)
+        decompressor = zlib.decompressobj()
+        hasher = hashlib.sha256()
+        try:
+            with self._original_path(digest).open('rb') as original_file, \
+                    temp_path.open('wb') as output_file:
+                for chunk in _read_chunks(original_file):
+                    output_bytes = decompressor.decompress(chunk)
+                    hasher.update(output_bytes)
+                    output_file.write(output_bytes)
+                output_bytes = decompressor.flush()
+                hasher.update(output_bytes)
+                output_file.write(output_bytes)
+            if hasher.hexdigest() != digest:
+                get_logger().error('Original file in cache is corrupt: %s', digest)
+                raise BuildkitAbort()
+            _replace_file(temp_path, path)
+        except (OSError, zlib.error):
+            get_logger().exception('Unable to read original file from cache: %s', digest)
+            raise BuildkitAbort()
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    def save(self):
+        """Writes the index and removes stored originals that are no longer referenced"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        index_path = self.cache_dir / _CACHE_INDEX
+        temp_path = _get_temp_path(index_path)
+        with temp_path.open('w', encoding=ENCODING) as index_file:
+            json.dump({
+                'version': _CACHE_FORMAT_VERSION,
+                'regex_digest': self.regex_digest,
+                'files': self.files,
+            }, index_file, sort_keys=True)
+        temp_path.replace(index_path)
+        originals_dir = self.cache_dir / _CACHE_ORIGINALS
+        if originals_dir.exists():
+            referenced = {orig for orig, sub in self.files.values() if orig != sub}
+            for original_path in originals_dir.iterdir():
+                if original_path.name not in referenced:
+                    original_path.unlink()
+
+    def delete(self):
+        """Removes the cache from disk"""
+        originals_dir = self.cache_dir / _CACHE_ORIGINALS
+        if originals_dir.exists():
+            for original_path in originals_dir.iterdir():
+                original_path.unlink()
+            originals_dir.rmdir()
+        index_path = self.cache_dir / _CACHE_INDEX
+        if index_path.exists():
+            index_path.unlink()
+        if not any(self.cache_dir.iterdir()):
+            self.cache_dir.rmdir()
+
+def _track_progress(resolved_tree, file_list, progress):
+    """
+    Yields the paths of the files in file_list that are not in the checkpoint.StageProgress
+    progress. Each file is recorded in progress once the next file is requested, i.e. after
+    it has been processed.
+    """
+    for relative_path in file_list:
+        if relative_path in progress:
+            _SKIPPED_FILES.add()
+            continue
+        yield resolved_tree / relative_path
+        progress.add(relative_path)
+
+def _restore_cached_file(cache, path, relative_path, file_warnings):
+    """
+    Restores the original content of a file recorded in the cache and drops its entry.
+    file_warnings is the common.FileWarnings to report files that are left alone.
+
+    Returns True if the file was restored or is already original; False if it was
+    left alone because it was modified after substitution or is missing.
+    """
+    orig_digest, sub_digest = cache.files[relative_path]
+    if not path.exists():
+        file_warnings.warn('File to revert does not exist: %s', path)
+        return False
+    disk_digest = _get_file_digest(path)
+    if disk_digest != orig_digest:
+        if disk_digest != sub_digest:
+            file_warnings.warn('File was modified after domain substitution: %s', path)
+            return False
+        cache.restore_original(orig_digest, path)
+    del cache.files[relative_path]
+    return True
+
+def _get_patched_file_path(source_file, target_file):
+    """Returns the path of a patched file like unidiff.PatchedFile.path"""
+    if source_file.startswith('a/') and target_file.startswith('b/'):
+        return source_file[2:]
+    if source_file.startswith('a/') and target_file == '/dev/null':
+        return source_file[2:]
+    if target_file.startswith('b/') and source_file == '/dev/null':
+        return target_file[2:]
+    return source_file
+
+def _substitute_hunk(regex_iter, header_match, line_iter, substitute, output):
+    """
+    Consumes the lines of a hunk from line_iter and appends them to the list output,
+    with domain substitution applied if substitute is True.
+
+    Returns the number of substitutions made.
+    Raises UnidiffParseError if the hunk is malformed.
+    """
+    source_start, source_length, target_start, target_length, section_header = (
+        header_match.groups())
+    source_line_no = int(source_start)
+    target_line_no = int(target_start)
+    source_length = 1 if source_length is None else int(source_length)
+    target_length = 1 if target_length is None else int(target_length)
+    expected_source_end = source_line_no + source_length
+    expected_target_end = target_line_no + target_length
+    output.append('@@ -%d,%d +%d,%d @@%s\n' % (
+        source_line_no, source_length, target_line_no, target_length,
+        ' ' + section_header if section_header else ''))
+    hunk_subs = 0
+    for line in line_iter:
+        valid_line = RE_HUNK_EMPTY_BODY_LINE.match(line) or RE_HUNK_BODY_LINE.match(line)
+        if not valid_line:
+            raise UnidiffParseError('Hunk diff line expected: %s' % line)
+        line_type = valid_line.group('line_type') or ' '
+        value = valid_line.group('value')
+        if line_type == '+':
+            target_line_no += 1
+        elif line_type == '-':
+            source_line_no += 1
+        elif line_type == ' ':
+            source_line_no += 1
+            target_line_no += 1
+        if source_line_no > expected_source_end or target_line_no > expected_target_end:
+            raise UnidiffParseError('Hunk is longer than expected')
+        if substitute:
+            value, line_subs = _substitute_content(regex_iter, value)
+            hunk_subs += line_subs
+        output.append(line_type + value)
+        if source_line_no == expected_source_end and target_line_no == expected_target_end:
+            break
+    if source_line_no < expected_source_end or target_line_no < expected_target_end:
+        raise UnidiffParseError('Hunk is shorter than expected')
+    return hunk_subs
+
+def _substitute_patch(regex_iter, file_set, patch_path):
+    """
+    Runs domain substitution over the sections of the unified diff at patch_path that patch
+    files in file_set, in a single pass over its lines.
+
+    The patch is rewritten only if there were substitutions. The output is identical to
+    parsing and serializing it with unidiff.PatchSet, including its normalization of hunk
+    headers and blank hunk lines, and its omission of text after the last hunk.
+
+    Returns the number of substitutions made.
+    Raises UnidiffParseError if the unified diff could not be parsed.
+    """
+    output = list()
+    patch_subs = 0
+    hunk_count = 0
+    patch_info = None
+    source_file = source_timestamp = None
+    current_file = None # Tuple of whether to substitute, and the number of hunks
+    with patch_path.open(encoding=ENCODING) as file_obj:
+        line_iter = iter(file_obj)
+        for line in line_iter:
+            source_match = RE_SOURCE_FILENAME.match(line)
+            if source_match:
+                source_file = source_match.group('filename')
+                source_timestamp = source_match.group('timestamp')
+                current_file = None
+                continue
+            target_match = RE_TARGET_FILENAME.match(line)
+            if target_match:
+                if current_file is not None or source_file is None:
+                    raise UnidiffParseError('Target without source: %s' % line)
+                target_file = target_match.group('filename')
+                target_timestamp = target_match.group('timestamp')
+                if patch_info:
+                    output.extend(patch_info)
+                output.append('--- %s%s\n' % (
+                    source_file, '\t' + source_timestamp if source_timestamp else ''))
+                output.append('+++ %s%s\n' % (
+                    target_file, '\t' + target_timestamp if target_timestamp else ''))
+                current_file = [
+                    _get_patched_file_path(source_file, target_file) in file_set, 0]
+                patch_info = None
+                continue
+            hunk_match = RE_HUNK_HEADER.match(line)
+            if hunk_match:
+                if current_file is None:
+                    raise UnidiffParseError('Unexpected hunk found: %s' % line)
+                patch_subs += _substitute_hunk(
+                    regex_iter, hunk_match, line_iter, current_file[0], output)
+                current_file[1] += 1
+                hunk_count += 1
+                continue
+            if RE_NO_NEWLINE_MARKER.match(line):
+                if current_file is None or not current_file[1]:
+                    raise UnidiffParseError('Unexpected marker: %s' % line)
+                output.append('\\ No newline at end of file\n')
+                continue
+            if line == '\n' and current_file is not None:
+                if not current_file[1]:
+                    raise UnidiffParseError('Unexpected trailing newline character')
+                output.append(line)
+                continue
+            if patch_info is None:
+                current_file = None
+                patch_info = list()
+            patch_info.append(line)
+    _PATCH_HUNKS.add(hunk_count)
+    if patch_subs > 0:
+        with patch_path.open('w', encoding=ENCODING) as file_obj:
+            file_obj.write(''.join(output))
+        _PATCH_FILES.add()
+        _PATCH_MATCHES.add(patch_subs)
+    return patch_subs
+
+@tracing.traced()
+def _substitute_patches_worker(regex_pairs, file_set, patch_paths):
+    """
+    Runs _substitute_patch() over patch_paths in a worker process.
+
+    regex_pairs is a tuple of (compiled pattern, replacement) tuples.
+
+    Returns a list of tuples of the patch path and its number of substitutions, or
+    None and the parsing error message if it could not be parsed.
+    """
+    regex_iter = tuple(_PlainRegexPair(*x) for x in regex_pairs)
+    results = list()
+    for patch_path in patch_paths:
+        try:
+            with tracing.file_span(patch_path, category='substitute'):
+                file_subs = _substitute_patch(regex_iter, file_set, patch_path)
+            results.append((patch_path, file_subs))
+        except UnidiffParseError as exc:
+            results.append((patch_path, None, str(exc)))
+    return results
+
+def _substitute_tree_shard(parameters, relative_paths, heartbeat):
+    """
+    Task function of sharding.run_job() that substitutes a shard of the buildspace tree.
+
+    parameters is a dictionary with the keys 'regex_pairs' (a list of lists of the pattern,
+    its flags and the replacement), 'tree' (the resolved buildspace tree path) and
+    'stream_threshold'.
+
+    Returns a list of the number of substitutions of each file.
+    """
+    regex_iter = tuple(
+        _PlainRegexPair(re.compile(pattern, flags), replacement)
+        for pattern, flags, replacement in parameters['regex_pairs'])
+    split_regex = _get_split_regex(regex_iter)
+    resolved_tree = Path(parameters['tree'])
+    results = list()
+    for relative_path in relative_paths:
+        path = resolved_tree / relative_path
+        with tracing.file_span(path, category='substitute'):
+            file_subs, _, _ = _substitute_file(
+                regex_iter, path, split_regex, parameters['stream_threshold'])
+        results.append(file_subs)
+        heartbeat()
+    return results
+
+# Task functions for sharding.run_worker()
+SHARD_TASKS = {
+    'substitute_tree': _substitute_tree_shard,
+}
+
+class _ProfiledPattern:
+    """
+    Wrapper of a compiled regex that records the cost and hits of subn() into a stats dict.
+    Other attributes are passed through to the compiled regex.
+    """
+
+    def __init__(self, pattern, stats):
+        self._pattern = pattern
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._pattern, name)
+
+    def subn(self, repl, string, count=0):
+        """Same as re.Pattern.subn(), but records the time taken, bytes scanned and matches"""
+        start_time = time.perf_counter()
+        result = self._pattern.subn(repl, string, count)
+        self._stats['seconds'] += time.perf_counter() - start_time
+        self._stats['calls'] += 1
+        # The text is measured in UTF-8 after the timing, since only decoded text is scanned
+        self._stats['bytes_scanned'] += len(string.encode(ENCODING, errors='surrogatepass'))
+        self._stats['matches'] += result[1]
+        return result
+
+# Public definitions
+
+class SubstitutionProfile:
+    """
+    Records the wall time, bytes scanned, and matches of every regex pair, and the
+    wall time, size, and substitutions of every file during domain substitution.
+    Bytes scanned are counted in the UTF-8 encoding of the decoded text, so they can exceed
+    the size of files decoded as ISO-8859-1.
+
+    Pass an instance to the profile argument of the substitution functions.
+    """
+
+    def __init__(self):
+        self._regex_stats = collections.OrderedDict()
+        self._file_stats = list()
+
+    def wrap_pairs(self, regex_iter):
+        """
+        Returns a tuple of the regex pairs in regex_iter with patterns that record into
+        this profile. Pairs with the same pattern and replacement share their records.
+        """
+        wrapped_pairs = list()
+        for regex_pair in regex_iter:
+            key = (regex_pair.pattern.pattern, regex_pair.replacement)
+            stats = self._regex_stats.setdefault(key, {
+                'pattern': key[0],
+                'replacement': key[1],
+                'seconds': 0.0,
+                'calls': 0,
+                'bytes_scanned': 0,
+                'matches': 0,
+            })
+            wrapped_pairs.append(regex_pair._replace(
+                pattern=_ProfiledPattern(regex_pair.pattern, stats)))
+        return tuple(wrapped_pairs)
+
+    def record_file(self, path, seconds, size, substitutions):
+        """Records the processing of a file or patch at path"""
+        self._file_stats.append({
+            'path': str(path),
+            'seconds': seconds,
+            'size': size,
+            'substitutions': substitutions,
+        })
+
+    @property
+    def regex_stats(self):
+        """Returns a list of dictionaries of stats per regex pair, slowest first"""
+        return sorted(self._regex_stats.values(), key=lambda x: x['seconds'], reverse=True)
+
+    @property
+    def file_stats(self):
+        """Returns a list of dictionaries of stats per file, slowest first"""
+        return sorted(self._file_stats, key=lambda x: x['seconds'], reverse=True)
+
+    def report(self, file_limit=10):
+        """
+        Returns a human-readable report of the regex pairs and the slowest files
+
+        file_limit is the maximum number of files to include.
+        """
+        lines = ['{:>9} {:>7} {:>14} {:>9}  {}'.format(
+            'Seconds', 'Share', 'Bytes scanned', 'Matches', 'Pattern')]
+        total_seconds = sum(x['seconds'] for x in self._regex_stats.values()) or 1.0
+        for stats in self.regex_stats:
+            lines.append('{:>9.3f} {:>7.1%} {:>14,d} {:>9,d}  {}'.format(
+                stats['seconds'], stats['seconds'] / total_seconds, stats['bytes_scanned'],
+                stats['matches'], stats['pattern']))
+        if self._file_stats:
+            lines.append('')
+            lines.append('{:>9} {:>14} {:>13}  {}'.format(
+                'Seconds', 'Bytes', 'Substitutions', 'File'))
+            for stats in self.file_stats[:file_limit]:
+                lines.append('{:>9.3f} {:>14,d} {:>13,d}  {}'.format(
+                    stats['seconds'], stats['size'], stats['substitutions'], stats['path']))
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        """Writes all stats as JSON to the pathlib.Path path"""
+        with path.open('w', encoding=ENCODING) as json_file:
+            json.dump({'regex': self.regex_stats, 'files': self.file_stats}, json_file, indent=1)
+
+@tracing.traced()
+def substitute_domains_for_files(regex_iter, file_iter, log_warnings=True,
+                                 stream_threshold=STREAM_THRESHOLD, profile=None):
     """
     Runs domain substitution with regex_iter over files from file_iter
 
     regex_iter is an iterable of pattern and replacement regex pair tuples
     file_iter is an iterable of pathlib.Path to files that are to be domain substituted
     log_warnings indicates if a warning is logged when a file has no matches.
+    stream_threshold is the file size in bytes above which files are substituted in
+    chunks to bound memory usage. The output is identical either way. If it is None,
+    files are always read whole.
+    profile is a SubstitutionProfile to record into, or None to disable profiling.
     """
-    encoding = None # To satisfy pylint undefined-loop-variable warning
-    for path in file_iter:
-        with path.open(mode="r+b") as file_obj:
-            file_bytes = file_obj.read()
-            content = None
-            for encoding in TREE_ENCODINGS:
-                try:
-                    content = file_bytes.decode(encoding)
-                    break
-                except UnicodeDecodeError:
-                    continue
-            if not content:
-                get_logger().error('Unable to decode with any encoding: %s', path)
-                raise BuildkitAbort()
-            file_subs = 0
-            for regex_pair in regex_iter:
-                content, sub_count = regex_pair.pattern.subn(
-                    regex_pair.replacement, content)
-                file_subs += sub_count
-            if file_subs > 0:
-                file_obj.seek(0)
-                file_obj.write(content.encode(encoding))
-                file_obj.truncate()
-            elif log_warnings:
-                get_logger().warning('File has no matches: %s', path)
-
-def substitute_domains_in_patches(regex_iter, file_set, patch_iter, log_warnings=False):
+    regex_iter = tuple(regex_iter)
+    split_regex = _get_split_regex(regex_iter)
+    if profile:
+        regex_iter = profile.wrap_pairs(regex_iter)
+    with FileWarnings() as file_warnings:
+        for path in file_iter:
+            start_time = time.perf_counter()
+            with tracing.file_span(path, category='substitute'):
+                file_subs, _, _ = _substitute_file(
+                    regex_iter, path, split_regex, stream_threshold)
+            if file_subs:
+                _TREE_FILES.add()
+                _TREE_MATCHES.add(file_subs)
+            if profile:
+                profile.record_file(
+                    path, time.perf_counter() - start_time, path.stat().st_size, file_subs)
+            if not file_subs and log_warnings:
+                file_warnings.warn('File has no matches: %s', path)
+
+@tracing.traced()
+def substitute_domains_incremental(regex_iter, resolved_tree, file_iter, cache_dir, #pylint: disable=too-many-arguments
+                                   log_warnings=True, stream_threshold=STREAM_THRESHOLD,
+                                   profile=None, progress=None):
+    """
+    Runs domain substitution like substitute_domains_for_files(), but records the result
+    in a cache so that later runs only process files whose inputs changed.
+
+    A file is skipped when its current content is the substituted content recorded in
+    the cache and the set of regex pairs is unchanged. When the regex pairs change, the
+    original content is restored from the cache and substituted again. Files that were
+    modified outside of buildkit are treated as new originals. Files that are no longer
+    in file_iter are restored to their original content.
+
+    regex_iter is an iterable of pattern and replacement regex pair tuples
+    resolved_tree is the resolved pathlib.Path to the buildspace tree
+    file_iter is an iterable of POSIX path strings relative to resolved_tree
+    cache_dir is a pathlib.Path to the cache directory. It is created if it does not exist.
+    log_warnings indicates if a warning is logged when a file has no matches.
+    stream_threshold is the same as in substitute_domains_for_files()
+    profile is a SubstitutionProfile to record into, or None to disable profiling.
+    Files skipped because of the cache are not recorded.
+    progress is a checkpoint.StageProgress to record processed and skipped files into, or
+    None. Unlike substitute_domains_for_files(), files are not skipped because they are in
+    progress, since the cache already records which files are done.
+
+    Raises BuildkitAbort if the cache is unusable or a file could not be decoded.
+    """
+    logger = get_logger()
+    regex_iter = tuple(regex_iter)
+    split_regex = _get_split_regex(regex_iter)
+    cache = _SubstitutionCache(cache_dir)
+    regex_digest = _get_regex_digest(regex_iter)
+    if profile:
+        regex_iter = profile.wrap_pairs(regex_iter)
+    regex_changed = cache.regex_digest != regex_digest
+    if cache.exists and regex_changed:
+        logger.info('Domain regex pairs changed; previously substituted files will be redone')
+    wanted_files = list(file_iter)
+    skipped = substituted = restored = 0
+    file_warnings = FileWarnings()
+    try:
+        for relative_path in sorted(set(cache.files) - set(wanted_files)):
+            if _restore_cached_file(
+                    cache, resolved_tree / relative_path, relative_path, file_warnings):
+                restored += 1
+        cache.regex_digest = regex_digest
+        for relative_path in wanted_files:
+            path = resolved_tree / relative_path
+            entry = cache.files.get(relative_path)
+            if entry:
+                disk_digest = _get_file_digest(path)
+                if disk_digest == entry[1]:
+                    # File is in the state left by the last run
+                    if not regex_changed:
+                        skipped += 1
+                        _SKIPPED_FILES.add()
+                        if progress is not None:
+                            progress.add(relative_path)
+                        continue
+                    if entry[0] != disk_digest:
+                        cache.restore_original(entry[0], path)
+            start_time = time.perf_counter()
+            with tracing.file_span(path, category='substitute'):
+                file_subs, orig_digest, new_digest = _substitute_file(
+                    regex_iter, path, split_regex, stream_threshold,
+                    store_original=cache.store_original)
+            if file_subs:
+                _TREE_FILES.add()
+                _TREE_MATCHES.add(file_subs)
+            if profile:
+                profile.record_file(
+                    path, time.perf_counter() - start_time, path.stat().st_size, file_subs)
+            if not file_subs and log_warnings:
+                file_warnings.warn('File has no matches: %s', path)
+            cache.files[relative_path] = [orig_digest, new_digest]
+            substituted += 1
+            if progress is not None:
+                progress.add(relative_path)
+    finally:
+        file_warnings.flush()
+        cache.save()
+    logger.info(
+        'Domain substitution: %s files processed, %s unchanged, %s restored',
+        substituted, skipped, restored)
+
+@tracing.traced()
+def revert_substitution(resolved_tree, cache_dir):
+    """
+    Reverts domain substitution on a buildspace tree using its domain substitution cache.
+    The cache is deleted once all files have been reverted.
+
+    resolved_tree is the resolved pathlib.Path to the buildspace tree
+    cache_dir is a pathlib.Path to the cache directory.
+
+    Raises FileNotFoundError if the cache does not exist.
+    Raises BuildkitAbort if some files could not be reverted; they are kept in the cache.
+    """
+    cache = _SubstitutionCache(cache_dir)
+    if not cache.exists:
+        raise FileNotFoundError(cache_dir / _CACHE_INDEX)
+    failed = 0
+    file_warnings = FileWarnings()
+    try:
+        for relative_path in sorted(cache.files):
+            if not _restore_cached_file(
+                    cache, resolved_tree / relative_path, relative_path, file_warnings):
+                failed += 1
+    finally:
+        file_warnings.flush()
+        if cache.files:
+            cache.save()
+        else:
+            cache.delete()
+    if failed:
+        get_logger().error('%s files could not be reverted', failed)
+        raise BuildkitAbort()
+
+@tracing.traced()
+def substitute_domains_in_patches(regex_iter, file_set, patch_iter, log_warnings=False,
+                                  profile=None, executor=None):
     """
     Runs domain substitution over sections of the given unified diffs patching the given files.
 
     regex_iter is an iterable of tuples containing the compiled search regex followed by
         the replacement regex.
-    file_set is the set of files as strings that should have domain substitution
-        applied to their sections.
+    file_set is a container (e.g. a set or a picklable config.PathListConfigFile) of files
+        as strings that should have domain substitution applied to their sections.
     patch_iter is an iterable that returns pathlib.Path to patches that should be
         checked and substituted.
     log_warnings indicates if a warning is logged when no substitutions are performed
+    profile is a SubstitutionProfile to record into, or None to disable profiling.
+        Profiling processes patches serially.
+    executor is the common.Executor to run workers with. Defaults to the shared executor
+        from common.get_executor().
 
     Raises BuildkitAbort if a unified diff could not be parsed.
     """
-    for patch_path in patch_iter:
-        with patch_path.open('r+', encoding=ENCODING) as file_obj:
+    patch_paths = list(patch_iter)
+    if executor is None:
+        executor = get_executor()
+    if profile or executor.jobs == 1 or len(patch_paths) < 2:
+        regex_iter = profile.wrap_pairs(regex_iter) if profile else tuple(regex_iter)
+        results = list()
+        for patch_path in patch_paths:
+            start_time = time.perf_counter()
             try:
-                patchset = unidiff.PatchSet(file_obj.read())
-            except unidiff.errors.UnidiffParseError:
-                get_logger().exception('Could not parse patch: %s', patch_path)
+                with tracing.file_span(patch_path, category='substitute'):
+                    file_subs = _substitute_patch(regex_iter, file_set, patch_path)
+            except UnidiffParseError as exc:
+                results.append((patch_path, None, str(exc)))
+                break
+            if profile:
+                profile.record_file(
+                    patch_path, time.perf_counter() - start_time, patch_path.stat().st_size,
+                    file_subs)
+            results.append((patch_path, file_subs))
+    else:
+        regex_pairs = tuple((x.pattern, x.replacement) for x in regex_iter)
+        # Patches are split into one group per job to limit pickling of the arguments
+        groups = min(executor.jobs, len(patch_paths))
+        results_by_path = dict()
+        for group_results in executor.map(
+                _substitute_patches_worker, itertools.repeat(regex_pairs, groups),
+                itertools.repeat(file_set, groups),
+                (patch_paths[index::groups] for index in range(groups))):
+            results_by_path.update((x[0], x) for x in group_results)
+        results = [results_by_path[x] for x in patch_paths]
+    with FileWarnings() as file_warnings:
+        for result in results:
+            if result[1] is None:
+                get_logger().error('Could not parse patch %s: %s', result[0], result[2])
                 raise BuildkitAbort()
-            file_subs = 0
-            for patchedfile in patchset:
-                if patchedfile.path not in file_set:
-                    continue
-                for regex_pair in regex_iter:
-                    for hunk in patchedfile:
-                        for line in hunk:
-                            line.value, sub_count = regex_pair.pattern.subn(
-                                regex_pair.replacement, line.value)
-                            file_subs += sub_count
-            if file_subs > 0:
-                file_obj.seek(0)
-                file_obj.write(str(patchset))
-                file_obj.truncate()
-            elif log_warnings:
-                get_logger().warning('Patch "%s" has no matches', patch_path)
-
-def process_bundle_patches(config_bundle, invert=False):
+            if not result[1] and log_warnings:
+                file_warnings.warn('Patch has no matches: %s', result[0])
+
+def process_bundle_patches(config_bundle, invert=False, profile=None, executor=None):
     """
     Substitute domains in config bundle patches
 
     config_bundle is a config.ConfigBundle that will have its patches modified.
     invert specifies if domain substitution should be inverted
+    profile is a SubstitutionProfile to record into, or None to disable profiling.
+    executor is the same as in substitute_domains_in_patches()
 
     Raises NotADirectoryError if the patches directory is not a directory or does not exist
     If invert=True, raises ValueError if a regex pair isn't invertible.
     If invert=True, may raise undetermined exceptions during regex pair inversion
     """
-    substitute_domains_in_patches(
-        config_bundle.domain_regex.get_pairs(invert=invert),
-        set(config_bundle.domain_substitution),
-        config_bundle.patches.patch_iter())
+    with memory_profile.stage('substitute patches'):
+        substitute_domains_in_patches(
+            config_bundle.domain_regex.get_pairs(invert=invert),
+            config_bundle.domain_substitution,
+            config_bundle.patches.patch_iter(), profile=profile, executor=executor)
 
-def process_tree_with_bundle(config_bundle, buildspace_tree):
+def process_tree_with_bundle(config_bundle, buildspace_tree, cache_dir=None, #pylint: disable=too-many-arguments
+                             stream_threshold=STREAM_THRESHOLD, profile=None, progress=None):
     """
     Substitute domains in buildspace_tree with files and substitutions from config_bundle
 
     config_bundle is a config.ConfigBundle
     buildspace_tree is a pathlib.Path to the buildspace tree.
+    cache_dir is a pathlib.Path to the domain substitution cache directory, or None to
+    substitute without a cache. See substitute_domains_incremental() for details.
+    stream_threshold is the same as in substitute_domains_for_files()
+    profile is a SubstitutionProfile to record into, or None to disable profiling.
+    progress is a checkpoint.StageProgress to record substituted files into, or None.
+    Without a cache, files it already contains are not substituted again. With a cache, the
+    cache decides which files to substitute again; see substitute_domains_incremental().
 
     Raises NotADirectoryError if the patches directory is not a directory or does not exist
     Raises FileNotFoundError if the buildspace tree does not exist.
@@ -115,6 +991,62 @@ def process_tree_with_bundle(config_bundle, buildspace_tree):
     if not buildspace_tree.exists():
         raise FileNotFoundError(buildspace_tree)
     resolved_tree = buildspace_tree.resolve()
-    substitute_domains_for_files(
-        config_bundle.domain_regex.get_pairs(),
-        map(lambda x: resolved_tree / x, config_bundle.domain_substitution))
+    file_list = config_bundle.domain_substitution.expand(resolved_tree)
+    with memory_profile.stage('substitute tree'):
+        if cache_dir is not None:
+            substitute_domains_incremental(
+                config_bundle.domain_regex.get_pairs(), resolved_tree,
+                file_list, cache_dir, stream_threshold=stream_threshold,
+                profile=profile, progress=progress)
+            return
+        if progress is None:
+            file_iter = map(lambda x: resolved_tree / x, file_list)
+        else:
+            file_iter = _track_progress(resolved_tree, file_list, progress)
+        substitute_domains_for_files(
+            config_bundle.domain_regex.get_pairs(), file_iter,
+            stream_threshold=stream_threshold, profile=profile)
+
+def process_tree_sharded(config_bundle, buildspace_tree, job_dir=None, local_workers=None, #pylint: disable=too-many-arguments
+                         stream_threshold=STREAM_THRESHOLD, progress=None):
+    """
+    Substitute domains in buildspace_tree like process_tree_with_bundle() without a cache,
+    as a job of sharding.run_job(). Workers on other hosts can join the job by running
+    sharding.run_worker() on job_dir with SHARD_TASKS; the buildspace tree must be at the
+    same resolved path on their hosts.
+
+    job_dir and local_workers are the same as in sharding.run_job()
+    stream_threshold is the same as in substitute_domains_for_files()
+    progress is a checkpoint.StageProgress, or None. Files it contains are not substituted
+    again, and files are recorded in it once the whole job has finished.
+
+    Raises FileNotFoundError if the buildspace tree does not exist.
+    Raises FileExistsError if job_dir is not empty.
+    Raises BuildkitAbort if a shard failed.
+    """
+    if not buildspace_tree.exists():
+        raise FileNotFoundError(buildspace_tree)
+    resolved_tree = buildspace_tree.resolve()
+    file_list = config_bundle.domain_substitution.expand(resolved_tree)
+    if progress is not None:
+        _SKIPPED_FILES.add(sum(1 for x in file_list if x in progress))
+        file_list = [x for x in file_list if x not in progress]
+    parameters = {
+        'regex_pairs': [[x.pattern.pattern, x.pattern.flags, x.replacement]
+                        for x in config_bundle.domain_regex.get_pairs()],
+        'tree': str(resolved_tree),
+        'stream_threshold': stream_threshold,
+    }
+    with memory_profile.stage('substitute tree'):
+        results = sharding.run_job(
+            'substitute_tree', _substitute_tree_shard, parameters, file_list, job_dir=job_dir,
+            local_workers=local_workers)
+    with FileWarnings() as file_warnings:
+        for relative_path, file_subs in zip(file_list, results):
+            if file_subs:
+                _TREE_FILES.add()
+                _TREE_MATCHES.add(file_subs)
+            else:
+                file_warnings.warn('File has no matches: %s', resolved_tree / relative_path)
+            if progress is not None:
+                progress.add(relative_path)
@@ -0,0 +1,216 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for materializing copies of files, such as exported patches and packaging files.
+
+A file is materialized with the cheapest method supported by the filesystem, in this order:
+reflink (copy-on-write clone), hardlink (only when allowed by the caller), in-kernel copy
+(copy_file_range or sendfile), and a regular copy.
+"""
+
+import collections
+import errno
+import filecmp
+import os
+import shutil
+import sys
+
+from pathlib import Path
+
+from .common import get_logger, ensure_empty_dir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Not available on Windows
+
+# Constants
+
+METHOD_REFLINK = 'reflink'
+METHOD_HARDLINK = 'hardlink'
+METHOD_KERNEL_COPY = 'kernel_copy'
+METHOD_COPY = 'copy'
+
+_FICLONE = 0x40049409 # From linux/fs.h
+
+# Errors indicating that a method is not supported for the files
+_UNSUPPORTED_ERRNOS = frozenset(filter(None, (
+    errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EPERM, errno.ENOTTY,
+    errno.EXDEV, errno.EMLINK, getattr(errno, 'ENOTSUP', None))))
+
+# Private definitions
+
+def _copy_file_range(source_fd, destination_fd, offset, count):
+    return os.copy_file_range(source_fd, destination_fd, count, offset, offset) #pylint: disable=no-member
+
+def _sendfile(source_fd, destination_fd, offset, count):
+    return os.sendfile(destination_fd, source_fd, offset, count) #pylint: disable=no-member
+
+_KERNEL_COPY_FUNCS = tuple(
+    copy_func for name, copy_func in (
+        ('copy_file_range', _copy_file_range), ('sendfile', _sendfile))
+    if hasattr(os, name) and sys.platform.startswith('linux'))
+
+def _reflink(source_fd, destination_fd):
+    """Returns True if the destination was cloned from the source; False if unsupported"""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(destination_fd, _FICLONE, source_fd)
+    except OSError as exc:
+        if exc.errno in _UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+def _kernel_copy(source_fd, destination_fd, size):
+    """Returns True if the data was copied in the kernel; False if unsupported"""
+    for copy_func in _KERNEL_COPY_FUNCS:
+        offset = 0
+        try:
+            while offset < size:
+                copied = copy_func(source_fd, destination_fd, offset, size - offset)
+                if not copied:
+                    break # The source was truncated
+                offset += copied
+        except OSError as exc:
+            if offset or exc.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            continue
+        return True
+    return False
+
+def _hardlink(source, destination):
+    """Returns True if the destination was hardlinked to the source; False if unsupported"""
+    try:
+        os.link(str(source), str(destination))
+    except OSError as exc:
+        if exc.errno in _UNSUPPORTED_ERRNOS:
+            return False
+        raise
+    return True
+
+# Public definitions
+
+def materialize_file(source, destination, allow_hardlink=False, copy_mode=False):
+    """
+    Creates destination as a copy of the regular file source, replacing any existing file.
+    The modification time of the source is preserved.
+
+    source and destination are pathlib.Path
+    allow_hardlink indicates if destination can be a hardlink of source. This must only be
+    used if neither file will be modified in place.
+    copy_mode indicates if the permission bits are copied, like shutil.copy()
+
+    Returns the method used, one of the METHOD_* constants.
+    Raises FileNotFoundError if source or the parent directory of destination does not exist.
+    """
+    if destination.is_symlink() or destination.exists():
+        # Never write through an existing hardlink or symlink
+        destination.unlink()
+    if allow_hardlink and _hardlink(source, destination):
+        return METHOD_HARDLINK
+    source_stat = source.stat()
+    with source.open('rb') as source_file, destination.open('wb') as destination_file:
+        if _reflink(source_file.fileno(), destination_file.fileno()):
+            method = METHOD_REFLINK
+        elif _kernel_copy(source_file.fileno(), destination_file.fileno(), source_stat.st_size):
+            method = METHOD_KERNEL_COPY
+        else:
+            shutil.copyfileobj(source_file, destination_file)
+            method = METHOD_COPY
+    if copy_mode:
+        shutil.copymode(str(source), str(destination))
+    os.utime(str(destination), ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    return method
+
+def files_match(source, destination):
+    """
+    Returns True if destination is a regular file with the same content as source;
+    False otherwise. Files of the same size are compared byte by byte, since exported files
+    may keep the modification time of their source while their content differs.
+    """
+    if destination.is_symlink() or not destination.is_file():
+        return False
+    return filecmp.cmp(str(source), str(destination), shallow=False)
+
+class DirectoryExport:
+    """
+    Materializes files into a directory. When updating an existing directory incrementally,
+    files that already match are skipped, and files that were not exported are removed.
+    """
+
+    def __init__(self, path, incremental=False, allow_hardlink=False):
+        """
+        path is a pathlib.Path to the directory to export into.
+        incremental indicates if an existing directory is updated. Otherwise, the directory
+        must be empty or not exist.
+        allow_hardlink is the same as in materialize_file()
+
+        Raises FileExistsError if incremental is False and the directory is not empty.
+        Raises FileNotFoundError if the parent directories for path do not exist.
+        """
+        if incremental:
+            path.mkdir(exist_ok=True)
+        else:
+            ensure_empty_dir(path)
+        self.path = path
+        self.incremental = incremental
+        self.allow_hardlink = allow_hardlink
+        # Counts of files per materialization method, and 'unchanged' files
+        self.counts = collections.Counter()
+        self._exported = set()
+
+    def add_file(self, source, relative_path, copy_mode=False):
+        """
+        Materializes the file source at relative_path in the export.
+
+        source is a pathlib.Path to a regular file
+        relative_path is a pathlib.Path relative to the export directory
+        copy_mode is the same as in materialize_file()
+        """
+        destination = self.path / relative_path
+        self._exported.add(destination)
+        if self.incremental and files_match(source, destination):
+            self.counts['unchanged'] += 1
+            return
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        self.counts[materialize_file(
+            source, destination, allow_hardlink=self.allow_hardlink, copy_mode=copy_mode)] += 1
+
+    def add_written(self, relative_path):
+        """
+        Marks a file that was written into the export by other means (e.g. a generated file)
+        so that it is not removed by finish()
+        """
+        self._exported.add(self.path / relative_path)
+
+    def finish(self):
+        """
+        Removes files and empty directories that were not exported, if the export is
+        incremental.
+
+        Returns the counts of files per materialization method, with 'unchanged' and 'removed'
+        files.
+        """
+        if self.incremental:
+            for dir_path, dir_names, file_names in os.walk(str(self.path), topdown=False):
+                for name in file_names:
+                    file_path = Path(dir_path, name)
+                    if file_path not in self._exported:
+                        file_path.unlink()
+                        self.counts['removed'] += 1
+                for name in dir_names:
+                    subdir_path = Path(dir_path, name)
+                    if subdir_path.is_symlink():
+                        if subdir_path not in self._exported:
+                            subdir_path.unlink()
+                            self.counts['removed'] += 1
+                    elif not any(subdir_path.iterdir()):
+                        subdir_path.rmdir()
+        get_logger().debug('Exported files to %s: %s', self.path, dict(self.counts))
+        return self.counts
@@ -0,0 +1,338 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for removing many files from the buildspace tree quickly.
+
+Files are grouped by their parent directory. Each directory is opened once, and its files
+are unlinked relative to the directory's file descriptor, which saves resolving the full
+path of every file. Directories are processed in parallel in the I/O-bound pool of
+common.Executor, since unlinking mostly waits on the filesystem.
+
+Whole trees are deleted by renaming them aside first, so that a new tree can be created
+at the same path while the old one is deleted in the background.
+"""
+
+import collections
+import os
+import threading
+import time
+import uuid
+
+from .common import BuildkitAbort, Executor, FileWarnings, get_executor, get_logger
+
+# Constants
+
+# Indicates if files can be unlinked relative to a directory file descriptor
+_DIR_FD_SUPPORTED = os.unlink in os.supports_dir_fd and hasattr(os, 'O_DIRECTORY')
+
+# Indicates if directories can be listed from a file descriptor (Python 3.7+)
+_SCANDIR_FD_SUPPORTED = _DIR_FD_SUPPORTED and os.scandir in getattr(os, 'supports_fd', set())
+
+# Infix of the names of trees renamed aside for deletion
+_TRASH_INFIX = '.deleting-'
+
+# Number of seconds between progress messages of tree deletions
+_REPORT_INTERVAL = 5
+
+PruneResult = collections.namedtuple('PruneResult', ('deleted', 'missing', 'removed_dirs'))
+PruneResult.__doc__ = """
+Result of prune_files()
+
+deleted is the number of files deleted
+missing is a sorted list of the relative paths that were not found
+removed_dirs is the number of empty directories removed
+"""
+
+DeleteResult = collections.namedtuple('DeleteResult', ('files', 'dirs', 'seconds'))
+DeleteResult.__doc__ = """
+Result of delete_tree()
+
+files is the number of files (including symlinks) deleted
+dirs is the number of directories deleted
+seconds is the duration of the deletion
+"""
+
+# Private definitions
+
+def _group_by_parent(relative_paths):
+    """Returns a dictionary of POSIX parent directory paths to lists of file names"""
+    groups = collections.defaultdict(list)
+    for relative_path in relative_paths:
+        parent, _, name = relative_path.rpartition('/')
+        groups[parent].append(name)
+    return groups
+
+def _unlink_names(resolved_tree, group):
+    """
+    Unlinks the files of a directory.
+
+    group is a tuple of the POSIX directory path relative to resolved_tree, and the list of
+    the names of its files to unlink.
+
+    Returns a tuple of the number of files deleted and a list of the names not found.
+    """
+    parent, names = group
+    directory = os.path.join(str(resolved_tree), parent)
+    deleted = 0
+    missing = list()
+    if _DIR_FD_SUPPORTED:
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        except (FileNotFoundError, NotADirectoryError):
+            return 0, list(names)
+        try:
+            for name in names:
+                try:
+                    os.unlink(name, dir_fd=dir_fd)
+                    deleted += 1
+                except FileNotFoundError:
+                    missing.append(name)
+        finally:
+            os.close(dir_fd)
+    else:
+        for name in names:
+            try:
+                os.unlink(os.path.join(directory, name))
+                deleted += 1
+            except FileNotFoundError:
+                missing.append(name)
+    return deleted, missing
+
+def _remove_empty_dirs(resolved_tree, parents):
+    """
+    Removes the directories at the POSIX relative paths in parents if they are empty, and
+    then their ancestors that became empty, bottom-up. The tree itself is never removed.
+
+    Returns the number of directories removed.
+    """
+    removed = 0
+    candidates = set(filter(None, parents))
+    while candidates:
+        # Process the deepest directories first, so parents are empty when reached
+        depth = max(x.count('/') for x in candidates)
+        level = sorted(x for x in candidates if x.count('/') == depth)
+        candidates.difference_update(level)
+        for relative_dir in level:
+            try:
+                os.rmdir(os.path.join(str(resolved_tree), relative_dir))
+            except OSError:
+                continue # Not empty, or already gone
+            removed += 1
+            parent = relative_dir.rpartition('/')[0]
+            if parent:
+                candidates.add(parent)
+    return removed
+
+def _clear_directory(path):
+    """
+    Unlinks the non-directory entries of the directory at path.
+
+    Returns a tuple of the number of entries unlinked and a list of the paths of the
+    subdirectories.
+    """
+    deleted = 0
+    subdirs = list()
+    # Entries that disappear were deleted by another process, e.g. another clean command
+    try:
+        if _SCANDIR_FD_SUPPORTED:
+            dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                with os.scandir(dir_fd) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(os.path.join(path, entry.name))
+                            continue
+                        try:
+                            os.unlink(entry.name, dir_fd=dir_fd)
+                            deleted += 1
+                        except FileNotFoundError:
+                            pass
+            finally:
+                os.close(dir_fd)
+        else:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    try:
+                        os.unlink(entry.path)
+                        deleted += 1
+                    except FileNotFoundError:
+                        pass
+    except FileNotFoundError:
+        pass
+    return deleted, subdirs
+
+def _remove_directory(path):
+    """Removes the empty directory at path. Returns True if it was removed; False if missing."""
+    try:
+        os.rmdir(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+class _DeletionReporter: #pylint: disable=too-few-public-methods
+    """Logs the progress and throughput of a tree deletion periodically"""
+
+    def __init__(self, path):
+        self._path = path
+        self.start_time = time.monotonic()
+        self._last_report = self.start_time
+        self.files = 0
+        self.dirs = 0
+
+    def update(self, files=0, dirs=0):
+        """Adds deleted files and directories, and logs the progress if it is time"""
+        self.files += files
+        self.dirs += dirs
+        now = time.monotonic()
+        if now - self._last_report >= _REPORT_INTERVAL:
+            self._last_report = now
+            get_logger().info(
+                'Deleting %s: %s files and %s directories deleted (%.0f files/s)', self._path,
+                self.files, self.dirs, self.files / (now - self.start_time))
+
+# Trees being deleted by delete_tree_in_background(), as a list of tuples of the path
+# and the thread
+_background_deletions = list()
+
+# Public definitions
+
+def prune_files(resolved_tree, relative_paths, remove_empty_dirs=False, executor=None,
+                warning='No such file: %s'):
+    """
+    Deletes files from the buildspace tree, in parallel.
+
+    resolved_tree is the resolved pathlib.Path to the buildspace tree
+    relative_paths is an iterable of POSIX path strings relative to resolved_tree
+    remove_empty_dirs indicates if the directories that became empty are removed afterwards
+    executor is the common.Executor to run workers with. Defaults to the shared executor
+    from common.get_executor().
+    warning is the message of the aggregated warnings about files that were not found,
+    with %s for the path
+
+    Returns a PruneResult.
+    Raises BuildkitAbort if a file could not be deleted for another reason than not existing.
+    """
+    if executor is None:
+        executor = get_executor()
+    groups = sorted(_group_by_parent(relative_paths).items())
+    deleted = 0
+    missing = list()
+    for (parent, _), (group_deleted, group_missing) in zip(groups, executor.map(
+            lambda x: _unlink_names(resolved_tree, x), groups, cpu_bound=False)):
+        deleted += group_deleted
+        missing.extend(parent + '/' + x if parent else x for x in group_missing)
+    missing.sort()
+    with FileWarnings() as file_warnings:
+        for relative_path in missing:
+            file_warnings.warn(warning, resolved_tree / relative_path)
+    removed_dirs = 0
+    if remove_empty_dirs:
+        removed_dirs = _remove_empty_dirs(resolved_tree, (x[0] for x in groups))
+    return PruneResult(deleted, missing, removed_dirs)
+
+def move_aside(path):
+    """
+    Renames the directory at path to a hidden name in the same directory, so that it can be
+    deleted later while a new directory is created at path. Renaming is atomic.
+
+    Returns the new pathlib.Path of the directory.
+    Raises FileNotFoundError if path does not exist.
+    Raises NotADirectoryError if path is not a directory.
+    """
+    if not path.is_dir():
+        if path.exists():
+            raise NotADirectoryError(path)
+        raise FileNotFoundError(path)
+    trash_path = path.with_name('.{}{}{}'.format(path.name, _TRASH_INFIX, uuid.uuid4().hex[:8]))
+    os.rename(str(path), str(trash_path))
+    return trash_path
+
+def get_moved_aside(path):
+    """
+    Returns a sorted list of the pathlib.Path of directories that were renamed aside from
+    path by move_aside() and not deleted yet, e.g. because their deletion was interrupted.
+    """
+    if not path.parent.is_dir():
+        return list()
+    return sorted(path.parent.glob('.{}{}*'.format(path.name, _TRASH_INFIX)))
+
+def delete_tree(path, executor=None):
+    """
+    Deletes the directory tree at path, like shutil.rmtree() but in parallel. Directories
+    are processed breadth-first; the entries of each level are unlinked relative to the
+    descriptor of their directory, and then the directories are removed bottom-up.
+    The progress and throughput are logged periodically.
+
+    path is a pathlib.Path to the directory
+    executor is the common.Executor to run workers with. Defaults to the shared executor
+    from common.get_executor().
+
+    Returns a DeleteResult.
+    Raises BuildkitAbort if a file or directory could not be deleted.
+    """
+    if executor is None:
+        executor = get_executor()
+    reporter = _DeletionReporter(path)
+    levels = list()
+    level = [str(path)]
+    while level:
+        levels.append(level)
+        next_level = list()
+        for deleted, subdirs in executor.map(_clear_directory, level, cpu_bound=False):
+            next_level.extend(subdirs)
+            reporter.update(files=deleted)
+        level = next_level
+    for level in reversed(levels):
+        for removed in executor.map(_remove_directory, level, cpu_bound=False):
+            reporter.update(dirs=int(removed))
+    return DeleteResult(reporter.files, reporter.dirs, time.monotonic() - reporter.start_time)
+
+def _delete_tree_thread(path, jobs):
+    """Thread function of delete_tree_in_background()"""
+    logger = get_logger()
+    try:
+        with Executor(jobs) as executor:
+            result = delete_tree(path, executor=executor)
+    except BuildkitAbort:
+        logger.error('Could not delete %s', path)
+        raise
+    except BaseException:
+        logger.exception('Unexpected exception while deleting %s', path)
+        raise
+    logger.info('Deleted %s: %s files and %s directories in %.1fs (%.0f files/s)', path,
+                result.files, result.dirs, result.seconds,
+                result.files / result.seconds if result.seconds else 0)
+
+def delete_tree_in_background(path, jobs=None):
+    """
+    Starts deleting the directory tree at path with delete_tree() in a background thread,
+    with its own Executor of jobs workers. wait_for_deletions() must be called before the
+    process exits.
+
+    jobs is the same as in common.get_jobs()
+    """
+    thread = threading.Thread(
+        target=_delete_tree_thread, args=(path, jobs), name='delete {}'.format(path.name))
+    thread.start()
+    _background_deletions.append((path, thread))
+
+def wait_for_deletions():
+    """
+    Waits for the deletions started by delete_tree_in_background().
+
+    Returns True if all trees were deleted; False otherwise.
+    """
+    success = True
+    while _background_deletions:
+        path, thread = _background_deletions.pop(0)
+        thread.join()
+        if path.exists():
+            success = False
+    return success
@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for profiling the memory usage of buildkit's stages.
+
+Python allocations are traced with tracemalloc: every stage records its current and peak
+traced memory, and the source lines that hold the most memory when it ends. The peak
+resident set size (RSS) of the process and of its finished child processes (e.g. the
+workers of common.Executor) is recorded from resource.getrusage().
+
+Profiling is disabled by default. Then, stage() returns a shared no-op context manager.
+"""
+
+import sys
+import time
+
+from .common import ENCODING
+
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows
+
+# Constants
+
+# Number of frames of the traceback of each allocation
+_TRACE_FRAMES = 1
+
+# Private definitions
+
+class _NullStage:
+    """Stage that records nothing, used when profiling is disabled"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+def _get_peak_rss(who):
+    """Returns the peak RSS in bytes of resource.RUSAGE_SELF or RUSAGE_CHILDREN, or None"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss # Already in bytes
+    return max_rss * 1024
+
+def _get_current_rss():
+    """Returns the current RSS in bytes, or None if it is not available"""
+    try:
+        with open('/proc/self/statm', encoding=ENCODING) as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * resource.getpagesize()
+
+def _format_size(size):
+    """Returns size in bytes formatted for the report"""
+    if size is None:
+        return '-'
+    return '{:,.1f} MiB'.format(size / 1024**2)
+
+class _Stage:
+    """A stage being profiled"""
+
+    __slots__ = ('_profile', 'name', 'peak', '_start_time')
+
+    def __init__(self, profile, name):
+        self._profile = profile
+        self.name = name
+        self.peak = 0
+        self._start_time = None
+
+    def __enter__(self):
+        self._profile.enter_stage(self)
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profile.exit_stage(self, time.perf_counter() - self._start_time)
+
+class _Profile:
+    """The stages profiled in this process"""
+
+    def __init__(self, top_sites):
+        import tracemalloc
+        self._tracemalloc = tracemalloc
+        self.top_sites = top_sites
+        self.records = list()
+        self._stack = list()
+        tracemalloc.start(_TRACE_FRAMES)
+
+    def enter_stage(self, stage):
+        """Starts tracking the peak of stage"""
+        if self._stack:
+            # Keep the peak of the enclosing stage before resetting it
+            parent = self._stack[-1]
+            parent.peak = max(parent.peak, self._tracemalloc.get_traced_memory()[1])
+        if hasattr(self._tracemalloc, 'reset_peak'): # Python 3.9+
+            self._tracemalloc.reset_peak()
+        self._stack.append(stage)
+
+    def exit_stage(self, stage, seconds):
+        """Records the memory usage of stage"""
+        current, peak = self._tracemalloc.get_traced_memory()
+        stage.peak = max(stage.peak, peak)
+        snapshot = self._tracemalloc.take_snapshot().filter_traces((
+            self._tracemalloc.Filter(False, self._tracemalloc.__file__),
+            self._tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            self._tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+        top_sites = list()
+        for statistic in snapshot.statistics('lineno')[:self.top_sites]:
+            frame = statistic.traceback[0]
+            top_sites.append({
+                'site': '{}:{}'.format(frame.filename, frame.lineno),
+                'size': statistic.size,
+                'count': statistic.count,
+            })
+        self._stack.pop()
+        self.records.append({
+            'stage': stage.name,
+            'depth': len(self._stack),
+            'seconds': seconds,
+            'traced_current': current,
+            'traced_peak': stage.peak,
+            'rss_current': _get_current_rss(),
+            'rss_peak': _get_peak_rss(resource.RUSAGE_SELF) if resource else None,
+            'rss_peak_children': _get_peak_rss(resource.RUSAGE_CHILDREN) if resource else None,
+            'top_sites': top_sites,
+        })
+
+    def stop(self):
+        """Stops tracing allocations"""
+        self._tracemalloc.stop()
+
+# The _Profile of this process, or None if profiling is disabled
+_profile = None
+
+# Public definitions
+
+def enable(top_sites=10):
+    """
+    Starts profiling memory. This slows down Python allocations considerably.
+
+    top_sites is the number of allocation sites to record per stage
+    """
+    global _profile #pylint: disable=global-statement
+    disable()
+    _profile = _Profile(top_sites)
+
+def disable():
+    """Stops profiling memory and discards the records"""
+    global _profile #pylint: disable=global-statement
+    if _profile is not None:
+        _profile.stop()
+    _profile = None
+
+def is_enabled():
+    """Returns True if memory profiling is enabled; False otherwise"""
+    return _profile is not None
+
+def stage(name):
+    """
+    Returns a context manager that records the memory usage of its block as a stage named
+    name. Stages can be nested.
+    """
+    if _profile is None:
+        return _NULL_STAGE
+    return _Stage(_profile, name)
+
+def get_records():
+    """
+    Returns a list of the records of the finished stages, in the order they finished.
+    Each record is a dictionary; sizes are in bytes and None if they are not available.
+    """
+    if _profile is None:
+        return list()
+    return list(_profile.records)
+
+def report(site_limit=3):
+    """
+    Returns a human-readable report of the stages with their peak memory, and the top
+    site_limit allocation sites of each.
+    """
+    lines = ['{:<40} {:>9} {:>14} {:>14} {:>14} {:>14}'.format(
+        'Stage', 'Time', 'Traced', 'Traced peak', 'RSS peak', 'Children peak')]
+    for record in get_records():
+        lines.append('{:<40} {:>8.2f}s {:>14} {:>14} {:>14} {:>14}'.format(
+            ('  ' * record['depth'] + record['stage'])[:40], record['seconds'],
+            _format_size(record['traced_current']), _format_size(record['traced_peak']),
+            _format_size(record['rss_peak']), _format_size(record['rss_peak_children'])))
+        for site in record['top_sites'][:site_limit]:
+            lines.append('{:<40} {:>14} {}'.format(
+                '', _format_size(site['size']), site['site']))
+    return '\n'.join(lines)
+
+def write_json(path):
+    """Writes the records of the stages to path as JSON"""
+    import json
+    with path.open('w', encoding=ENCODING) as json_file:
+        json.dump({'stages': get_records()}, json_file, indent=2)
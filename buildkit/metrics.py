@@ -0,0 +1,345 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for process-wide metrics (counters and histograms) of the work done by buildkit.
+
+Metrics are always collected; they are cheap enough to be updated in hot loops. They can
+be written in the Prometheus text exposition format (e.g. for the textfile collector of
+node_exporter) or as JSON. Metrics updated in the worker processes of common.Executor are
+merged into the parent process.
+
+Updates are locked per metric, so that no update is lost when metrics are updated from
+several threads at once (e.g. by concurrent stages of aio).
+"""
+
+import abc
+import bisect
+import collections
+import os
+import threading
+
+from .common import ENCODING
+
+# Constants
+
+# Default upper bounds of histogram buckets, in seconds
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+# Private definitions
+
+# Dictionary of (name, labels) to metrics, in the order they were defined
+_registry = collections.OrderedDict()
+
+# Lock for adding metrics to _registry
+_registry_lock = threading.Lock()
+
+class _Metric(abc.ABC):
+    """Base class of metrics"""
+
+    kind = None
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # Lock for updates and snapshots of the state of the metric
+        self._lock = threading.Lock()
+
+    def _definition(self):
+        """Returns the arguments of _get_metric() that define this metric"""
+        return type(self), self.name, self.description, dict(self.labels)
+
+    @abc.abstractmethod
+    def _snapshot(self):
+        """Returns the current state for computing deltas"""
+
+    @abc.abstractmethod
+    def _zero_snapshot(self):
+        """Returns the state of a new metric, for computing deltas of metrics without snapshots"""
+
+    @abc.abstractmethod
+    def _delta(self, snapshot):
+        """Returns the change since snapshot, or None if unchanged"""
+
+    @abc.abstractmethod
+    def _merge(self, delta):
+        """Adds a delta from another process"""
+
+    @abc.abstractmethod
+    def samples(self):
+        """Returns a list of tuples of the sample name suffix, extra labels, and value"""
+
+class Counter(_Metric):
+    """A count that only increases, e.g. of bytes or files"""
+
+    kind = 'counter'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.value = 0
+
+    def add(self, amount=1):
+        """Increases the counter by amount"""
+        with self._lock:
+            self.value += amount
+
+    def _snapshot(self):
+        with self._lock:
+            return self.value
+
+    def _zero_snapshot(self):
+        return 0
+
+    def _delta(self, snapshot):
+        return (self._snapshot() - snapshot) or None
+
+    def _merge(self, delta):
+        self.add(delta)
+
+    def samples(self):
+        return [('', (), self._snapshot())]
+
+class Histogram(_Metric):
+    """The distribution of observed values, e.g. durations"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels, buckets):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Counts of observations per bucket, with one more for values above all buckets
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+
+    def observe(self, value):
+        """Records a value"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.total += value
+
+    @property
+    def count(self):
+        """The number of observations"""
+        return sum(self._snapshot()[0])
+
+    def _definition(self):
+        return super()._definition() + (self.buckets, )
+
+    def _snapshot(self):
+        with self._lock:
+            return tuple(self.bucket_counts), self.total
+
+    def _zero_snapshot(self):
+        return (0, ) * len(self.bucket_counts), 0
+
+    def _delta(self, snapshot):
+        bucket_counts, total = self._snapshot()
+        bucket_deltas = [x - y for x, y in zip(bucket_counts, snapshot[0])]
+        if not any(bucket_deltas):
+            return None
+        return bucket_deltas, total - snapshot[1]
+
+    def _merge(self, delta):
+        with self._lock:
+            for index, bucket_delta in enumerate(delta[0]):
+                self.bucket_counts[index] += bucket_delta
+            self.total += delta[1]
+
+    def samples(self):
+        bucket_counts, total = self._snapshot()
+        samples = list()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'), ), bucket_counts):
+            cumulative += bucket_count
+            samples.append(('_bucket', (('le', _format_value(bound)), ), cumulative))
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), cumulative))
+        return samples
+
+def _get_metric(metric_class, name, description, labels, *args):
+    """Returns the registered metric, creating it if necessary"""
+    key = (name, tuple(sorted(labels.items())))
+    metric = _registry.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = _registry.get(key)
+            if metric is None:
+                metric = metric_class(name, description, key[1], *args)
+                _registry[key] = metric
+    if not isinstance(metric, metric_class):
+        raise ValueError('Metric {} is already defined as a {}'.format(name, metric.kind))
+    return metric
+
+def _format_value(value):
+    """Returns value formatted for the Prometheus text format"""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(labels):
+    """Returns labels formatted for the Prometheus text format"""
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                                    for name, value in labels))
+
+def _get_prometheus_text():
+    """Returns all metrics in the Prometheus text format"""
+    lines = list()
+    described = set()
+    # The registry is copied first, since metrics may be created by other threads meanwhile
+    for metric in sorted(list(_registry.values()), key=lambda x: x.name):
+        if metric.name not in described:
+            described.add(metric.name)
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for suffix, extra_labels, value in metric.samples():
+            lines.append('{}{}{} {}'.format(
+                metric.name, suffix, _format_labels(metric.labels + extra_labels),
+                _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+def _get_json_data():
+    """Returns all metrics as a list of dictionaries for JSON"""
+    data = list()
+    for metric in list(_registry.values()):
+        entry = {
+            'name': metric.name,
+            'type': metric.kind,
+            'help': metric.description,
+            'labels': dict(metric.labels),
+        }
+        if isinstance(metric, Histogram):
+            bucket_counts, entry['sum'] = metric._snapshot() #pylint: disable=protected-access
+            entry['buckets'] = dict(zip(
+                map(_format_value, metric.buckets + (float('inf'), )), bucket_counts))
+            entry['count'] = sum(bucket_counts)
+        else:
+            entry['value'] = metric._snapshot() #pylint: disable=protected-access
+        data.append(entry)
+    return data
+
+class _MeteredTask: #pylint: disable=too-few-public-methods
+    """
+    Wrapper for a task that runs in a worker process. The changes of the metrics made by
+    the task are returned with its result, to be merged into the parent process. Metrics
+    created by the task are returned with their definitions, so that the parent process can
+    create them too.
+    """
+
+    def __init__(self, function):
+        self._function = function
+
+    def __call__(self, *args):
+        snapshots = {key: metric._snapshot() for key, metric in list(_registry.items())} #pylint: disable=protected-access
+        result = self._function(*args)
+        deltas = list()
+        for key, metric in list(_registry.items()):
+            snapshot = snapshots.get(key)
+            if snapshot is None:
+                snapshot = metric._zero_snapshot() #pylint: disable=protected-access
+            delta = metric._delta(snapshot) #pylint: disable=protected-access
+            if delta is not None:
+                deltas.append((metric._definition(), delta)) #pylint: disable=protected-access
+        return result, deltas
+
+def _merge_task_results(results):
+    """Yields the results of _MeteredTask, and merges their metrics"""
+    for result, deltas in results:
+        for definition, delta in deltas:
+            _get_metric(*definition)._merge(delta) #pylint: disable=protected-access
+        yield result
+
+# Public definitions
+
+def counter(name, description, **labels):
+    """
+    Returns the counter with name and labels, creating it if necessary.
+
+    name is the Prometheus metric name, e.g. 'buildkit_written_bytes_total'
+    description is the help text of the metric
+    labels are the label names and string values of this counter
+
+    Raises ValueError if the name is used by a different kind of metric.
+    """
+    return _get_metric(Counter, name, description, labels)
+
+def histogram(name, description, buckets=DURATION_BUCKETS, **labels):
+    """
+    Returns the histogram with name and labels, creating it if necessary.
+
+    buckets is an iterable of the upper bounds of the buckets
+    Other arguments are the same as in counter().
+
+    Raises ValueError if the name is used by a different kind of metric.
+    """
+    return _get_metric(Histogram, name, description, labels, buckets)
+
+def wrap_task(function):
+    """
+    Returns function wrapped for running in a worker process, so that the metrics it
+    updates are kept. Its results must be passed through unwrap_results().
+    """
+    return _MeteredTask(function)
+
+def unwrap_results(results):
+    """
+    Returns an iterator of the results of a function returned by wrap_task(), and merges
+    the updated metrics into this process.
+    """
+    return _merge_task_results(results)
+
+def write(path):
+    """
+    Writes all metrics to path, as JSON if the file name ends with .json, or in the
+    Prometheus text format otherwise. The file is replaced atomically.
+    """
+    if path.suffix == '.json':
+        import json
+        content = json.dumps({'metrics': _get_json_data()}, indent=2, sort_keys=True)
+    else:
+        content = _get_prometheus_text()
+    temp_path = path.with_name('.{}.tmp'.format(path.name))
+    with temp_path.open('w', encoding=ENCODING) as metrics_file:
+        metrics_file.write(content)
+    os.replace(str(temp_path), str(path))
+
+class PeriodicWriter:
+    """Writes the metrics to a file periodically in a background thread, and when stopped"""
+
+    def __init__(self, path, interval):
+        """
+        path is the same as in write()
+        interval is the number of seconds between writes, or None to only write when stopped
+        """
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            write(self.path)
+
+    def start(self):
+        """Starts writing periodically"""
+        if self.interval:
+            self._thread = threading.Thread(
+                target=self._run, name='metrics writer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops writing periodically, and writes the final metrics"""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+        write(self.path)
@@ -14,6 +14,7 @@ import urllib.request
 
 from pathlib import Path
 
+from .. import tracing
 from ..common import BuildkitAbort, get_logger
 
 # Constants
@@ -43,6 +44,7 @@ class BuildFileStringTemplate(string.Template):
 
 # Methods
 
+@tracing.traced('packaging')
 def process_templates(root_dir, build_file_subs):
     """Substitute '$ungoog' strings in '.in' template files and remove the suffix"""
     for old_path in root_dir.glob("*.in"):
@@ -72,6 +74,7 @@ def get_current_commit():
         raise BuildkitAbort()
     return result.stdout.strip('\n')
 
+@tracing.traced('io')
 def get_remote_file_hash(url, hash_type='sha256'):
     """Downloads and returns a hash of a file at the given url"""
     with urllib.request.urlopen(url) as file_obj:
@@ -6,9 +6,9 @@
 
 """Arch Linux-specific build files generation code"""
 
-import shutil
-
+from .. import tracing
 from ..common import PACKAGING_DIR, BuildkitAbort, get_resources_dir, ensure_empty_dir, get_logger
+from ..file_materialization import materialize_file
 from ._common import (
     DEFAULT_BUILD_OUTPUT, SHARED_PACKAGING, process_templates,
     get_current_commit, get_remote_file_hash)
@@ -26,9 +26,8 @@ def _get_packaging_resources(shared=False):
         return get_resources_dir() / PACKAGING_DIR / 'archlinux'
 
 def _copy_from_resources(name, output_dir, shared=False):
-    shutil.copy(
-        str(_get_packaging_resources(shared=shared) / name),
-        str(output_dir / name))
+    materialize_file(
+        _get_packaging_resources(shared=shared) / name, output_dir / name, copy_mode=True)
 
 def _generate_gn_flags(flags_items_iter):
     """Returns GN flags for the PKGBUILD"""
@@ -37,6 +36,7 @@ def _generate_gn_flags(flags_items_iter):
 
 # Public definitions
 
+@tracing.traced('packaging')
 def generate_packaging(config_bundle, output_dir, repo_version='bundle',
                        repo_hash='SKIP', build_output=DEFAULT_BUILD_OUTPUT):
     """
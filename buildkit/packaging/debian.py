@@ -13,7 +13,9 @@ import shutil
 
 from ..third_party import schema
 
+from .. import tracing
 from ..common import PACKAGING_DIR, PATCHES_DIR, get_resources_dir, ensure_empty_dir
+from ..file_materialization import materialize_file
 from ..config import RequiredConfigMixin, IniConfigFile, schema_inisections, schema_dictcast
 from ._common import DEFAULT_BUILD_OUTPUT, process_templates
 
@@ -109,6 +111,7 @@ class _Flavor:
             current_flavor = current_flavor.parent
         return sorted(file_flavor_resolutions.items())
 
+    @tracing.traced('packaging')
     def assemble_files(self, destination):
         """
         Copies all files associated with this flavor to `destination`
@@ -119,8 +122,10 @@ class _Flavor:
             if source_path.is_dir():
                 dest_path.mkdir()
                 shutil.copymode(str(source_path), str(dest_path), follow_symlinks=False)
-            else:
+            elif source_path.is_symlink():
                 shutil.copy(str(source_path), str(dest_path), follow_symlinks=False)
+            else:
+                materialize_file(source_path, dest_path, copy_mode=True)
 
 def _get_dpkg_changelog_datetime(override_datetime=None):
     if override_datetime is None:
@@ -150,6 +155,7 @@ def _get_parsed_gn_flags(gn_flags):
 
 # Public definitions
 
+@tracing.traced('packaging')
 def generate_packaging(config_bundle, flavor, debian_dir,
                        build_output=DEFAULT_BUILD_OUTPUT, distro_version='stable'):
     """
@@ -6,9 +6,9 @@
 
 """Linux Simple-specific build files generation code"""
 
-import shutil
-
+from .. import tracing
 from ..common import PACKAGING_DIR, PATCHES_DIR, get_resources_dir, ensure_empty_dir
+from ..file_materialization import materialize_file
 from ._common import (
     DEFAULT_BUILD_OUTPUT, SHARED_PACKAGING, LIST_BUILD_OUTPUTS, process_templates)
 
@@ -21,12 +21,12 @@ def _get_packaging_resources(shared=False):
         return get_resources_dir() / PACKAGING_DIR / 'linux_simple'
 
 def _copy_from_resources(name, output_dir, shared=False):
-    shutil.copy(
-        str(_get_packaging_resources(shared=shared) / name),
-        str(output_dir / name))
+    materialize_file(
+        _get_packaging_resources(shared=shared) / name, output_dir / name, copy_mode=True)
 
 # Public definitions
 
+@tracing.traced('packaging')
 def generate_packaging(config_bundle, output_dir, build_output=DEFAULT_BUILD_OUTPUT):
     """
     Generates the linux_simple packaging into output_dir
@@ -6,9 +6,9 @@
 
 """macOS-specific build files generation code"""
 
-import shutil
-
+from .. import tracing
 from ..common import PACKAGING_DIR, PATCHES_DIR, get_resources_dir, ensure_empty_dir
+from ..file_materialization import materialize_file
 from ._common import DEFAULT_BUILD_OUTPUT, process_templates
 
 # Private definitions
@@ -17,12 +17,11 @@ def _get_packaging_resources():
     return get_resources_dir() / PACKAGING_DIR / 'macos'
 
 def _copy_from_resources(name, output_dir):
-    shutil.copy(
-        str(_get_packaging_resources() / name),
-        str(output_dir / name))
+    materialize_file(_get_packaging_resources() / name, output_dir / name, copy_mode=True)
 
 # Public definitions
 
+@tracing.traced('packaging')
 def generate_packaging(config_bundle, output_dir, build_output=DEFAULT_BUILD_OUTPUT):
     """
     Generates the macOS packaging into output_dir
@@ -0,0 +1,298 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for splitting work over many items (e.g. files of the buildspace tree) into shards
+that are processed by worker processes on this host or others.
+
+A coordinator publishes the shards of a job in a job directory. Workers that can access the
+directory (e.g. over NFS for other hosts) claim shards by renaming them, process them with
+a task function, and write back the results. The coordinator merges the results in the
+order of the items, so the result does not depend on which worker processed which shard.
+
+Layout of a job directory:
+
+    job.json            The task name, its parameters and the number of shards
+    pending/NNNNN.json  Shards that are not claimed yet
+    claimed/NNNNN.WORKER.json
+                        Shards being processed by WORKER. The worker updates the
+                        modification time regularly; shards of workers that stop doing so
+                        are put back in pending/.
+    results/NNNNN.json  The results of the shard, or the error that occurred
+    complete            Created by the coordinator when the job is finished; workers exit
+
+A task function takes the parameters of the job (a JSON object), the list of the items of a
+shard, and a heartbeat function to call regularly. It returns a list of JSON-compatible
+results, one per item. Paths in items and parameters must be valid on every worker.
+"""
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+from .common import ENCODING, BuildkitAbort, get_executor, get_logger
+
+# Constants
+
+# Default number of items per shard
+DEFAULT_SHARD_SIZE = 500
+
+# Default number of seconds without a heartbeat after which a claimed shard is requeued
+DEFAULT_CLAIM_TIMEOUT = 300
+
+# Number of seconds between polls of the job directory
+_POLL_INTERVAL = 0.2
+
+# Minimum number of seconds between updates of the modification time of a claim
+_HEARTBEAT_INTERVAL = 10
+
+# Number of seconds between progress messages of the coordinator
+_REPORT_INTERVAL = 10
+
+_JOB_FILE = 'job.json'
+_COMPLETE_FILE = 'complete'
+_PENDING_DIR = 'pending'
+_CLAIMED_DIR = 'claimed'
+_RESULTS_DIR = 'results'
+
+# Private definitions
+
+def _get_shard_name(index):
+    """Returns the file name of the shard with index"""
+    return '{:05d}.json'.format(index)
+
+def _write_json(path, data):
+    """Writes data to path as JSON, replacing it atomically"""
+    temp_path = path.with_name('.{}.{}-{}.tmp'.format(
+        path.name, socket.gethostname(), os.getpid()))
+    with temp_path.open('w', encoding=ENCODING) as json_file:
+        json.dump(data, json_file)
+    os.replace(str(temp_path), str(path))
+
+def _read_json(path):
+    """Returns the data of the JSON file at path"""
+    with path.open(encoding=ENCODING) as json_file:
+        return json.load(json_file)
+
+class _Heartbeat: #pylint: disable=too-few-public-methods
+    """Callable that updates the modification time of a claim, at most every interval"""
+
+    def __init__(self, claim_path):
+        self._claim_path = claim_path
+        self._last_beat = time.monotonic()
+
+    def __call__(self):
+        now = time.monotonic()
+        if now - self._last_beat < _HEARTBEAT_INTERVAL:
+            return
+        self._last_beat = now
+        try:
+            os.utime(str(self._claim_path))
+        except FileNotFoundError:
+            pass # The shard was requeued; its result will still be accepted
+
+def _claim_shard(job_dir, worker_id):
+    """
+    Claims a pending shard for worker_id.
+
+    Returns a tuple of the shard index and the path of its claim, or None if no shard is
+    pending.
+    """
+    pending_dir = job_dir / _PENDING_DIR
+    for name in sorted(os.listdir(str(pending_dir))):
+        if not name.endswith('.json'):
+            continue
+        claim_path = job_dir / _CLAIMED_DIR / '{}.{}.json'.format(name[:-5], worker_id)
+        try:
+            os.rename(str(pending_dir / name), str(claim_path))
+        except FileNotFoundError:
+            continue # Claimed by another worker
+        return int(name[:-5]), claim_path
+    return None
+
+def _requeue_stale_claims(job_dir, claim_timeout):
+    """Puts shards back in pending/ if their worker stopped updating its claim"""
+    claimed_dir = job_dir / _CLAIMED_DIR
+    deadline = time.time() - claim_timeout
+    for name in os.listdir(str(claimed_dir)):
+        index_str, _, worker_id = name[:-5].partition('.')
+        try:
+            if os.stat(str(claimed_dir / name)).st_mtime >= deadline:
+                continue
+            os.rename(
+                str(claimed_dir / name),
+                str(job_dir / _PENDING_DIR / '{}.json'.format(index_str)))
+        except FileNotFoundError:
+            continue # Finished in the meantime
+        get_logger().warning('Worker %s stopped responding; shard %s is requeued', worker_id,
+                             index_str)
+
+def _create_job(job_dir, task_name, parameters, items, shard_size):
+    """Publishes the shards of a job in job_dir. Returns the number of shards."""
+    for name in (_PENDING_DIR, _CLAIMED_DIR, _RESULTS_DIR):
+        (job_dir / name).mkdir()
+    shard_count = 0
+    for shard_count, start in enumerate(range(0, len(items), shard_size), start=1):
+        _write_json(job_dir / _PENDING_DIR / _get_shard_name(shard_count - 1),
+                    items[start:start + shard_size])
+    # job.json is written last, so that workers only start on a complete job
+    _write_json(job_dir / _JOB_FILE, {
+        'task': task_name,
+        'parameters': parameters,
+        'shards': shard_count,
+    })
+    return shard_count
+
+def _start_local_workers(job_dir, tasks, count):
+    """Returns a list of count started worker processes"""
+    import multiprocessing
+    processes = list()
+    for _ in range(count):
+        process = multiprocessing.Process(
+            target=run_worker, args=(job_dir, tasks), name='shard worker', daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+def _collect_results(job_dir, shard_count, claim_timeout, local_workers):
+    """Waits for the results of all shards, and returns them as a list in shard order"""
+    logger = get_logger()
+    results = [None] * shard_count
+    remaining = set(range(shard_count))
+    last_report = time.monotonic()
+    while remaining:
+        for index in sorted(remaining):
+            result_path = job_dir / _RESULTS_DIR / _get_shard_name(index)
+            if not result_path.exists():
+                continue
+            data = _read_json(result_path)
+            if 'error' in data:
+                logger.error('Shard %s failed on worker %s:\n%s', index, data['worker'],
+                             data['error'])
+                raise BuildkitAbort()
+            results[index] = data['results']
+            remaining.remove(index)
+        if not remaining:
+            break
+        if local_workers and not any(x.is_alive() for x in local_workers):
+            logger.error('All local workers exited before the job was finished')
+            raise BuildkitAbort()
+        _requeue_stale_claims(job_dir, claim_timeout)
+        if time.monotonic() - last_report >= _REPORT_INTERVAL:
+            last_report = time.monotonic()
+            logger.info('%s of %s shards finished', shard_count - len(remaining), shard_count)
+        time.sleep(_POLL_INTERVAL)
+    return results
+
+# Public definitions
+
+def run_worker(job_dir, tasks, worker_id=None):
+    """
+    Processes shards of the job in job_dir until the job is complete. Waits for the job to
+    be created if necessary.
+
+    job_dir is the path to the job directory
+    tasks is a dictionary of task names to the task functions this worker can run
+    worker_id is the name of the worker in claims, or None to use the host name and
+    process ID. It must not contain dots.
+
+    Returns the number of shards processed.
+
+    Raises KeyError if the job's task is not in tasks.
+    """
+    job_dir = Path(job_dir)
+    if worker_id is None:
+        worker_id = '{}-{}'.format(socket.gethostname().split('.')[0], os.getpid())
+    logger = get_logger()
+    job = None
+    processed = 0
+    while not (job_dir / _COMPLETE_FILE).exists():
+        if job is None:
+            try:
+                job = _read_json(job_dir / _JOB_FILE)
+            except FileNotFoundError:
+                time.sleep(_POLL_INTERVAL)
+                continue
+            task_function = tasks[job['task']]
+        claim = _claim_shard(job_dir, worker_id)
+        if claim is None:
+            time.sleep(_POLL_INTERVAL)
+            continue
+        index, claim_path = claim
+        logger.debug('Worker %s processing shard %s', worker_id, index)
+        try:
+            items = _read_json(claim_path)
+            data = {
+                'worker': worker_id,
+                'results': task_function(job['parameters'], items, _Heartbeat(claim_path)),
+            }
+        except Exception: #pylint: disable=broad-except
+            data = {'worker': worker_id, 'error': traceback.format_exc()}
+        _write_json(job_dir / _RESULTS_DIR / _get_shard_name(index), data)
+        try:
+            claim_path.unlink()
+        except FileNotFoundError:
+            pass
+        processed += 1
+    return processed
+
+def run_job(task_name, task_function, parameters, items, job_dir=None, local_workers=None, #pylint: disable=too-many-arguments
+            shard_size=DEFAULT_SHARD_SIZE, claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+    """
+    Runs task_function over items as a sharded job, and returns the list of its results in
+    the order of items.
+
+    task_name is the name of the task for workers, which look it up in their tasks
+    task_function is the task function, which is run by the local workers
+    parameters is the JSON-compatible object passed to the task function
+    items is a list of JSON-compatible items
+    job_dir is the path to an empty or non-existent directory to publish the job in, or
+    None to use a temporary directory that is deleted afterwards. It is kept otherwise.
+    local_workers is the number of worker processes to start on this host, or None to use
+    the number of jobs of common.get_executor(). With 0, the job is only processed by
+    workers started separately with run_worker().
+    shard_size is the number of items per shard
+    claim_timeout is the number of seconds without a heartbeat after which the shard of a
+    worker is given to another worker
+
+    Raises FileExistsError if job_dir is not empty.
+    Raises BuildkitAbort if a shard failed or all local workers exited early.
+    """
+    if job_dir is None:
+        job_dir = Path(tempfile.mkdtemp(prefix='buildkit-shards-'))
+        temporary = True
+    else:
+        job_dir = Path(job_dir)
+        temporary = False
+        job_dir.mkdir(parents=True, exist_ok=True)
+        if os.listdir(str(job_dir)):
+            raise FileExistsError(job_dir)
+    if local_workers is None:
+        local_workers = get_executor().jobs
+    shard_count = _create_job(job_dir, task_name, parameters, items, shard_size)
+    get_logger().info('Published %s shards of %s items in %s', shard_count, len(items), job_dir)
+    processes = _start_local_workers(job_dir, {task_name: task_function},
+                                     min(local_workers, shard_count))
+    try:
+        shard_results = _collect_results(job_dir, shard_count, claim_timeout, processes)
+    finally:
+        # Tell all workers to exit
+        (job_dir / _COMPLETE_FILE).touch()
+        for process in processes:
+            process.join(_HEARTBEAT_INTERVAL)
+            if process.is_alive():
+                process.terminate()
+        if temporary:
+            shutil.rmtree(str(job_dir), ignore_errors=True)
+    results = list()
+    for shard_result in shard_results:
+        results.extend(shard_result)
+    return results
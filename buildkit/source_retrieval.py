@@ -14,7 +14,9 @@ import urllib.request
 import hashlib
 from pathlib import Path, PurePosixPath
 
+from . import file_removal, memory_profile, metrics, tracing
 from .common import ENCODING, BuildkitAbort, get_logger, ensure_empty_dir
+from .config import PathTrie
 
 # Constants
 
@@ -22,6 +24,19 @@ _SOURCE_ARCHIVE_URL = ('https://commondatastorage.googleapis.com/'
                        'chromium-browser-official/chromium-{}.tar.xz')
 _SOURCE_HASHES_URL = _SOURCE_ARCHIVE_URL + '.hashes'
 
+_DOWNLOADED_BYTES = metrics.counter('buildkit_downloaded_bytes_total', 'Bytes downloaded')
+_HASHED_BYTES = metrics.counter('buildkit_hashed_bytes_total', 'Bytes of archives hashed')
+_DECOMPRESSED_BYTES = metrics.counter(
+    'buildkit_decompressed_bytes_total', 'Bytes of tar archives after decompression')
+_WRITTEN_BYTES = metrics.counter(
+    'buildkit_written_bytes_total', 'Bytes of files written', stage='extract')
+_WRITTEN_FILES = metrics.counter(
+    'buildkit_written_files_total', 'Files, directories and links written', stage='extract')
+_PRUNED_FILES = metrics.counter('buildkit_pruned_files_total', 'Files pruned', stage='extract')
+_SKIPPED_FILES = metrics.counter(
+    'buildkit_skipped_files_total', 'Files skipped because they were already processed',
+    stage='extract')
+
 # Custom Exceptions
 
 class NotAFileError(OSError):
@@ -34,7 +49,8 @@ class HashMismatchError(Exception):
 
 # Methods and supporting code
 
-def _extract_tar_file(tar_path, buildspace_tree, unpack_dir, ignore_files, relative_to):
+def _extract_tar_file(tar_path, buildspace_tree, unpack_dir, ignore_files, relative_to, #pylint: disable=too-many-arguments
+                      ignore_rules=None, progress=None):
     """
     Improved one-time tar extraction function
 
@@ -43,10 +59,14 @@ def _extract_tar_file(tar_path, buildspace_tree, unpack_dir, ignore_files, relat
     unpack_dir is a pathlib.Path relative to buildspace_tree to unpack the archive.
     It must already exist.
 
-    ignore_files is a set of paths as strings that should not be extracted from the archive.
-    Files that have been ignored are removed from the set.
+    ignore_files is a config.PathTrie of paths that should not be extracted from the archive.
+    Files that have been ignored are removed from the trie.
     relative_to is a pathlib.Path for directories that should be stripped relative to the
     root of the archive.
+    ignore_rules is a config.PathRules of additional files that should not be extracted,
+    or None.
+    progress is a checkpoint.StageProgress to record extracted members into, or None.
+    Members it already contains are not extracted again.
 
     Raises BuildkitAbort if unexpected issues arise during unpacking.
     """
@@ -83,8 +103,16 @@ def _extract_tar_file(tar_path, buildspace_tree, unpack_dir, ignore_files, relat
                     tree_relative_path = unpack_dir / PurePosixPath(tarinfo.name).relative_to(
                         relative_to) # pylint: disable=redefined-variable-type
                 try:
-                    ignore_files.remove(tree_relative_path.as_posix())
+                    ignore_files.remove(tree_relative_path.parts)
+                    _PRUNED_FILES.add()
                 except KeyError:
+                    if ignore_rules and not tarinfo.isdir() and ignore_rules.matches(
+                            tree_relative_path.as_posix()):
+                        _PRUNED_FILES.add()
+                        continue
+                    if progress is not None and tree_relative_path.as_posix() in progress:
+                        _SKIPPED_FILES.add()
+                        continue
                     destination = resolved_tree / tree_relative_path
                     if tarinfo.issym() and not symlink_supported:
                         # In this situation, TarFile.makelink() will try to create a copy of the
@@ -99,10 +127,20 @@ def _extract_tar_file(tar_path, buildspace_tree, unpack_dir, ignore_files, relat
                         tarinfo._link_target = new_target.as_posix() # pylint: disable=protected-access
                     if destination.is_symlink():
                         destination.unlink()
-                    tar_file_obj._extract_member(tarinfo, str(destination)) # pylint: disable=protected-access
+                    with tracing.file_span(tree_relative_path, tarinfo.size, 'extract'):
+                        tar_file_obj._extract_member( # pylint: disable=protected-access
+                            tarinfo, str(destination))
+                    _WRITTEN_FILES.add()
+                    if tarinfo.isreg():
+                        _WRITTEN_BYTES.add(tarinfo.size)
+                    if progress is not None:
+                        progress.add(tree_relative_path.as_posix())
+            except BuildkitAbort:
+                raise
             except BaseException:
                 get_logger().exception('Exception thrown for tar member: %s', tarinfo.name)
                 raise BuildkitAbort()
+        _DECOMPRESSED_BYTES.add(tar_file_obj.offset)
 
 class _UrlRetrieveReportHook: #pylint: disable=too-few-public-methods
     """Hook for urllib.request.urlretrieve to log progress information to console"""
@@ -139,12 +177,21 @@ def _download_if_needed(file_path, url, show_progress):
         reporthook = None
         if show_progress:
             reporthook = _UrlRetrieveReportHook()
-        urllib.request.urlretrieve(url, str(file_path), reporthook=reporthook)
+        with tracing.span('download', 'io', file=file_path.name) as download_span:
+            urllib.request.urlretrieve(url, str(file_path), reporthook=reporthook)
+            download_span.set(size=file_path.stat().st_size)
+        _DOWNLOADED_BYTES.add(file_path.stat().st_size)
         if show_progress:
             print()
     else:
         get_logger().info('%s already exists. Skipping download.', file_path)
 
+def _get_source_archive(config_bundle, buildspace_downloads):
+    """Returns a tuple of the paths to the Chromium source archive and its hashes file"""
+    source_archive = buildspace_downloads / 'chromium-{}.tar.xz'.format(
+        config_bundle.version.chromium_version)
+    return source_archive, source_archive.with_name(source_archive.name + '.hashes')
+
 def _chromium_hashes_generator(hashes_path):
     with hashes_path.open(encoding=ENCODING) as hashes_file:
         hash_lines = hashes_file.read().splitlines()
@@ -154,22 +201,39 @@ def _chromium_hashes_generator(hashes_path):
         else:
             get_logger().warning('Skipping unknown hash algorithm: %s', hash_name)
 
-def _setup_chromium_source(config_bundle, buildspace_downloads, buildspace_tree,
-                           show_progress, pruning_set):
+def _verify_hashes(archive_path, hashes_iter):
+    """
+    Checks the archive at archive_path against hashes_iter, an iterable of tuples of the
+    hash algorithm name and the expected hex digest.
+
+    Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
+    """
+    with memory_profile.stage('verify hashes of {}'.format(archive_path.name)):
+        with tracing.span('read archive', 'io', file=archive_path.name):
+            with archive_path.open('rb') as file_obj:
+                archive_data = file_obj.read()
+        for hash_name, hash_hex in hashes_iter:
+            get_logger().debug('Verifying %s hash...', hash_name)
+            with tracing.span('hash', 'hash', file=archive_path.name, algorithm=hash_name):
+                hasher = hashlib.new(hash_name, data=archive_data)
+            _HASHED_BYTES.add(len(archive_data))
+            if not hasher.hexdigest().lower() == hash_hex.lower():
+                raise HashMismatchError(archive_path)
+
+def _setup_chromium_source(config_bundle, buildspace_downloads, buildspace_tree, #pylint: disable=too-many-arguments
+                           show_progress, pruning_set, pruning_rules, progress):
     """
     Download, check, and extract the Chromium source code into the buildspace tree.
 
     Arguments of the same name are shared with retreive_and_extract().
-    pruning_set is a set of files to be pruned. Only the files that are ignored during
-    extraction are removed from the set.
+    pruning_set is a config.PathTrie of files to be pruned. Only the files that are ignored
+    during extraction are removed from the trie.
 
     Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
     Raises source_retrieval.NotAFileError when the archive name exists but is not a file.
     May raise undetermined exceptions during archive unpacking.
     """
-    source_archive = buildspace_downloads / 'chromium-{}.tar.xz'.format(
-        config_bundle.version.chromium_version)
-    source_hashes = source_archive.with_name(source_archive.name + '.hashes')
+    source_archive, source_hashes = _get_source_archive(config_bundle, buildspace_downloads)
 
     if source_archive.exists() and not source_archive.is_file():
         raise NotAFileError(source_archive)
@@ -186,25 +250,22 @@ def _setup_chromium_source(config_bundle, buildspace_downloads, buildspace_tree,
         _SOURCE_HASHES_URL.format(config_bundle.version.chromium_version),
         False)
     get_logger().info('Verifying hashes...')
-    with source_archive.open('rb') as file_obj:
-        archive_data = file_obj.read()
-    for hash_name, hash_hex in _chromium_hashes_generator(source_hashes):
-        get_logger().debug('Verifying %s hash...', hash_name)
-        hasher = hashlib.new(hash_name, data=archive_data)
-        if not hasher.hexdigest().lower() == hash_hex.lower():
-            raise HashMismatchError(source_archive)
+    _verify_hashes(source_archive, _chromium_hashes_generator(source_hashes))
     get_logger().info('Extracting archive...')
-    _extract_tar_file(source_archive, buildspace_tree, Path(), pruning_set,
-                      Path('chromium-{}'.format(config_bundle.version.chromium_version)))
-
-def _setup_extra_deps(config_bundle, buildspace_downloads, buildspace_tree, show_progress,
-                      pruning_set):
+    with tracing.span('extract', 'io', file=source_archive.name), memory_profile.stage(
+            'extract {}'.format(source_archive.name)):
+        _extract_tar_file(source_archive, buildspace_tree, Path(), pruning_set,
+                          Path('chromium-{}'.format(config_bundle.version.chromium_version)),
+                          pruning_rules, progress)
+
+def _setup_extra_deps(config_bundle, buildspace_downloads, buildspace_tree, show_progress, #pylint: disable=too-many-arguments
+                      pruning_set, pruning_rules, progress):
     """
     Download, check, and extract extra dependencies into the buildspace tree.
 
     Arguments of the same name are shared with retreive_and_extract().
-    pruning_set is a set of files to be pruned. Only the files that are ignored during
-    extraction are removed from the set.
+    pruning_set is a config.PathTrie of files to be pruned. Only the files that are ignored
+    during extraction are removed from the trie.
 
     Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
     Raises source_retrieval.NotAFileError when the archive name exists but is not a file.
@@ -216,19 +277,32 @@ def _setup_extra_deps(config_bundle, buildspace_downloads, buildspace_tree, show
         dep_archive = buildspace_downloads / dep_properties.download_name
         _download_if_needed(dep_archive, dep_properties.url, show_progress)
         get_logger().info('Verifying hashes...')
-        with dep_archive.open('rb') as file_obj:
-            archive_data = file_obj.read()
-        for hash_name, hash_hex in dep_properties.hashes.items():
-            get_logger().debug('Verifying %s hash...', hash_name)
-            hasher = hashlib.new(hash_name, data=archive_data)
-            if not hasher.hexdigest().lower() == hash_hex.lower():
-                raise HashMismatchError(dep_archive)
+        _verify_hashes(dep_archive, dep_properties.hashes.items())
         get_logger().info('Extracting archive...')
-        _extract_tar_file(dep_archive, buildspace_tree, Path(dep_name), pruning_set,
-                          Path(dep_properties.strip_leading_dirs))
+        with tracing.span('extract', 'io', file=dep_archive.name), memory_profile.stage(
+                'extract {}'.format(dep_archive.name)):
+            _extract_tar_file(dep_archive, buildspace_tree, Path(dep_name), pruning_set,
+                              Path(dep_properties.strip_leading_dirs), pruning_rules, progress)
 
-def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree,
-                         prune_binaries=True, show_progress=True):
+def get_downloads(config_bundle, buildspace_downloads):
+    """
+    Returns a list of tuples of the pathlib.Path and URL of every file that
+    retrieve_and_extract() downloads if it is missing.
+    """
+    source_archive, source_hashes = _get_source_archive(config_bundle, buildspace_downloads)
+    chromium_version = config_bundle.version.chromium_version
+    downloads = [
+        (source_archive, _SOURCE_ARCHIVE_URL.format(chromium_version)),
+        (source_hashes, _SOURCE_HASHES_URL.format(chromium_version)),
+    ]
+    for dep_name in config_bundle.extra_deps:
+        dep_properties = config_bundle.extra_deps[dep_name]
+        downloads.append(
+            (buildspace_downloads / dep_properties.download_name, dep_properties.url))
+    return downloads
+
+def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree, #pylint: disable=too-many-arguments
+                         prune_binaries=True, show_progress=True, progress=None):
     """
     Downloads, checks, and unpacks the Chromium source code and extra dependencies
     defined in the config bundle into the buildspace tree.
@@ -236,8 +310,12 @@ def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree,
 
     buildspace_downloads is the path to the buildspace downloads directory, and
     buildspace_tree is the path to the buildspace tree.
+    progress is a checkpoint.StageProgress to record extracted files into, or None.
+    If it is resuming, the buildspace tree is expected to be partially extracted, and
+    files recorded in it are not extracted again.
 
-    Raises FileExistsError when the buildspace tree already exists and is not empty
+    Raises FileExistsError when the buildspace tree already exists and is not empty,
+    unless progress is resuming
     Raises FileNotFoundError when buildspace/downloads does not exist or through
     another system operation.
     Raises NotADirectoryError if buildspace/downloads is not a directory or through
@@ -246,20 +324,30 @@ def retrieve_and_extract(config_bundle, buildspace_downloads, buildspace_tree,
     Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
     May raise undetermined exceptions during archive unpacking.
     """
-    ensure_empty_dir(buildspace_tree) # FileExistsError, FileNotFoundError
+    if progress is not None and progress.resumed:
+        get_logger().info('Resuming extraction after %s files', len(progress))
+        buildspace_tree.mkdir(exist_ok=True)
+    else:
+        ensure_empty_dir(buildspace_tree) # FileExistsError, FileNotFoundError
     if not buildspace_downloads.exists():
         raise FileNotFoundError(buildspace_downloads)
     if not buildspace_downloads.is_dir():
         raise NotADirectoryError(buildspace_downloads)
     if prune_binaries:
-        remaining_files = set(config_bundle.pruning)
+        remaining_files = PathTrie(config_bundle.pruning.plain_paths)
+        pruning_rules = config_bundle.pruning.rules
     else:
-        remaining_files = set()
-    _setup_chromium_source(config_bundle, buildspace_downloads, buildspace_tree, show_progress,
-                           remaining_files)
-    _setup_extra_deps(config_bundle, buildspace_downloads, buildspace_tree, show_progress,
-                      remaining_files)
+        remaining_files = PathTrie()
+        pruning_rules = None
+    with tracing.span('chromium source'):
+        _setup_chromium_source(config_bundle, buildspace_downloads, buildspace_tree,
+                               show_progress, remaining_files, pruning_rules, progress)
+    with tracing.span('extra deps'):
+        _setup_extra_deps(config_bundle, buildspace_downloads, buildspace_tree, show_progress,
+                          remaining_files, pruning_rules, progress)
     if remaining_files:
-        logger = get_logger()
-        for path in remaining_files:
-            logger.warning('File not found during source pruning: %s', path)
+        # Files that were not found in the archives are pruned in case they exist anyway,
+        # and reported otherwise
+        _PRUNED_FILES.add(file_removal.prune_files(
+            buildspace_tree.resolve(), remaining_files,
+            warning='File not found during source pruning: %s').deleted)
@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Module for recording where buildkit spends its time, in the Chrome trace event format.
+
+The trace can be opened in chrome://tracing or https://ui.perfetto.dev. Every span is
+recorded with the process and thread that ran it, including the workers of common.Executor.
+
+Tracing is disabled by default. Then, span() and file_span() return a shared no-op context
+manager, so spans can be left in hot loops.
+"""
+
+import functools
+import os
+import threading
+import time
+
+from .common import ENCODING
+
+# Private definitions
+
+class _NullSpan:
+    """Span that records nothing, used when tracing is disabled"""
+
+    __slots__ = ()
+
+    def set(self, **args):
+        """Does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    """Span that records a complete event when it exits"""
+
+    __slots__ = ('_trace', '_name', '_category', '_args', '_start')
+
+    def __init__(self, trace, name, category, args):
+        self._trace = trace
+        self._name = name
+        self._category = category
+        self._args = args
+        self._start = None
+
+    def set(self, **args):
+        """Adds arguments to the span, e.g. results that are known once it is done"""
+        self._args.update(args)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        if exc_info[0] is not None:
+            self._args['error'] = exc_info[0].__name__
+        self._trace.add_event(self._name, self._category, self._start, end, self._args)
+
+class _Trace:
+    """The events recorded in a process"""
+
+    def __init__(self, file_threshold):
+        self.file_threshold = file_threshold
+        self.events = list()
+        # Dictionary of (pid, tid) to thread names
+        self.thread_names = dict()
+
+    def add_event(self, name, category, start, end, args):
+        """Records a complete event. Timestamps are from time.perf_counter()"""
+        pid = os.getpid()
+        tid = threading.get_ident()
+        if (pid, tid) not in self.thread_names:
+            self.thread_names[(pid, tid)] = threading.current_thread().name
+        event = {
+            'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': start * 1e6, 'dur': (end - start) * 1e6,
+        }
+        if args:
+            event['args'] = args
+        self.events.append(event) # list.append() is thread-safe
+
+# The _Trace of this process, or None if tracing is disabled
+_trace = None
+
+class _TracedTask: #pylint: disable=too-few-public-methods
+    """
+    Wrapper for a task that runs in a worker process. The events recorded by the task are
+    returned with its result, to be merged into the trace of the parent process.
+    """
+
+    def __init__(self, function, file_threshold):
+        self._function = function
+        self._file_threshold = file_threshold
+
+    def __call__(self, *args):
+        global _trace #pylint: disable=global-statement
+        # A forked worker starts with a copy of the parent's trace, so always start over
+        _trace = _Trace(self._file_threshold)
+        try:
+            result = self._function(*args)
+            return result, _trace.events, _trace.thread_names
+        finally:
+            _trace = None
+
+def _merge_task_results(results):
+    """Yields the results of _TracedTask, and merges their events into the trace"""
+    for result, events, thread_names in results:
+        if _trace is not None:
+            _trace.events.extend(events)
+            _trace.thread_names.update(thread_names)
+        yield result
+
+# Public definitions
+
+def enable(file_threshold=None):
+    """
+    Enables tracing in this process and discards any events recorded before.
+
+    file_threshold is the minimum size in bytes of files that get their own span from
+    file_span(), or None to disable per-file spans.
+    """
+    global _trace #pylint: disable=global-statement
+    _trace = _Trace(file_threshold)
+
+def disable():
+    """Disables tracing and discards the recorded events"""
+    global _trace #pylint: disable=global-statement
+    _trace = None
+
+def is_enabled():
+    """Returns True if tracing is enabled; False otherwise"""
+    return _trace is not None
+
+def span(name, category='stage', **args):
+    """
+    Returns a context manager that records a span named name around its block.
+    Keyword arguments are recorded with the span, and more can be added with its set() method.
+
+    category is the category of the span, e.g. 'stage', 'io', 'hash', or 'file'
+    """
+    if _trace is None:
+        return _NULL_SPAN
+    return _Span(_trace, name, category, args)
+
+def file_span(path, size=None, category='file'):
+    """
+    Returns a context manager that records a span for processing the file at path, if
+    per-file spans are enabled and the file is at least as large as the threshold.
+
+    path is the path of the file, which is also the name of the span
+    size is the size of the file in bytes, or None to get it from the file
+    """
+    if _trace is None or _trace.file_threshold is None:
+        return _NULL_SPAN
+    if size is None:
+        try:
+            size = os.stat(str(path)).st_size
+        except OSError:
+            return _NULL_SPAN
+    if size < _trace.file_threshold:
+        return _NULL_SPAN
+    return _Span(_trace, str(path), category, {'size': size})
+
+def traced(category='stage'):
+    """
+    Returns a decorator that records a span around every call of the function, named after
+    the function's module and name.
+    """
+    def _decorator(function):
+        name = '{}.{}'.format(function.__module__.rpartition('.')[2], function.__qualname__)
+
+        @functools.wraps(function)
+        def _wrapper(*args, **kwargs):
+            with span(name, category):
+                return function(*args, **kwargs)
+        return _wrapper
+    return _decorator
+
+def wrap_task(function):
+    """
+    Returns function wrapped for running in a worker process, so that the spans it records
+    are kept. The results of the wrapped function must be passed through unwrap_results().
+    Returns function unchanged if tracing is disabled.
+    """
+    if _trace is None:
+        return function
+    return _TracedTask(function, _trace.file_threshold)
+
+def unwrap_results(function, results):
+    """
+    Returns an iterator of the results of function, which was returned by wrap_task(),
+    and merges the recorded spans into the trace.
+    """
+    if isinstance(function, _TracedTask):
+        return _merge_task_results(results)
+    return results
+
+def write(path):
+    """
+    Writes the recorded events to path as Chrome trace event JSON.
+    Does nothing if tracing is disabled.
+    """
+    import json
+    if _trace is None:
+        return
+    metadata = [{
+        'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+        'args': {'name': 'buildkit' if pid == os.getpid() else 'buildkit worker'},
+    } for pid in sorted({x[0] for x in _trace.thread_names})]
+    metadata.extend({
+        'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name},
+    } for (pid, tid), name in sorted(_trace.thread_names.items()))
+    with path.open('w', encoding=ENCODING) as trace_file:
+        json.dump({
+            'traceEvents': metadata + sorted(_trace.events, key=lambda x: x['ts']),
+            'displayTimeUnit': 'ms',
+        }, trace_file)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Benchmark candidate rewrites of a domain substitution regex against a corpus.
+
+Each candidate pattern is timed over every file of the corpus, and its output is compared
+against the output of the original pattern. A candidate is only a valid rewrite if it
+produces identical output for every file.
+"""
+
+import argparse
+import re
+import sys
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from buildkit.cli import NewBaseBundleAction
+from buildkit.common import BUILDSPACE_TREE, get_logger
+from buildkit.domain_substitution import TREE_ENCODINGS
+sys.path.pop(0)
+
+def _read_corpus(paths):
+    """Returns a list of tuples of each path and its decoded contents"""
+    corpus = list()
+    for path in paths:
+        with path.open('rb') as file_obj:
+            file_bytes = file_obj.read()
+        for encoding in TREE_ENCODINGS:
+            try:
+                corpus.append((path, file_bytes.decode(encoding)))
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            get_logger().warning('Skipping file that cannot be decoded: %s', path)
+    return corpus
+
+def _find_original_pair(config_bundle, pattern_arg):
+    """
+    Returns the regex pair of the bundle selected by pattern_arg, which is either
+    the zero-based index in domain_regex.list or the exact pattern string.
+    """
+    pairs = config_bundle.domain_regex.get_pairs()
+    if pattern_arg.isdigit():
+        return pairs[int(pattern_arg)]
+    for regex_pair in pairs:
+        if regex_pair.pattern.pattern == pattern_arg:
+            return regex_pair
+    raise KeyError(pattern_arg)
+
+def benchmark_pattern(pattern, replacement, corpus, repeat):
+    """
+    Returns a tuple of the fastest total time over repeat runs, the total number of
+    substitutions, and a list of outputs for each file in the corpus.
+    """
+    best_time = None
+    for _ in range(repeat):
+        outputs = list()
+        substitutions = 0
+        start_time = time.perf_counter()
+        for _, content in corpus:
+            output, sub_count = pattern.subn(replacement, content)
+            outputs.append(output)
+            substitutions += sub_count
+        elapsed = time.perf_counter() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time, substitutions, outputs
+
+def main(arg_list=None):
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--base-bundle', metavar='NAME', action=NewBaseBundleAction,
+                        required=True, help='The base bundle containing the original pattern')
+    parser.add_argument('-p', '--pattern', required=True,
+                        help=('The original pattern as its zero-based index in '
+                              'domain_regex.list, or as the exact pattern string'))
+    parser.add_argument('-c', '--candidate', action='append', default=list(),
+                        help=('A candidate rewrite of the pattern. It can have its own '
+                              'replacement in the same format as domain_regex.list. '
+                              'Can be specified multiple times.'))
+    parser.add_argument('--corpus', metavar='PATH', type=Path, nargs='+',
+                        help=('Files to use as the corpus. Default: the files of the bundle\'s '
+                              'domain substitution list in the buildspace tree'))
+    parser.add_argument('--tree', metavar='PATH', type=Path, default=BUILDSPACE_TREE,
+                        help='The buildspace tree for the default corpus. Default: %(default)s')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of timed runs per pattern; the fastest is used.')
+    args = parser.parse_args(args=arg_list)
+
+    try:
+        original = _find_original_pair(args.base_bundle, args.pattern)
+    except (KeyError, IndexError):
+        get_logger().error('Pattern not found in domain_regex.list: %s', args.pattern)
+        parser.exit(status=1)
+    candidates = list()
+    for candidate in args.candidate:
+        if '#' in candidate:
+            # Like domain_regex.list, the pattern ends at the first "#"
+            pattern, _, replacement = candidate.partition('#')
+        else:
+            pattern, replacement = candidate, original.replacement
+        try:
+            candidates.append((re.compile(pattern), replacement))
+        except re.error as exc:
+            get_logger().error('Invalid candidate pattern %s: %s', pattern, exc)
+            parser.exit(status=1)
+
+    if args.corpus:
+        corpus_paths = args.corpus
+    else:
+        resolved_tree = args.tree.resolve()
+        corpus_paths = [
+            resolved_tree / x for x in args.base_bundle.domain_substitution.expand(resolved_tree)
+        ]
+    corpus = _read_corpus(corpus_paths)
+    get_logger().info('Corpus has %s files', len(corpus))
+
+    original_time, original_subs, original_outputs = benchmark_pattern(
+        original.pattern, original.replacement, corpus, args.repeat)
+    print('{:>9} {:>9} {:>9}  {}'.format('Seconds', 'Speedup', 'Subs', 'Pattern'))
+    print('{:>9.3f} {:>9} {:>9,d}  {}'.format(
+        original_time, '-', original_subs, original.pattern.pattern))
+    mismatched = False
+    for pattern, replacement in candidates:
+        candidate_time, candidate_subs, candidate_outputs = benchmark_pattern(
+            pattern, replacement, corpus, args.repeat)
+        print('{:>9.3f} {:>8.2f}x {:>9,d}  {}'.format(
+            candidate_time, original_time / candidate_time if candidate_time else 0,
+            candidate_subs, pattern.pattern))
+        for (path, _), original_output, candidate_output in zip(
+                corpus, original_outputs, candidate_outputs):
+            if original_output != candidate_output:
+                mismatched = True
+                get_logger().error('Output differs from the original pattern: %s', path)
+    if mismatched:
+        parser.exit(status=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Benchmark compiled config file schemas against the interpreted third_party.schema validation.
+
+The INI config files of every base bundle (merged with their dependencies, as buildkit does)
+are validated repeatedly with both. Invalid variants of each file are also validated to check
+that both raise the same error messages.
+"""
+
+import argparse
+import configparser
+import sys
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from buildkit.common import CONFIG_BUNDLES_DIR, ENCODING, get_logger, get_resources_dir
+from buildkit.config import (
+    BASEBUNDLEMETA_INI, EXTRA_DEPS_INI, VERSION_INI, BaseBundleMetaIni, BundleCatalog,
+    CompiledSchema, ExtraDepsIni, VersionIni)
+from buildkit.third_party import schema
+sys.path.pop(0)
+
+_INI_CLASSES = {
+    BASEBUNDLEMETA_INI: BaseBundleMetaIni,
+    EXTRA_DEPS_INI: ExtraDepsIni,
+    VERSION_INI: VersionIni,
+}
+
+def _read_ini(ini_paths):
+    """Returns a ConfigParser of the INI files in ini_paths, merged in order"""
+    parsed_ini = configparser.ConfigParser()
+    for ini_path in ini_paths:
+        with ini_path.open(encoding=ENCODING) as ini_file:
+            parsed_ini.read_file(ini_file, source=str(ini_path))
+    return parsed_ini
+
+def _get_ini_paths(catalog, file_name):
+    """Returns a list of lists of the paths to merge for every config file named file_name"""
+    if file_name == BASEBUNDLEMETA_INI:
+        # These are not merged with dependencies
+        return [
+            [x] for x in sorted(
+                (get_resources_dir() / CONFIG_BUNDLES_DIR).glob('*/' + file_name))
+        ]
+    ini_paths = list()
+    for name in catalog:
+        config_file = catalog.get_bundle(name)[file_name]
+        if config_file.path is not None:
+            ini_paths.append(list(config_file._path_order)) #pylint: disable=protected-access
+    return ini_paths
+
+def _invalid_variants(parsed_ini):
+    """Yields tuples of a description and an invalid copy of the ConfigParser"""
+    for section in parsed_ini.sections():
+        for key in parsed_ini[section]:
+            variant = _copy_ini(parsed_ini)
+            del variant[section][key]
+            yield 'missing {}.{}'.format(section, key), variant
+            variant = _copy_ini(parsed_ini)
+            variant[section][key] = ''
+            yield 'empty {}.{}'.format(section, key), variant
+        variant = _copy_ini(parsed_ini)
+        variant[section]['unknown_key'] = 'value'
+        yield 'unknown key in {}'.format(section), variant
+    variant = _copy_ini(parsed_ini)
+    variant['unknown_section'] = {'unknown_key': 'value'}
+    yield 'unknown section', variant
+
+def _copy_ini(parsed_ini):
+    """Returns a copy of the ConfigParser"""
+    new_ini = configparser.ConfigParser()
+    new_ini.read_dict(parsed_ini)
+    return new_ini
+
+def _get_error(validator, data):
+    """Returns the message of the SchemaError raised by validator, or None"""
+    try:
+        validator.validate(data)
+    except schema.SchemaError as exc:
+        return str(exc)
+    return None
+
+def _time_validation(validator, inis, repeat):
+    """Returns the fastest time in seconds to validate all inis once"""
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for parsed_ini in inis:
+            validator.validate(parsed_ini)
+        elapsed = time.perf_counter() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time
+
+def main(arg_list=None):
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--repeat', type=int, default=200,
+                        help='Number of timed runs per schema; the fastest is used.')
+    args = parser.parse_args(args=arg_list)
+
+    catalog = BundleCatalog()
+    mismatched = False
+    print('{:<20} {:>5} {:>15} {:>15} {:>9}'.format(
+        'File', 'Count', 'Interpreted', 'Compiled', 'Speedup'))
+    for file_name, ini_class in sorted(_INI_CLASSES.items()):
+        inis = [_read_ini(x) for x in _get_ini_paths(catalog, file_name)]
+        interpreted = ini_class._schema #pylint: disable=protected-access
+        compiled = CompiledSchema(interpreted)
+        for parsed_ini in inis:
+            for description, variant in _invalid_variants(parsed_ini):
+                expected = _get_error(interpreted, variant)
+                if _get_error(compiled, variant) != expected:
+                    mismatched = True
+                    get_logger().error('Different error for %s (%s)', file_name, description)
+        interpreted_time = _time_validation(interpreted, inis, args.repeat)
+        compiled_time = _time_validation(compiled, inis, args.repeat)
+        print('{:<20} {:>5} {:>12.1f} us {:>12.1f} us {:>8.2f}x'.format(
+            file_name, len(inis), interpreted_time * 1e6, compiled_time * 1e6,
+            interpreted_time / compiled_time if compiled_time else 0))
+    if mismatched:
+        parser.exit(status=1)
+
+if __name__ == '__main__':
+    main()
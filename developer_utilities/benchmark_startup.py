@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2018 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""
+Benchmark the import time of buildkit's CLI for each command.
+
+Every command is run with "python -X importtime". The total time spent importing modules is
+checked against a threshold, and modules that should only be imported by the callbacks of
+other commands must not be imported at all.
+"""
+
+import argparse
+import subprocess
+import sys
+
+from pathlib import Path
+
+_ROOT_DIR = Path(__file__).resolve().parent.parent
+
+sys.path.insert(0, str(_ROOT_DIR))
+from buildkit.common import get_logger
+sys.path.pop(0)
+
+# Arguments of the commands to benchmark. Commands that need a buildspace only print help.
+_COMMANDS = (
+    ('bunnfo', '--list'),
+    ('genbun', '--help'),
+    ('getsrc', '--help'),
+    ('prubin', '--help'),
+    ('subdom', '--help'),
+    ('index', '--help'),
+    ('genpkg', '--help'),
+    ('run', '--help'),
+)
+
+# Modules (and their submodules) that must only be imported when needed by a callback
+_DEFERRED_MODULES = (
+    'buildkit.checkpoint',
+    'buildkit.domain_index',
+    'buildkit.domain_substitution',
+    'buildkit.file_removal',
+    'buildkit.memory_profile',
+    'buildkit.metrics',
+    'buildkit.packaging',
+    'buildkit.sharding',
+    'buildkit.source_retrieval',
+    'buildkit.tracing',
+    'tarfile',
+    'urllib.request',
+)
+
+def _measure_imports(command_args):
+    """
+    Returns a tuple of the total import time in seconds and the set of modules imported
+    by the buildkit CLI with command_args.
+    """
+    result = subprocess.run(
+        (sys.executable, '-X', 'importtime', '-m', 'buildkit') + command_args,
+        cwd=str(_ROOT_DIR), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode:
+        get_logger().error('Command failed: %s\n%s', ' '.join(command_args), result.stderr)
+        raise subprocess.CalledProcessError(result.returncode, command_args)
+    total_us = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, _, module = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue # Header line
+        total_us += int(self_us)
+        modules.add(module.strip())
+    return total_us / 1e6, modules
+
+def _is_deferred(module):
+    """Returns True if module is one of _DEFERRED_MODULES or their submodules"""
+    return any(module == x or module.startswith(x + '.') for x in _DEFERRED_MODULES)
+
+def main(arg_list=None):
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of runs per command; the fastest is used.')
+    parser.add_argument('-t', '--threshold', metavar='MS', type=float, default=100,
+                        help=('The maximum import time of a command in milliseconds. '
+                              'Default: %(default)s'))
+    args = parser.parse_args(args=arg_list)
+
+    regressed = False
+    print('{:<16} {:>10} {:>8}'.format('Command', 'Imports', 'Modules'))
+    for command_args in _COMMANDS:
+        best_time = None
+        for _ in range(args.repeat):
+            import_time, modules = _measure_imports(command_args)
+            if best_time is None or import_time < best_time:
+                best_time = import_time
+        print('{:<16} {:>7.1f} ms {:>8}'.format(
+            ' '.join(command_args), best_time * 1e3, len(modules)))
+        if best_time * 1e3 > args.threshold:
+            regressed = True
+            get_logger().error('Import time exceeds %s ms: %s', args.threshold, command_args[0])
+        deferred = sorted(filter(_is_deferred, modules))
+        if deferred:
+            regressed = True
+            get_logger().error(
+                'Modules imported before they are needed by %s: %s',
+                command_args[0], ', '.join(deferred))
+    if regressed:
+        parser.exit(status=1)
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ No binary pruning or domain substitution will be applied to the buildspace tree
 the process has finished.
 """
 
+import re
 import sys
 import argparse
 
@@ -21,8 +22,9 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from buildkit.cli import NewBaseBundleAction
 from buildkit.common import (
     BUILDSPACE_DOWNLOADS, BUILDSPACE_TREE, ENCODING, BuildkitAbort, get_logger, dir_empty)
+from buildkit.config import walk_tree_files
 from buildkit.domain_substitution import TREE_ENCODINGS
-from buildkit import source_retrieval
+from buildkit import memory_profile, sharding, source_retrieval
 sys.path.pop(0)
 
 # NOTE: Include patterns have precedence over exclude patterns
@@ -177,7 +179,48 @@ def should_domain_substitute(path, relative_path, search_regex):
                     return False
             return _check_regex_match(path, search_regex)
 
-def compute_lists(buildspace_tree, search_regex):
+def _classify_file(path, relative_path, search_regex):
+    """
+    Returns 'prune' if the file should be pruned, 'domain' if it should be domain
+    substituted, or None otherwise
+
+    Raises BuildkitAbort if the file could not be processed.
+    """
+    try:
+        if should_prune(path, relative_path):
+            return 'prune'
+        if should_domain_substitute(path, relative_path, search_regex):
+            return 'domain'
+        return None
+    except:
+        get_logger().exception('Unhandled exception while processing %s', relative_path)
+        raise BuildkitAbort()
+
+def _classify_shard(parameters, relative_paths, heartbeat):
+    """
+    Task function of buildkit.sharding for classifying files of the buildspace tree.
+
+    parameters is a dictionary with the keys 'tree' (the resolved buildspace tree path),
+    'search_regex' and 'search_flags' (the pattern and flags of the domain search regex)
+
+    Returns a list of the results of _classify_file() for relative_paths.
+    """
+    buildspace_tree = Path(parameters['tree'])
+    search_regex = re.compile(parameters['search_regex'], parameters['search_flags'])
+    results = list()
+    for relative_posix in relative_paths:
+        relative_path = Path(relative_posix)
+        results.append(_classify_file(buildspace_tree / relative_path, relative_path,
+                                      search_regex))
+        heartbeat()
+    return results
+
+# Task functions for --worker
+SHARD_TASKS = {
+    'compute_lists': _classify_shard,
+}
+
+def compute_lists(buildspace_tree, search_regex, shard_dir=None, shard_workers=None):
     """
     Compute the binary pruning and domain substitution lists of the buildspace tree.
     Returns a tuple of two items in the following order:
@@ -186,53 +229,141 @@ def compute_lists(buildspace_tree, search_regex):
 
     buildspace_tree is a pathlib.Path to the buildspace tree
     search_regex is a compiled regex object to search for domain names
+    shard_dir and shard_workers are the job_dir and local_workers arguments of
+    buildkit.sharding.run_job(). If both are None, files are processed in this process.
+    Otherwise, files are processed as a sharded job, with the same result.
+
+    Raises BuildkitAbort if a file could not be processed.
     """
-    pruning_set = set()
-    domain_substitution_set = set()
-    deferred_symlinks = dict() # POSIX resolved path -> set of POSIX symlink paths
     buildspace_tree = buildspace_tree.resolve()
-    for path in buildspace_tree.rglob('*'):
+    file_list = list() # POSIX relative paths of regular files
+    symlinks = list() # Tuples of POSIX symlink paths and POSIX resolved paths
+    for path in sorted(buildspace_tree.rglob('*')):
         if not path.is_file():
             # NOTE: Path.rglob() does not traverse symlink dirs; no need for special handling
             continue
-        relative_path = path.relative_to(buildspace_tree)
+        relative_posix = path.relative_to(buildspace_tree).as_posix()
         if path.is_symlink():
-            resolved_relative_posix = path.resolve().relative_to(buildspace_tree).as_posix()
-            if resolved_relative_posix in pruning_set:
-                pruning_set.add(relative_path.as_posix())
-            else:
-                symlink_set = deferred_symlinks.get(resolved_relative_posix, None)
-                if symlink_set is None:
-                    symlink_set = set()
-                    deferred_symlinks[resolved_relative_posix] = symlink_set
-                symlink_set.add(relative_path.as_posix())
-            # Path has finished processing because...
-            # Pruning: either symlink has been added or removal determination has been deferred
+            # Pruning: symlinks are pruned along with the files they resolve to
             # Domain substitution: Only the real paths can be added, not symlinks
-            continue
-        try:
-            if should_prune(path, relative_path):
-                relative_posix_path = relative_path.as_posix()
-                pruning_set.add(relative_posix_path)
-                symlink_set = deferred_symlinks.pop(relative_posix_path, tuple())
-                if symlink_set:
-                    pruning_set.update(symlink_set)
-            elif should_domain_substitute(path, relative_path, search_regex):
-                domain_substitution_set.add(relative_path.as_posix())
-        except:
-            get_logger().exception('Unhandled exception while processing %s', relative_path)
-            raise BuildkitAbort()
+            symlinks.append(
+                (relative_posix, path.resolve().relative_to(buildspace_tree).as_posix()))
+        else:
+            file_list.append(relative_posix)
+    if shard_dir is None and shard_workers is None:
+        classifications = [
+            _classify_file(buildspace_tree / x, Path(x), search_regex) for x in file_list]
+    else:
+        classifications = sharding.run_job(
+            'compute_lists', _classify_shard, {
+                'tree': str(buildspace_tree),
+                'search_regex': search_regex.pattern,
+                'search_flags': search_regex.flags,
+            }, file_list, job_dir=shard_dir, local_workers=shard_workers)
+    pruning_set = set()
+    domain_substitution_set = set()
+    for relative_posix, classification in zip(file_list, classifications):
+        if classification == 'prune':
+            pruning_set.add(relative_posix)
+        elif classification == 'domain':
+            domain_substitution_set.add(relative_posix)
+    pruning_set.update(x for x, resolved in symlinks if resolved in pruning_set)
     return sorted(pruning_set), sorted(domain_substitution_set)
 
+def _build_dir_tree(tree_files, selected_set):
+    """
+    Returns a nested dictionary of the directories of tree_files. Each directory has the keys
+    'files' (a list of tuples of the file path and whether it is selected), 'dirs' (a dictionary
+    of names to subdirectories), 'path' (the POSIX relative path) and 'selected' and
+    'unselected' (the number of files below the directory of each kind).
+    """
+    root = {'files': list(), 'dirs': dict(), 'path': '', 'selected': 0, 'unselected': 0}
+    for file_path in tree_files:
+        is_selected = file_path in selected_set
+        node = root
+        node['selected' if is_selected else 'unselected'] += 1
+        for part in file_path.split('/')[:-1]:
+            if part not in node['dirs']:
+                if node['path']:
+                    dir_path = node['path'] + '/' + part
+                else:
+                    dir_path = part
+                node['dirs'][part] = {
+                    'files': list(), 'dirs': dict(), 'path': dir_path,
+                    'selected': 0, 'unselected': 0}
+            node = node['dirs'][part]
+            node['selected' if is_selected else 'unselected'] += 1
+        node['files'].append((file_path, is_selected))
+    return root
+
+def _list_selected(node):
+    """Returns the lines for a directory with only plain paths"""
+    lines = list()
+    for file_path, is_selected in node['files']:
+        if is_selected:
+            lines.append(file_path)
+    for subnode in node['dirs'].values():
+        if subnode['selected']:
+            lines.extend(_list_selected(subnode))
+    return lines
+
+def _compact_covered(node):
+    """Returns the lines for a directory that is matched by a directory rule"""
+    if not node['unselected']:
+        return list()
+    lines = list()
+    for file_path, is_selected in node['files']:
+        if not is_selected:
+            lines.append('!' + file_path)
+    for subnode in node['dirs'].values():
+        lines.extend(_compact_covered(subnode))
+    excluded_lines = ['!{}/'.format(node['path'])] + _list_selected(node)
+    if len(excluded_lines) < len(lines):
+        return excluded_lines
+    return lines
+
+def _compact_uncovered(node):
+    """Returns the lines for a directory that is not matched by any rule"""
+    if not node['selected']:
+        return list()
+    lines = list()
+    for file_path, is_selected in node['files']:
+        if is_selected:
+            lines.append(file_path)
+    for subnode in node['dirs'].values():
+        lines.extend(_compact_uncovered(subnode))
+    if node['path']:
+        covered_lines = ['{}/'.format(node['path'])] + _compact_covered(node)
+        if len(covered_lines) < len(lines):
+            return covered_lines
+    return lines
+
+def compact_list(path_list, buildspace_tree):
+    """
+    Returns a sorted list of plain paths and directory rules with exceptions that expands to
+    exactly the paths of path_list in the buildspace tree, with the fewest lines.
+    See buildkit.config.PathRules for the rule syntax.
+
+    path_list is an iterable of POSIX relative paths
+    buildspace_tree is a pathlib.Path to the buildspace tree
+    """
+    selected_set = set(path_list)
+    tree_files = set(walk_tree_files(buildspace_tree.resolve()))
+    lines = _compact_uncovered(_build_dir_tree(tree_files, selected_set))
+    # Paths that are not found by the tree walk can only be plain paths
+    lines.extend(selected_set - tree_files)
+    return sorted(lines, key=lambda x: x.lstrip('!'))
+
 def main(args_list=None):
     """CLI entrypoint"""
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-b', '--base-bundle', metavar='NAME', action=NewBaseBundleAction,
-                        required=True, help='The base bundle to use')
-    parser.add_argument('-p', '--pruning', metavar='PATH', type=Path, required=True,
-                        help='The path to store pruning.list')
-    parser.add_argument('-d', '--domain-substitution', metavar='PATH', type=Path, required=True,
-                        help='The path to store domain_substitution.list')
+                        help='The base bundle to use. Required unless --worker is used.')
+    parser.add_argument('-p', '--pruning', metavar='PATH', type=Path,
+                        help='The path to store pruning.list. Required unless --worker is used.')
+    parser.add_argument('-d', '--domain-substitution', metavar='PATH', type=Path,
+                        help=('The path to store domain_substitution.list. '
+                              'Required unless --worker is used.'))
     parser.add_argument('--tree', metavar='PATH', type=Path, default=BUILDSPACE_TREE,
                         help=('The path to the buildspace tree to create. '
                               'If it is not empty, the source will not be unpacked. '
@@ -240,19 +371,60 @@ def main(args_list=None):
     parser.add_argument('--downloads', metavar='PATH', type=Path, default=BUILDSPACE_DOWNLOADS,
                         help=('The path to the buildspace downloads directory. '
                               'It must already exist. Default: %s') % BUILDSPACE_DOWNLOADS)
+    parser.add_argument('--compact', action='store_true',
+                        help=('Write the lists with directory rules and exceptions where '
+                              'they need fewer lines than plain paths'))
+    parser.add_argument('--memprofile', metavar='PATH', type=Path,
+                        help=('Profile the memory usage of every stage, log a report, and '
+                              'write it to PATH as JSON. This is much slower.'))
+    parser.add_argument('--shard-dir', metavar='PATH', type=Path,
+                        help=('Compute the lists as a sharded job published in PATH, which must '
+                              'be empty. Workers on other hosts can join with --worker if PATH '
+                              'and the buildspace tree are shared at the same paths.'))
+    parser.add_argument('--shard-workers', metavar='COUNT', type=int,
+                        help=('Compute the lists as a sharded job with COUNT worker processes '
+                              'on this host. With 0, only workers started with --worker '
+                              'process the job. Default with --shard-dir: BUILDKIT_JOBS or the '
+                              'number of CPUs available'))
+    parser.add_argument('--worker', metavar='PATH', type=Path,
+                        help=('Process shards of the job published in PATH by another '
+                              'instance with --shard-dir, then exit. Other options are ignored.'))
     args = parser.parse_args(args_list)
 
+    if args.worker:
+        sharding.run_worker(args.worker, SHARD_TASKS)
+        return
+    if not (args.base_bundle and args.pruning and args.domain_substitution):
+        parser.error('-b/--base-bundle, -p/--pruning, and -d/--domain-substitution are required')
+    if args.shard_workers is not None and args.shard_workers < 0:
+        parser.error('--shard-workers must not be negative')
+    if args.memprofile:
+        memory_profile.enable()
     try:
         if args.tree.exists() and not dir_empty(args.tree):
             get_logger().info('Using existing buildspace tree at %s', args.tree)
         else:
-            source_retrieval.retrieve_and_extract(
-                args.base_bundle, args.downloads, args.tree, prune_binaries=False)
+            with memory_profile.stage('retrieve_and_extract'):
+                source_retrieval.retrieve_and_extract(
+                    args.base_bundle, args.downloads, args.tree, prune_binaries=False)
         get_logger().info('Computing lists...')
-        pruning_list, domain_substitution_list = compute_lists(
-            args.tree, args.base_bundle.domain_regex.search_regex)
+        with memory_profile.stage('compute_lists'):
+            pruning_list, domain_substitution_list = compute_lists(
+                args.tree, args.base_bundle.domain_regex.search_regex,
+                shard_dir=args.shard_dir, shard_workers=args.shard_workers)
+        if args.compact:
+            with memory_profile.stage('compact_list'):
+                pruning_list = compact_list(pruning_list, args.tree)
+                domain_substitution_list = compact_list(domain_substitution_list, args.tree)
     except BuildkitAbort:
         exit(1)
+    except FileExistsError as exc:
+        get_logger().error('Shard directory is not empty: %s', exc)
+        exit(1)
+    finally:
+        if args.memprofile:
+            get_logger().info('Memory profile:\n%s', memory_profile.report())
+            memory_profile.write_json(args.memprofile)
     with args.pruning.open('w', encoding=ENCODING) as file_obj:
         file_obj.writelines('%s\n' % line for line in pruning_list)
     with args.domain_substitution.open('w', encoding=ENCODING) as file_obj: